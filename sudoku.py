@@ -1,31 +1,154 @@
+import io
+import marshal
+import os
+import sys
+
+### Grid geometry and candidate bitmasks
+#
+# The grid is stored as one flat list of 81 candidate bitmasks, cell index = row * 9 + col.
+# Bit n-1 of a mask is set when digit n is still possible in that cell, so an empty cell is 0x1FF
+# and a settled cell has exactly one bit set.  Cell and Sudoku objects are thin views over that list.
+#
+# The tables that take a while to build (the peer tables) are saved, the first time they are built, in a marshal
+# file next to the compiled modules in __pycache__, and later runs load them from there -- a few milliseconds
+# instead of 15.  The file is rebuilt whenever sudoku.py changes; "python3 sudoku.py" builds it ahead of time, and
+# the SUDOKU_TABLES environment variable can name another place for it.
+
+TABLE_FILE = os.environ.get("SUDOKU_TABLES") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__",
+	"sudoku_tables.{}.marshal".format(sys.implementation.cache_tag))
+
+def table_stamp():					# identifies this version of sudoku.py
+	stat = os.stat(__file__)
+	return [stat.st_mtime_ns, stat.st_size]
+
+def load_table_file():				# {table name: table} saved by save_table_file(), or {} if missing or out of date
+	try:
+		with open(TABLE_FILE, "rb") as ifile:
+			saved = marshal.loads(ifile.read())	# much faster than marshal.load(ifile)
+		if saved.get("stamp") == table_stamp():
+			return saved
+	except (OSError, EOFError, ValueError, TypeError, AttributeError):
+		pass
+	return {}
+
+# Each process writes its own temporary file (several pool workers may start at once with no tables saved) and
+# puts it in place in one step, so a half-written file is never where it would be read
+def save_table_file(tables):
+	temp_file = "{}.{}.tmp".format(TABLE_FILE, os.getpid())
+	try:
+		os.makedirs(os.path.dirname(TABLE_FILE), exist_ok=True)
+		with open(temp_file, "wb") as ofile:
+			marshal.dump(dict(tables, stamp=table_stamp()), ofile)
+		os.replace(temp_file, TABLE_FILE)
+	except OSError:					# e.g. a read-only install; the tables are simply built each time
+		try:
+			os.remove(temp_file)
+		except OSError:
+			pass
+
+saved_tables = load_table_file()
+
+ROW_OF = [i // 9 for i in range(81)]							# row number of each cell index
+COL_OF = [i % 9 for i in range(81)]								# col number of each cell index
+BOX_OF = [(i // 27) * 3 + (i % 9) // 3 for i in range(81)]		# box number of each cell index
+
+ROW_INDICES = [[r * 9 + c for c in range(9)] for r in range(9)]	# cell indices of each row
+COL_INDICES = [[r * 9 + c for r in range(9)] for c in range(9)]	# cell indices of each col
+BOX_INDICES = [[i for i in range(81) if BOX_OF[i] == b] for b in range(9)]	# cell indices of each box
+UNIT_INDICES = ROW_INDICES + COL_INDICES + BOX_INDICES			# units 0-8 are rows, 9-17 cols, 18-26 boxes
+CELL_UNITS = [(ROW_OF[i], 9 + COL_OF[i], 18 + BOX_OF[i]) for i in range(81)]	# the 3 units each cell is in
+
+if "COMMON_PEERS" in saved_tables:
+	PEER_SETS, SEES, COMMON_PEERS = saved_tables["PEER_SETS"], saved_tables["SEES"], saved_tables["COMMON_PEERS"]
+else:
+	PEER_SETS = [frozenset(j for j in range(81) if j != i and (ROW_OF[j] == ROW_OF[i] or COL_OF[j] == COL_OF[i]
+		or BOX_OF[j] == BOX_OF[i])) for i in range(81)]			# the 20 cells each cell sees
+	SEES = [[j in PEER_SETS[i] for j in range(81)] for i in range(81)]	# SEES[i][j]: does cell i see cell j?
+	COMMON_PEERS = [[tuple(sorted(PEER_SETS[i] & PEER_SETS[j])) for j in range(81)] for i in range(81)]	# cells that see both i and j
+	save_table_file({"PEER_SETS": PEER_SETS, "SEES": SEES, "COMMON_PEERS": COMMON_PEERS})
+PEERS = [tuple(sorted(peers)) for peers in PEER_SETS]			# same as PEER_SETS, as sorted tuples for fast iteration
+PEER_BITS = [sum([1 << j for j in peers]) for peers in PEERS]	# same, as 81-bit sets (bit j for cell j)
+
+ALL_DIGITS = 0x1FF												# mask with all digits 1-9 possible
+DIGIT_BIT = [0] + [1 << (n - 1) for n in range(1, 10)]			# DIGIT_BIT[n] is the mask bit for digit n
+MASK_DIGITS = [[n for n in range(1, 10) if m & DIGIT_BIT[n]] for m in range(512)]	# sorted digit list of each mask
+MASK_COUNT = [len(digits) for digits in MASK_DIGITS]			# number of digits in each mask
+MASK_TEXT = [str(digits) for digits in MASK_DIGITS]				# each mask's digit list as printed, e.g. "[1, 2]"
+
+def digits_to_mask(digits):
+	mask = 0
+	for n in digits:
+		mask |= DIGIT_BIT[n]
+	return mask
+
+# The 9 grid lines of a grid given as text (9 lines in the sudoku.txt layout, or one 81-character line in which
+# '0' and '.' also mark empty cells) or as a 9x9 list of rows of digits (0, None, or '-' for empty cells)
+def grid_to_lines(grid):
+	if isinstance(grid, str):
+		line = grid.strip()
+		if len(line) == 81 and "\n" not in line:
+			line = line.replace("0", "-").replace(".", "-")
+			lines = [line[i:i + 9] for i in range(0, 81, 9)]
+		else:
+			lines = grid.strip("\n").split("\n")
+	else:
+		lines = ["".join(["-" if n in (0, None) else str(n) for n in row]) for row in grid]
+	if len(lines) < 9:
+		raise Exception ("Grid has {} rows; a sudoku needs 9.".format(len(lines)))
+	return lines[:9]
+
+# Make a Sudoku from a grid given in any of the forms grid_to_lines accepts
+def sudoku_from_grid(grid):
+	return Sudoku(io.StringIO("\n".join(grid_to_lines(grid))))
+
+
+# Make a Sudoku whose cells have the given 81 candidate bitmasks
+def sudoku_from_masks(masks):
+	s = Sudoku(None)
+	s.cands[:] = [int(mask) for mask in masks]		# fill in place; the Cells are views of this list
+	return s
+
+# The cells that lost candidates from snapshot old to snapshot new (see Sudoku.snapshot), as a list of
+# (cell index, [digits lost]) in cell order
+def diff_snapshots(old, new):
+	return [(i, MASK_DIGITS[a & ~b]) for i, (a, b) in enumerate(zip(old, new)) if a != b and a & ~b]
+
+
+# Raised when a rule would leave a cell with no options: the givens contradict each other (or a rule is wrong).
+# The message says which cell and which options, so callers needn't print anything to find out.
+class Contradiction(Exception):
+	pass
+
+
 class Sudoku:
 
 	def __init__(self, ifile):
 		# Initialize sudoku with all numbers possible in all cells
-		self.rows = [[],[],[],[],[],[],[],[],[]]	# List of rows; each row is a list of Cells
-		self.cols = [[],[],[],[],[],[],[],[],[]]	# list of cols; each col is a list of Cells
-		self.boxes = [[],[],[],[],[],[],[],[],[]]	# List of boxes; each box is a list of Cells
+		self.cands = [ALL_DIGITS] * 81		# Flat grid of candidate bitmasks; all numbers possible
+		self.changes = []					# Log of indices of cells that lost options; cleared by clear_changed()
+		self.cells = [Cell(None, self.cands, i, self.changes) for i in range(81)]		# One Cell view per grid index
+		self.rows = [[self.cells[i] for i in indices] for indices in ROW_INDICES]	# List of rows; each row is a list of Cells
+		self.cols = [[self.cells[i] for i in indices] for indices in COL_INDICES]	# list of cols; each col is a list of Cells
+		self.boxes = [[self.cells[i] for i in indices] for indices in BOX_INDICES]	# List of boxes; each box is a list of Cells
+		self.units = self.rows + self.cols + self.boxes		# All 27 containers, numbered as in UNIT_INDICES
 		self.__changed = False
-		
-		for i in range(9):
+		self.__trace_sink = None	# function to call with each rule's diagnostic messages, e.g. print
+		self.links = None			# sudoku_solver.LinkGraph of this grid, made when a rule first asks for it
+		self.recorder = None		# sudoku_solver.StepRecorder the rules report their steps to, or None
+		self.display = None			# sudoku_solver.GridDisplay the solving drivers show each pass on, or None
+
+		for i in range(9 if ifile is not None else 0):		# no file: leave every cell with all numbers possible
 			line = ifile.readline()
 
 			for j in range(9):
 				c = line[j]
 				if c in "-_ ":						# empty Cells are marked with '-', '_', or ' '
-					this_cell = Cell([1,2,3,4,5,6,7,8,9])	# empty Cells start with all numbers possible
+					continue						# empty Cells start with all numbers possible
 				elif c in "123456789":
-					this_cell = Cell([int(c)])		# known Cells start with single value
+					self.cands[i * 9 + j] = DIGIT_BIT[int(c)]		# known Cells start with single value
 				else:
 					raise Exception ("Invalid character {} in input.".format(c))
 
-				this_cell.set_row(i)
-				this_cell.set_col(j)
-
-				self.rows[i].append(this_cell)
-				self.cols[j].append(this_cell)
-				self.boxes[this_cell.get_box()].append(this_cell)
-
 	def get_rows(self):
 		return self.rows
 
@@ -38,8 +161,18 @@ class Sudoku:
 	def get_cell(self, r, c):
 		return self.rows[r][c]
 
+	def get_units(self):
+		return self.units
+
+	def get_cands(self):
+		return self.cands
+
+	def get_changes(self):
+		return self.changes
+
 	def clear_changed(self):
 		self.__changed = False
+		del self.changes[:]
 
 	def set_changed(self):
 		self.__changed = True
@@ -47,70 +180,129 @@ class Sudoku:
 	def is_changed(self):
 		return self.__changed
 
+	def set_trace(self, sink):		# sink is called with one string per message; None turns tracing off
+		self.__trace_sink = sink
+
+	def is_tracing(self):
+		return self.__trace_sink is not None
+
+	def set_recorder(self, recorder):	# recorder is a sudoku_solver.StepRecorder; None turns recording off
+		self.recorder = recorder
+
+	def set_display(self, display):	# display is a sudoku_solver.GridDisplay; None turns it off
+		self.display = display
+
+	def trace(self, *args):			# report a rule's progress, formatted like print(*args)
+		if self.__trace_sink is not None:
+			self.__trace_sink(" ".join([str(a) for a in args]))
+
+	def to_line(self):				# 81-character line of settled digits, '-' for unsettled cells
+		return "".join([str(MASK_DIGITS[mask][0]) if MASK_COUNT[mask] == 1 else "-" for mask in self.cands])
+
 	def is_solved(self):
-		for i in range(9):
-			for j in range(9):
-				if self.rows[i][j].number_of_options() > 1:
-					return False
+		for mask in self.cands:
+			if MASK_COUNT[mask] > 1:
+				return False
 		return True
 
-	def print_sudoku(self, container_type):
-		print("-----------------------------")
+	def count_options(self):		# total number of candidates left in all cells
+		return sum(map(MASK_COUNT.__getitem__, self.cands))
+
+	# Snapshots: an immutable copy of the candidates, a tuple of the 81 masks -- one pointer per cell, sharing the
+	# mask values with the grid -- taken in a single copy.  A sudoku can be put back into any snapshot of it (or of
+	# any other grid) with restore(); sudoku_from_masks(snapshot) makes a new Sudoku from one, and diff_snapshots()
+	# lists what changed between two.
+
+	def snapshot(self):
+		return tuple(self.cands)
+
+	def restore(self, snapshot):	# set every cell's candidates as in snapshot; the change log and flag are left alone
+		self.cands[:] = snapshot	# in place, since the Cells are views of this list
+
+	def print_sudoku(self, container_type):		# the whole grid is built first, then printed in one write
+		lines = ["-----------------------------"]
 		for i in range(9):
-			for j in range(9):
-				print(container_type[i][j], end="")
-				if (j + 1) % 3 == 0 and j < 8:
-					print("|", end="")
-			print()
+			cells = [MASK_TEXT[cell.get_mask()] for cell in container_type[i]]
+			lines.append("|".join(["".join(cells[j:j + 3]) for j in (0, 3, 6)]))
 			if (i + 1) % 3 == 0:
-				print("--------------------------------------------")
-		print()
+				lines.append("--------------------------------------------")
+		print("\n".join(lines) + "\n")
 
 
 class Cell:
-    
-	def __init__(self, possible):
-		self.__possible = possible
-		self.__row_num = 0
-		self.__col_num = 0
+
+	def __init__(self, possible, cands=None, index=0, changes=None):
+		if cands is None:			# stand-alone Cell; keep its mask in a grid of its own
+			cands = [ALL_DIGITS]
+		if changes is None:
+			changes = []
+		self.__cands = cands		# flat candidate-mask grid this Cell is a view of
+		self.__index = index		# this Cell's position in that grid
+		self.__changes = changes	# change log; this Cell's index is appended whenever it loses options
+		if possible is not None:
+			self.__cands[index] = digits_to_mask(possible)
+		self.__row_num = ROW_OF[index]
+		self.__col_num = COL_OF[index]
+		self.__box_num = BOX_OF[index]
+		self.__pos = index			# grid position (row * 9 + col) for the lookup tables; differs from index
+									# only for a stand-alone Cell moved with set_row/set_col
 
 	def __str__(self):
-		return str(self.__possible)
-#		return str("{}:({},{}) ".format(self.__possible, self.__row_num, self.__col_num))
+		return MASK_TEXT[self.__cands[self.__index]]
+#		return str("{}:({},{}) ".format(self.get_possible(), self.__row_num, self.__col_num))
+
+	def get_possible(self):		# returns a shared list; callers must not modify it
+		return MASK_DIGITS[self.__cands[self.__index]]
+
+	def get_mask(self):
+		return self.__cands[self.__index]
 
-	def get_possible(self):
-		return self.__possible
+	def get_index(self):
+		return self.__index
+
+	def name(self):				# e.g. "r1c5", for messages
+		return "r{}c{}".format(self.__row_num + 1, self.__col_num + 1)
 
 	def set_possible(self, new_possible):
 		if len(new_possible) == 0:
-			print("!!! Attempt to set options to nothing!!!")	
-			raise Exception ("Houston, we have a problem!")
+			raise Contradiction ("Houston, we have a problem! Attempt to set options of {} to nothing.".format(self.name()))
 		else:
-			self.__possible = new_possible
+			mask = digits_to_mask(new_possible)
+			if mask != self.__cands[self.__index]:
+				self.__cands[self.__index] = mask
+				self.__changes.append(self.__index)
 
 	def remove_possible(self, l):
-		if self.number_of_options() == 1 and self.__possible[0] in l:  #This if may be redundant with the elif below
-			print("!!! Attempt to remove last option!!!")
-			print("Possible numbers:", self.__possible, "numbers to remove:", l)
-			raise Exception ("Houston, we have a problem!")
-		elif set(self.__possible) <= set(l):
-			print("!!! Attempt to remove all options!!!")
-			print("Possible numbers:", self.__possible, "numbers to remove:", l)
-			raise Exception ("Houston, we have a problem!")
-		else:
-			self.__possible = [n for n in self.__possible if n not in l]
+		mask = self.__cands[self.__index]
+		remove_mask = digits_to_mask(l)
+		if MASK_COUNT[mask] == 1 and mask & remove_mask:  #This if may be redundant with the elif below
+			raise Contradiction ("Houston, we have a problem! Attempt to remove last option of {}: possible numbers {}, "
+				"numbers to remove {}".format(self.name(), MASK_DIGITS[mask], list(l)))
+		elif not mask & ~remove_mask:
+			raise Contradiction ("Houston, we have a problem! Attempt to remove all options of {}: possible numbers {}, "
+				"numbers to remove {}".format(self.name(), MASK_DIGITS[mask], list(l)))
+		elif mask & remove_mask:
+			self.__cands[self.__index] = mask & ~remove_mask
+			self.__changes.append(self.__index)
 
 	def is_possible(self, n):
-		return n in self.__possible
+		return bool(self.__cands[self.__index] & DIGIT_BIT[n])
 
 	def number_of_options(self):
-		return len(self.__possible)
+		return MASK_COUNT[self.__cands[self.__index]]
 
 	def set_row(self, row_num):
 		self.__row_num = row_num
+		self.__pos = self.__row_num * 9 + self.__col_num
+		self.__box_num = BOX_OF[self.__pos]
 
 	def set_col(self, col_num):
 		self.__col_num = col_num
+		self.__pos = self.__row_num * 9 + self.__col_num
+		self.__box_num = BOX_OF[self.__pos]
+
+	def get_pos(self):
+		return self.__pos
 
 	def get_row(self):
 		return self.__row_num
@@ -119,13 +311,17 @@ class Cell:
 		return self.__col_num
 
 	def get_box(self):
-		return self.__row_num//3 * 3 + self.__col_num//3
+		return self.__box_num
 
 	def get_box_cell_index(self):								# not currently used
 		return (self.__row_num % 3) * 3 + (self.__col_num % 3)
 
 	def sees(self, other_cell):
-		if self == other_cell:
-			return False
-		else:
-			return self.__row_num == other_cell.get_row() or self.__col_num == other_cell.get_col() or self.get_box() == other_cell.get_box()
+		return SEES[self.__pos][other_cell.get_pos()]
+
+
+if __name__ == "__main__":		# build the table file ahead of time, e.g. when installing
+	if os.path.exists(TABLE_FILE):
+		print("Tables saved in", TABLE_FILE)
+	else:
+		print("Could not save tables in", TABLE_FILE)
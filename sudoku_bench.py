@@ -0,0 +1,303 @@
+import argparse
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+from sudoku import Sudoku
+from sudoku_solver import ENGINES, RULE_NAMES, RULE_ORDER, RuleProfiler, get_engine, run_chunk_jobs, solve_chunk
+
+# Benchmark sudoku_solver on a puzzle corpus (by default sudoku.txt): solve every puzzle with output suppressed
+# and report wall time, passes, per-rule time and eliminations, and how many puzzles were solved or stuck.
+# Results can be saved as JSON, and two saved runs can be compared to flag regressions.
+
+
+### Corpus
+
+# Read every puzzle in a corpus file.  Each puzzle is a "Rules ..." line and 9 grid lines; the lines after the grid,
+# up to the next blank or "Rules" line, are its notes (difficulty, source, how it was solved before).
+def read_corpus(path):
+	lines = open(path, "r").read().split("\n")
+	puzzles = []
+	i = 0
+	while i < len(lines):
+		if lines[i].startswith("Rules"):
+			notes = []
+			j = i + 10
+			while j < len(lines) and lines[j].strip() and not lines[j].startswith("Rules"):
+				notes.append(lines[j].strip())
+				j += 1
+			puzzles.append({"number": len(puzzles) + 1, "line": i + 1, "rules": lines[i][len("Rules"):].strip(),
+				"grid": "\n".join(lines[i + 1:i + 10]) + "\n", "notes": notes})
+			i = j
+		else:
+			i += 1
+	return puzzles
+
+
+### Benchmark
+
+# Solve one corpus puzzle repeat times and return its record for the fastest run
+def bench_puzzle(puzzle, engine, repeat):
+	best = None
+	for r in range(repeat):
+		s = Sudoku(io.StringIO(puzzle["grid"]))
+		profile = RuleProfiler()
+		start = time.perf_counter()
+		solved, passes = get_engine(engine)(s, puzzle["rules"], verbose=False, profile=profile)
+		seconds = time.perf_counter() - start
+		if best is None or seconds < best["seconds"]:
+			best = {"number": puzzle["number"], "line": puzzle["line"], "rules": puzzle["rules"], "notes": puzzle["notes"],
+				"solved": solved, "passes": passes, "candidates": s.count_options(), "seconds": seconds, "rule_stats": profile.as_dict()["rules"]}
+	return best
+
+def run_benchmark(path, engine="passes", repeat=1):
+	puzzles = [bench_puzzle(puzzle, engine, repeat) for puzzle in read_corpus(path)]
+	rules = {}
+	for rule in RULE_ORDER:				# per-rule totals over the whole corpus
+		rules[rule] = {"seconds": 0.0, "eliminated": 0}
+		for puzzle in puzzles:
+			if rule in puzzle["rule_stats"]:
+				rules[rule]["seconds"] += puzzle["rule_stats"][rule]["seconds"]
+				rules[rule]["eliminated"] += puzzle["rule_stats"][rule]["eliminated"]
+	return {"corpus": path, "engine": engine, "repeat": repeat, "puzzles": puzzles, "rules": rules,
+		"total_seconds": sum([puzzle["seconds"] for puzzle in puzzles]),
+		"total_passes": sum([puzzle["passes"] for puzzle in puzzles]),
+		"solved": len([puzzle for puzzle in puzzles if puzzle["solved"]]),
+		"stuck": len([puzzle for puzzle in puzzles if not puzzle["solved"]])}
+
+def print_report(results):
+	print("Corpus {}: {} puzzles, engine {}".format(results["corpus"], len(results["puzzles"]), results["engine"]))
+	print("Solved {}, stuck {}, {} passes, {:.3f} s".format(results["solved"], results["stuck"], results["total_passes"],
+		results["total_seconds"]))
+	print()
+	print("Rule  Name              Seconds  Eliminated")
+	for rule in RULE_ORDER:
+		rule_totals = results["rules"][rule]
+		print("{:4}  {:16} {:8.3f}  {:10}".format(rule, RULE_NAMES[rule], rule_totals["seconds"], rule_totals["eliminated"]))
+	print()
+	slowest = sorted(results["puzzles"], key=lambda puzzle: puzzle["seconds"], reverse=True)[:5]
+	print("Slowest puzzles:")
+	for puzzle in slowest:
+		outcome = "solved" if puzzle["solved"] else "stuck"
+		print("  #{} (line {}, Rules {}): {} in {} passes, {:.3f} s".format(puzzle["number"], puzzle["line"], puzzle["rules"],
+			outcome, puzzle["passes"], puzzle["seconds"]))
+
+
+### Startup
+
+# Commands whose start-up time is measured, each run as a fresh process: the bare interpreter, importing the library,
+# and a one-off quiet solve from the command line
+def startup_commands(path):
+	solver = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sudoku_solver.py")
+	return [("python", [sys.executable, "-c", "pass"]),
+		("import", [sys.executable, "-c", "import sudoku_solver"]),
+		("cli_solve", [sys.executable, solver, path, "--quiet"])]
+
+# Run each startup command repeat times; returns {"startup": {name: fastest seconds}}, with "import" and "cli_solve"
+# less the bare interpreter's time, so they show what the program itself adds
+def run_startup_benchmark(path, repeat=20):
+	here = os.path.dirname(os.path.abspath(__file__))
+	timings = {}
+	for name, command in startup_commands(path):
+		best = None
+		for r in range(repeat):
+			start = time.perf_counter()
+			subprocess.run(command, cwd=here, stdout=subprocess.DEVNULL, check=True)
+			seconds = time.perf_counter() - start
+			best = seconds if best is None else min(best, seconds)
+		timings[name] = best
+	for name in ("import", "cli_solve"):
+		timings[name] -= timings["python"]
+	return {"corpus": path, "repeat": repeat, "startup": timings}
+
+def print_startup_report(results):
+	print("Startup, fastest of {} runs:".format(results["repeat"]))
+	print("  Python interpreter      {:7.1f} ms".format(results["startup"]["python"] * 1000))
+	print("  + import sudoku_solver  {:7.1f} ms".format(results["startup"]["import"] * 1000))
+	print("  + one-off CLI solve     {:7.1f} ms".format(results["startup"]["cli_solve"] * 1000))
+
+
+### Worker handoff
+#
+# Three ways of handing a batch of puzzles to worker processes and getting results back, timed on the same corpus:
+# pickling whole Sudoku objects (each with its 81 Cells and row, col, and box lists) both ways; pickling the grid text
+# out and a result record back (solve_batch_parallel); and shared memory (sudoku_shared.py), where only the block's
+# name and a range of puzzle numbers are pickled.
+
+def solve_objects_chunk(chunk, engine="passes"):	# worker side: solve (number, rules_to_use, Sudoku), send Sudokus back
+	solved_chunk = []
+	for number, rules_to_use, s in chunk:
+		start = time.perf_counter()
+		solved, passes = get_engine(engine)(s, rules_to_use, verbose=False)
+		solved_chunk.append((number, rules_to_use, s, solved, passes, time.perf_counter() - start))
+	return [solved_chunk], None
+
+def transfer_objects(puzzles, workers, chunk_size, engine):
+	chunks = [[(p["number"], p["rules"], Sudoku(io.StringIO(p["grid"]))) for p in puzzles[i:i + chunk_size]]
+		for i in range(0, len(puzzles), chunk_size)]
+	for solved_chunk in run_chunk_jobs(((solve_objects_chunk, chunk, engine) for chunk in chunks), workers):
+		for number, rules_to_use, s, solved, passes, seconds in solved_chunk:
+			yield {"puzzle": number, "rules": rules_to_use, "solved": solved, "passes": passes,
+				"candidates": s.count_options(), "seconds": seconds}
+
+def transfer_texts(puzzles, workers, chunk_size, engine):
+	chunks = [[(p["number"], p["rules"], p["grid"]) for p in puzzles[i:i + chunk_size]] for i in range(0, len(puzzles), chunk_size)]
+	return run_chunk_jobs(((solve_chunk, chunk, engine) for chunk in chunks), workers)
+
+def transfer_shared(puzzles, workers, chunk_size, engine):
+	from sudoku_shared import solve_batch_shared
+	return solve_batch_shared(io.StringIO("".join(["Rules {}\n{}".format(p["rules"], p["grid"]) for p in puzzles])),
+		workers, chunk_size, True, engine)
+
+TRANSFERS = [("objects", transfer_objects), ("texts", transfer_texts), ("shared", transfer_shared)]
+TRANSFER_COPIES = 10				# times over the corpus is solved, by default
+
+def pickled_sizes(puzzles, chunk_size, engine):	# bytes pickled per puzzle, out and back, for each way
+	chunk = puzzles[:chunk_size]
+	objects = [(p["number"], p["rules"], Sudoku(io.StringIO(p["grid"]))) for p in chunk]
+	texts = [(p["number"], p["rules"], p["grid"]) for p in chunk]
+	size = lambda value: len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) / len(chunk)
+	return {"objects": (size(objects), size(solve_objects_chunk(objects, engine))),
+		"texts": (size(texts), size(solve_chunk(texts, engine))),
+		"shared": (size(("name", 4096, 0, len(chunk), engine, False)), size((range(0, len(chunk)), None)))}
+
+# Solve the corpus copies times over with each handoff, repeat times, keeping the fastest.  Checks that every way
+# gets the same results.
+def run_transfer_benchmark(path, workers=None, chunk_size=50, engine="passes", repeat=1, copies=TRANSFER_COPIES):
+	puzzles = read_corpus(path) * copies
+	timings = {}
+	outcomes = {}
+	for name, transfer in TRANSFERS:
+		best = None
+		for r in range(repeat):
+			start = time.perf_counter()
+			records = list(transfer(puzzles, workers, chunk_size, engine))
+			seconds = time.perf_counter() - start
+			best = seconds if best is None else min(best, seconds)
+		timings[name] = best
+		outcomes[name] = [(record["solved"], record["passes"], record["candidates"]) for record in records]
+	if outcomes["objects"] != outcomes["texts"] or outcomes["texts"] != outcomes["shared"]:
+		raise Exception ("Worker handoffs got different results.")
+	return {"corpus": path, "engine": engine, "repeat": repeat, "puzzles": len(puzzles), "workers": workers or os.cpu_count(),
+		"chunk_size": chunk_size, "transfer": timings, "pickled": pickled_sizes(puzzles, chunk_size, engine)}
+
+def print_transfer_report(results):
+	print("Worker handoff: {} puzzles, {} workers, {} puzzles a chunk, engine {}, fastest of {} runs".format(
+		results["puzzles"], results["workers"], results["chunk_size"], results["engine"], results["repeat"]))
+	print("Handoff    Seconds  Puzzles/s  Pickled out/back per puzzle")
+	for name, transfer in TRANSFERS:
+		seconds = results["transfer"][name]
+		out, back = results["pickled"][name]
+		print("{:8} {:9.3f} {:10.0f}  {:8.0f} B / {:.0f} B".format(name, seconds, results["puzzles"] / seconds, out, back))
+
+
+### Compare
+
+def check_time(regressions, what, old_seconds, new_seconds, threshold, min_seconds):
+	if new_seconds - old_seconds > max(old_seconds * threshold, min_seconds):
+		regressions.append("{} slower: {:.3f} s -> {:.3f} s ({:+.0%})".format(what, old_seconds, new_seconds,
+			new_seconds / old_seconds - 1 if old_seconds else 1))
+
+def rule_label(rule):				# e.g. "Rule 5 (locked single)"; a saved run may have rules this version doesn't
+	return "Rule {} ({})".format(rule, RULE_NAMES[rule]) if rule in RULE_NAMES else "Rule {}".format(rule)
+
+# The rules only one of two saved benchmark runs has -- e.g. a baseline saved before rules were added -- which
+# compare_results() leaves out.  Returns a list of messages.
+def rule_changes(old, new):
+	if "rules" not in old or "rules" not in new:
+		return []
+	return (["{} added".format(rule_label(rule)) for rule in new["rules"] if rule not in old["rules"]] +
+		["{} removed".format(rule_label(rule)) for rule in old["rules"] if rule not in new["rules"]])
+
+# Compare two saved benchmark runs.  Returns a list of regression messages: slower total or per-rule time (by more
+# than threshold, a fraction, and min_seconds), and any puzzle that is now stuck, needs more passes, or has more
+# candidates left.  Only the rules both runs have are compared.
+def compare_results(old, new, threshold=0.10, min_seconds=0.005):
+	regressions = []
+	if "transfer" in old and "transfer" in new:	# saved --transfer runs
+		for name in old["transfer"]:
+			check_time(regressions, "Handoff ({})".format(name), old["transfer"][name], new["transfer"][name], threshold,
+				min_seconds)
+		return regressions
+	if "startup" in old and "startup" in new:	# saved --startup runs
+		for name in ("import", "cli_solve"):
+			check_time(regressions, "Startup ({})".format(name), old["startup"][name], new["startup"][name], threshold,
+				min_seconds)
+		return regressions
+	check_time(regressions, "Total time", old["total_seconds"], new["total_seconds"], threshold, min_seconds)
+	for rule in [rule for rule in new["rules"] if rule in old["rules"]]:	# see rule_changes() for the others
+		check_time(regressions, rule_label(rule), old["rules"][rule]["seconds"], new["rules"][rule]["seconds"], threshold,
+			min_seconds)
+	if len(old["puzzles"]) != len(new["puzzles"]):
+		regressions.append("Corpus changed: {} puzzles -> {}".format(len(old["puzzles"]), len(new["puzzles"])))
+	for old_puzzle, new_puzzle in zip(old["puzzles"], new["puzzles"]):
+		where = "Puzzle #{} (line {})".format(new_puzzle["number"], new_puzzle["line"])
+		if old_puzzle["solved"] and not new_puzzle["solved"]:
+			regressions.append("{} no longer solved (stuck on pass {})".format(where, new_puzzle["passes"]))
+		elif old_puzzle["solved"] == new_puzzle["solved"] and new_puzzle["passes"] > old_puzzle["passes"]:
+			regressions.append("{} needs more passes: {} -> {}".format(where, old_puzzle["passes"], new_puzzle["passes"]))
+		if new_puzzle["candidates"] > old_puzzle["candidates"]:
+			regressions.append("{} has more candidates left: {} -> {}".format(where, old_puzzle["candidates"],
+				new_puzzle["candidates"]))
+	return regressions
+
+
+### Main driver
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark sudoku_solver on a puzzle corpus.")
+	parser.add_argument("corpus", nargs="?", default="sudoku.txt", help="puzzle file (default sudoku.txt)")
+	parser.add_argument("--engine", choices=sorted(ENGINES), default="passes", help="solving driver to benchmark")
+	parser.add_argument("--repeat", type=int, default=1, metavar="N", help="solve each puzzle N times, keep the fastest")
+	parser.add_argument("--json", metavar="FILE", help="also save the results as JSON in FILE ('-' for stdout only)")
+	parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved JSON runs and flag regressions")
+	parser.add_argument("--threshold", type=float, default=0.10, help="compare: slowdown fraction to flag (default 0.10)")
+	parser.add_argument("--startup", type=int, nargs="?", const=20, metavar="N", help="instead, time interpreter start, "
+		"import, and a one-off CLI solve of the corpus's first puzzle, fastest of N runs (default 20)")
+	parser.add_argument("--transfer", type=int, nargs="?", const=0, metavar="WORKERS", help="instead, time handing the "
+		"corpus to WORKERS worker processes (default one per CPU) as pickled Sudokus, pickled text, and shared memory")
+	parser.add_argument("--copies", type=int, default=TRANSFER_COPIES, metavar="N",
+		help="transfer: solve the corpus N times over (default {})".format(TRANSFER_COPIES))
+	parser.add_argument("--chunk-size", type=int, default=50, metavar="N", help="transfer: puzzles sent to a worker at a time")
+	args = parser.parse_args()
+
+	if args.compare:
+		old = json.load(open(args.compare[0], "r"))
+		new = json.load(open(args.compare[1], "r"))
+		regressions = compare_results(old, new, args.threshold)
+		for message in rule_changes(old, new):
+			print("NOT COMPARED:", message)
+		for message in regressions:
+			print("REGRESSION:", message)
+		if "startup" in new or "transfer" in new:
+			print("{} regressions.".format(len(regressions)))
+		else:
+			print("{} regressions ({:.3f} s -> {:.3f} s total).".format(len(regressions), old["total_seconds"], new["total_seconds"]))
+		sys.exit(1 if regressions else 0)
+
+	if args.transfer is not None:
+		results = run_transfer_benchmark(args.corpus, args.transfer or None, args.chunk_size, args.engine, args.repeat,
+			args.copies)
+	elif args.startup:
+		results = run_startup_benchmark(args.corpus, args.startup)
+	else:
+		results = run_benchmark(args.corpus, args.engine, args.repeat)
+	if args.json == "-":
+		json.dump(results, sys.stdout, indent=1)
+		print()
+		return
+	if args.transfer is not None:
+		print_transfer_report(results)
+	elif args.startup:
+		print_startup_report(results)
+	else:
+		print_report(results)
+	if args.json:
+		with open(args.json, "w") as ofile:
+			json.dump(results, ofile, indent=1)
+
+if __name__ == "__main__":
+	main()
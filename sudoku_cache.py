@@ -0,0 +1,273 @@
+import copy
+import dbm
+import io
+import json
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import permutations, product
+from operator import itemgetter
+from sudoku import DIGIT_BIT, MASK_DIGITS, Sudoku, grid_to_lines, sudoku_from_masks
+from sudoku_solver import RULE_ORDER, SolveResult, get_engine
+
+# Result cache: remembers what the solver made of each sudoku, so a sudoku seen before -- as given, or rotated,
+# transposed, shuffled, or with its digits relabeled -- is not solved again.  Results are keyed by the sudoku's
+# canonical form (below) and the rules and engine used, and kept in canonical orientation, in a bounded in-memory
+# LRU and optionally in a dbm file on disk.  A second LRU, keyed by the grid exactly as given, answers exact
+# repeats without working out the canonical form at all.
+
+### Canonical form
+#
+# Two sudokus are equivalent when one can be turned into the other by transposing the grid, reordering the bands
+# (and stacks), reordering the rows within a band (and columns within a stack), and relabeling the digits.  The
+# canonical form of a sudoku is the smallest of all its equivalent grids, read row by row with 0 for an empty cell
+# and the digits relabeled 1, 2, 3, ... in order of first appearance.  It is found row by row: every way of
+# choosing the first row and ordering the columns that gives the smallest first row is kept, and each later row
+# only keeps the choices that tie for the smallest row so far.
+#
+# A sparse or very symmetric grid (the empty grid, one given, a single full row) ties in hundreds of thousands of
+# ways row after row, and finding its canonical form would take seconds.  Once more than MAX_TIED_STATES choices
+# tie at any row the search gives up, and such a sudoku is cached only as given.  The sudokus in sudoku.txt tie in at
+# most about 5000.
+
+MAX_TIED_STATES = 10000
+
+def transpose(givens):
+	return [givens[c * 9 + r] for r in range(9) for c in range(9)]
+
+def first_row_form(row):		# the smallest form row (9 values) can take, whatever its column order
+	form = []
+	labels = 0
+	for k in sorted([len([n for n in row[s * 3:s * 3 + 3] if n]) for s in range(3)]):
+		form += [0] * (3 - k) + list(range(labels + 1, labels + k + 1))
+		labels += k
+	return tuple(form)
+
+def first_row_choices(row):		# every column order that gives row its smallest form
+	counts = [len([n for n in row[s * 3:s * 3 + 3] if n]) for s in range(3)]
+	stack_orders = [order for order in permutations(range(3)) if [counts[s] for s in order] == sorted(counts)]
+	within = []						# each stack's column orders: empty cells first, then givens, each in any order
+	for s in range(3):
+		empty = [c for c in range(s * 3, s * 3 + 3) if not row[c]]
+		given = [c for c in range(s * 3, s * 3 + 3) if row[c]]
+		within.append([e + g for e in permutations(empty) for g in permutations(given)])
+	choices = []
+	for order in stack_orders:
+		for parts in product(*[within[s] for s in order]):
+			choices.append(parts[0] + parts[1] + parts[2])
+	return choices
+
+@lru_cache(maxsize=None)
+def next_rows(rows):			# source rows that can come next, given the ones already placed
+	if len(rows) % 3:
+		band = rows[-1] // 3
+		return [r for r in range(band * 3, band * 3 + 3) if r not in rows]
+	used = [r // 3 for r in rows]
+	return [r for r in range(9) if r // 3 not in used]
+
+def relabel_row(values, labels, next_label):	# the row with labels; labels is updated in place for new digits
+	out = []
+	for n in values:
+		if n and not labels[n]:
+			labels[n] = next_label
+			next_label += 1
+		out.append(labels[n])
+	return tuple(out), next_label
+
+GIVEN_PATTERN = bytes([0] + [1] * 255)	# bytes.translate table: 0 for an empty cell, 1 for a given
+
+# Returns (canonical, transform): canonical is the canonical form as a list of 81 numbers (0 for empty cells), and
+# transform is (transposed, rows, cols, labels) such that canonical cell (i, j) is source cell (rows[i], cols[j]) of
+# the grid (transposed first if transposed is set) with digit n relabeled labels[n].  Returns None if more than
+# MAX_TIED_STATES choices tie at some row.
+def canonical_form(givens):
+	grids = [list(givens), transpose(givens)]
+	grid_rows = [[grid[r * 9:r * 9 + 9] for r in range(9)] for grid in grids]
+	best_form = None
+	states = []					# (transposed, rows, cols, labels, next_label) of every choice tying for smallest
+	for t in range(2):
+		for r in range(9):
+			form = first_row_form(grid_rows[t][r])
+			if best_form is None or form < best_form:
+				best_form, states = form, []
+			if form == best_form:		# labels are worked out only for the choices still tied after the next row
+				states += [(t, (r,), cols, None, 1) for cols in first_row_choices(grid_rows[t][r])]
+	canonical = list(best_form)
+	if len(states) > MAX_TIED_STATES:
+		return None
+	for i in range(1, 9):
+		# Empty cells come before any digit, so first keep only the choices with the smallest pattern of empty
+		# cells and givens, and relabel only those
+		best_pattern = None
+		candidates = []
+		for state in states:
+			t, rows, cols, labels, next_label = state
+			get_cols = itemgetter(*cols)
+			for r in next_rows(rows):
+				values = get_cols(grid_rows[t][r])
+				pattern = bytes(values).translate(GIVEN_PATTERN)
+				if best_pattern is None or pattern < best_pattern:
+					best_pattern, candidates = pattern, []
+				if pattern == best_pattern:
+					candidates.append((state, r, values))
+					if len(candidates) > MAX_TIED_STATES:
+						return None
+		best_row = None
+		next_states = []
+		for (t, rows, cols, labels, next_label), r, values in candidates:
+			if labels is None:
+				labels = [0] * 10
+				first_row, next_label = relabel_row(itemgetter(*cols)(grid_rows[t][rows[0]]), labels, 1)
+			new_labels = labels[:]
+			row, new_next = relabel_row(values, new_labels, next_label)
+			if best_row is None or row < best_row:
+				best_row, next_states = row, []
+			if row == best_row:
+				next_states.append((t, rows + (r,), cols, new_labels, new_next))
+				if len(next_states) > MAX_TIED_STATES:
+					return None
+		canonical += best_row
+		states = next_states
+	t, rows, cols, labels, next_label = states[0]
+	for n in range(1, 10):			# digits not given take the remaining labels in order
+		if not labels[n]:
+			labels[n] = next_label
+			next_label += 1
+	return canonical, (t, rows, cols, labels)
+
+IDENTITY = (0, tuple(range(9)), tuple(range(9)), list(range(10)))	# the transform that leaves a grid as it is
+
+def source_index(transform, i):		# grid index of the cell that canonical cell i comes from
+	t, rows, cols, labels = transform
+	r, c = rows[i // 9], cols[i % 9]
+	return c * 9 + r if t else r * 9 + c
+
+def relabel_mask(mask, labels):
+	relabeled = 0
+	for n in MASK_DIGITS[mask]:
+		relabeled |= DIGIT_BIT[labels[n]]
+	return relabeled
+
+def to_canonical(masks, transform):		# candidate masks of a grid, in the canonical orientation and labels
+	labels = transform[3]
+	return [relabel_mask(masks[source_index(transform, i)], labels) for i in range(81)]
+
+def from_canonical(canonical_masks, transform):	# inverse of to_canonical
+	inverse = [0] * 10
+	for n in range(1, 10):
+		inverse[transform[3][n]] = n
+	masks = [0] * 81
+	for i in range(81):
+		masks[source_index(transform, i)] = relabel_mask(canonical_masks[i], inverse)
+	return masks
+
+
+### Cache
+
+def lines_to_key(lines):			# 81-character line of givens, '-' for empty cells
+	return "".join([c if c not in "_ " else "-" for line in lines for c in line[:9].ljust(9)])
+
+def normal_rules(rules_to_use):		# the rules in RULE_ORDER, so "0 1 2" and "210" share cache entries
+	return "".join([rule for rule in RULE_ORDER if rule in rules_to_use])
+
+def copy_result(result, seconds):	# a copy of a remembered SolveResult, for the caller to keep or change
+	result = copy.copy(result)
+	result.masks = list(result.masks)
+	result.seconds = seconds
+	return result
+
+class SolveCache:
+
+	def __init__(self, size=10000, path=None, canonical=True):
+		self.size = size				# most results kept in memory (each LRU)
+		self.canonical = canonical		# False: only exact repeats are recognized, no canonical forms worked out
+		self.exact = OrderedDict()		# (grid line, rules, engine) -> SolveResult as given
+		self.entries = OrderedDict()	# (canonical line, rules, engine) -> (solved, passes, masks) canonical
+		self.store = dbm.open(path, "c") if path else None		# same as entries, on disk, as JSON
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.entries) if self.canonical else len(self.exact)
+
+	def remember(self, lru, key, value):
+		lru[key] = value
+		lru.move_to_end(key)
+		if len(lru) > self.size:
+			lru.popitem(last=False)
+
+	def lookup(self, key):			# canonical entry from memory or disk, or None
+		if key in self.entries:
+			self.entries.move_to_end(key)
+			return self.entries[key]
+		if self.store is not None:
+			stored = self.store.get("|".join(key))
+			if stored is not None:
+				entry = json.loads(stored)
+				value = (entry["solved"], entry["passes"], entry["masks"])
+				self.remember(self.entries, key, value)
+				return value
+		return None
+
+	# Solve grid (any form sudoku_from_grid accepts) with rules and engine, or answer from the cache.  Returns a
+	# SolveResult, in the caller's orientation; its passes are those of the solve that was cached.  Engine must be
+	# an ENGINES name; other engines are solved every time.
+	def solve(self, grid, rules="0123456789AB", engine="passes"):
+		start = time.perf_counter()
+		lines = grid_to_lines(grid)
+		if not isinstance(engine, str):
+			self.misses += 1
+			return self.solve_grid(lines, rules, engine, start)
+		rules = normal_rules(rules)
+		exact_key = (lines_to_key(lines), rules, engine)
+		if exact_key in self.exact:
+			self.hits += 1
+			self.exact.move_to_end(exact_key)
+			return copy_result(self.exact[exact_key], time.perf_counter() - start)
+		if self.canonical:
+			found = canonical_form([int(c) if c in "123456789" else 0 for c in exact_key[0]])
+			if found is None:		# too many ties to find the canonical form: key the grid as given instead
+				form, transform = exact_key[0], IDENTITY
+			else:
+				form, transform = found
+			key = ("".join([str(n) for n in form]), rules, engine)
+			entry = self.lookup(key)
+			if entry is not None:
+				self.hits += 1
+				solved, passes, canonical_masks = entry
+				result = SolveResult(sudoku_from_masks(from_canonical(canonical_masks, transform)), solved, passes,
+					time.perf_counter() - start)
+				self.remember(self.exact, exact_key, result)
+				return copy_result(result, result.seconds)
+		self.misses += 1
+		result = self.solve_grid(lines, rules, engine, start)
+		self.remember(self.exact, exact_key, result)
+		if self.canonical:
+			canonical_masks = to_canonical(result.masks, transform)
+			self.remember(self.entries, key, (result.solved, result.passes, canonical_masks))
+			if self.store is not None:
+				self.store["|".join(key)] = json.dumps({"solved": result.solved, "passes": result.passes,
+					"masks": canonical_masks})
+		return copy_result(result, result.seconds)
+
+	def solve_grid(self, lines, rules, engine, start):
+		s = Sudoku(io.StringIO("\n".join(lines)))
+		solved, passes = get_engine(engine)(s, rules, verbose=False)
+		return SolveResult(s, solved, passes, time.perf_counter() - start)
+
+	def close(self):
+		if self.store is not None:
+			self.store.close()
+			self.store = None
+
+
+### Batch solving
+
+# Solve (rules_to_use, grid_text) puzzles, e.g. from read_puzzle_texts, through cache, yielding one result record per
+# puzzle (see solve_record), with "cached" set for those answered from the cache
+def solve_batch_cached(puzzles, cache, engine="passes"):
+	for number, (rules_to_use, grid_text) in enumerate(puzzles, 1):
+		hits = cache.hits
+		result = cache.solve(grid_text, rules_to_use, engine)
+		yield {"puzzle": number, "rules": rules_to_use, "solved": result.solved, "passes": result.passes,
+			"candidates": result.candidates, "seconds": result.seconds, "cached": cache.hits > hits}
@@ -0,0 +1,328 @@
+import argparse
+import ast
+import contextlib
+import importlib
+import io
+import os
+import random
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import types
+import sudoku_solver
+from sudoku import ALL_DIGITS, DIGIT_BIT, MASK_COUNT, MASK_DIGITS, PEERS, digits_to_mask, sudoku_from_grid
+from sudoku_solver import RULE_NAMES, read_puzzle_texts
+
+# Differential check of the rules: a reference version of sudoku.py and sudoku_solver.py (a git revision, by default
+# HEAD, or a directory) and a candidate version (by default the working tree) solve the same puzzles side by side,
+# one rule at a time.  After every rule application both grids must have exactly the same candidates, neither may
+# raise an error, and no candidate may have been eliminated that the puzzle's solution needs -- the solution is
+# found by a plain backtracking search, so this last check doesn't trust either version of the rules.  The time
+# each version spends in each rule is added up, so the same run shows how much faster (or slower) the candidate is.
+#
+# Puzzles come from sudoku.txt (or another file), and/or are made up at random: a random solution with some of its
+# digits given.  A puzzle that fails can be shrunk to a minimal one that fails in the same way: no given and no rule
+# can be left out without the failure going away.
+#
+# Either version can be any version of the rules, back to the first.  Versions from before apply_rule() (the
+# benchmark harness) are run through their logic_rule_N functions, called the way their main() called them.  Rules a
+# version doesn't have are left out.
+
+ENGINE_MODULES = ("sudoku", "sudoku_solver")		# the modules that make up a version of the rules
+DEFAULT_RULES = "0123456789ABCD"
+
+
+### Versions of the rules
+
+class Engine:						# one version of the rules, and the time spent in each of them
+
+	def __init__(self, name, solver):
+		self.name = name
+		self.solver = solver		# that version's sudoku_solver module
+		self.seconds = {}			# rule -> seconds spent applying it
+		self.container_rules = getattr(solver, "CONTAINER_RULES", "012345")	# rules applied to each container, every pass
+
+	def has_rule(self, rule):
+		return rule in self.solver.RULE_ORDER
+
+	def load(self, line):			# that version's Sudoku of an 81-character line
+		return self.solver.sudoku_from_grid(line)
+
+	def cands(self, s):				# the 81 candidate masks of that version's Sudoku
+		return s.get_cands()
+
+	def apply(self, s, rule):
+		start = time.perf_counter()
+		self.solver.apply_rule(s, rule)
+		self.seconds[rule] = self.seconds.get(rule, 0.0) + time.perf_counter() - start
+
+# A version from before apply_rule().  Its rules are called one by one, in the same order as its main() (or
+# apply_rules()) called them.  The oldest versions keep each cell's options as a list, have no sudoku_from_grid(),
+# and print what their rules find (check_puzzle() hides that); the rule functions themselves take the same
+# arguments in every version.
+LEGACY_RULES = "0123456789AB"
+
+class LegacyEngine(Engine):
+
+	def has_rule(self, rule):
+		return rule in LEGACY_RULES
+
+	def load(self, line):
+		return self.solver.Sudoku(io.StringIO("\n".join([line[r * 9:r * 9 + 9] for r in range(9)]) + "\n"))
+
+	def cands(self, s):
+		return [digits_to_mask(cell.get_possible()) for row in s.rows for cell in row]
+
+	def apply(self, s, rule):
+		start = time.perf_counter()
+		for name, args in legacy_rule_calls(s, rule):
+			getattr(self.solver, name)(s, *args)
+		self.seconds[rule] = self.seconds.get(rule, 0.0) + time.perf_counter() - start
+
+def legacy_rule_calls(s, rule):		# (function name, arguments after s) of each call older versions make for rule
+	if rule in "01234":
+		return [("logic_rule_" + rule, (container,)) for container in s.rows + s.cols + s.boxes]
+	if rule == "5":
+		return ([("logic_rule_5rc", (row, s.boxes)) for row in s.rows] + [("logic_rule_5rc", (col, s.boxes)) for col in s.cols]
+			+ [("logic_rule_5b", (box, s.rows, s.cols)) for box in s.boxes])
+	if rule in "67":
+		return [("logic_rule_" + rule, (s.rows, s.cols, 'r')), ("logic_rule_" + rule, (s.cols, s.rows, 'c'))]
+	if rule == "9":
+		return [("logic_rule_9", (s.cols, s.rows, 'c')), ("logic_rule_9", (s.rows, s.cols, 'r'))]
+	return [("logic_rule_" + rule, ())]
+
+# Import sudoku_solver (and the sudoku it imports) from directory as a separate copy, leaving the modules already
+# imported alone.  Each copy's functions keep using their own module's names, so both versions can run side by side.
+def load_engine(name, directory):
+	path = os.path.join(directory, "sudoku_solver.py")
+	with open(path, "r") as ifile:
+		source = ifile.read()
+	saved = dict([(module, sys.modules.pop(module)) for module in ENGINE_MODULES if module in sys.modules])
+	sys.path.insert(0, directory)
+	try:
+		if "\ndef apply_rule(" in source:
+			return Engine(name, importlib.import_module("sudoku_solver"))
+		return LegacyEngine(name, import_without_main(path, source))
+	finally:
+		sys.path.remove(directory)
+		for module in ENGINE_MODULES:
+			sys.modules.pop(module, None)
+		sys.modules.update(saved)
+
+# The oldest versions end with a bare main() call, which solves sudoku.txt on import: run the module's code without it
+def import_without_main(path, source):
+	tree = ast.parse(source, path)
+	tree.body = [node for node in tree.body if not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+		and isinstance(node.value.func, ast.Name) and node.value.func.id == "main")]
+	solver = types.ModuleType("sudoku_solver")
+	solver.__file__ = path
+	exec(compile(tree, path, "exec"), solver.__dict__)
+	return solver
+
+# The Engine for source: None for the modules already imported, a directory, or a git revision (extracted to a
+# temporary directory, removed when the program ends)
+def get_engine(source):
+	if source is None:
+		return Engine("working tree", sudoku_solver)
+	if os.path.isdir(source):
+		return load_engine(source, source)
+	here = os.path.dirname(os.path.abspath(__file__))
+	try:
+		archive = subprocess.run(["git", "archive", "--format=tar", source] + [module + ".py" for module in ENGINE_MODULES],
+			cwd=here, capture_output=True, check=True).stdout
+	except (OSError, subprocess.CalledProcessError) as error:
+		raise Exception ("Can't get revision {} from git: {}".format(source, getattr(error, "stderr", b"").decode().strip() or error))
+	directory = tempfile.TemporaryDirectory(prefix="sudoku_check_")
+	with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+		tar.extractall(directory.name)
+	engine = load_engine(source, directory.name)
+	engine.directory = directory		# keep the files until the engine is gone
+	return engine
+
+
+### Solutions and random puzzles
+
+# Set digit n in cell i of a list of 81 masks and take it out of every peer, following any cell that is left with
+# one digit.  Returns False if some cell is left with none.
+def assign(cands, i, n):
+	todo = [(i, DIGIT_BIT[n])]
+	while todo:
+		i, bit = todo.pop()
+		if not cands[i] & bit:
+			return False
+		cands[i] = bit
+		for j in PEERS[i]:
+			if cands[j] & bit:
+				cands[j] &= ~bit
+				if not cands[j]:
+					return False
+				if MASK_COUNT[cands[j]] == 1:
+					todo.append((j, cands[j]))
+	return True
+
+# A solution of a list of 81 masks, found by backtracking on the cell with fewest digits left (trying its digits in
+# random order if rng is a random.Random), or None if there is none.
+def search_solution(cands, rng=None):
+	best = None
+	for i in range(81):
+		if MASK_COUNT[cands[i]] > 1 and (best is None or MASK_COUNT[cands[i]] < MASK_COUNT[cands[best]]):
+			best = i
+	if best is None:
+		return cands
+	digits = list(MASK_DIGITS[cands[best]])
+	if rng is not None:
+		rng.shuffle(digits)
+	for n in digits:
+		trial = list(cands)
+		if assign(trial, best, n):
+			solution = search_solution(trial, rng)
+			if solution is not None:
+				return solution
+	return None
+
+def solution_of(line, rng=None):	# a solution of an 81-character puzzle line, as 81 masks, or None
+	cands = [ALL_DIGITS] * 81
+	for i, c in enumerate(line):
+		if c in "123456789" and not assign(cands, i, int(c)):
+			return None
+	return search_solution(cands, rng)
+
+def random_puzzle(rng, givens):		# (81-character line, solution): a random solution with givens of its digits shown
+	solution = solution_of("-" * 81, rng)
+	shown = set(rng.sample(range(81), givens))
+	return "".join([str(MASK_DIGITS[mask][0]) if i in shown else "-" for i, mask in enumerate(solution)]), solution
+
+
+### Differential check
+
+def failure(kind, rule, passes, message, cells=()):
+	return {"kind": kind, "rule": rule, "pass": passes, "message": message, "cells": list(cells)}
+
+# Solve the puzzle line with both engines, pass by pass as solve_sudoku does, comparing the grids after every rule.
+# Returns None if they agree all the way, or the first failure: a dict with "kind" ("error", "mismatch", or
+# "unsound"), the "rule" and "pass" it happened on, a "message", and the "cells" involved.
+def check_puzzle(reference, candidate, line, rules_to_use, solution=None, max_passes=100):
+	if solution is None:
+		solution = solution_of(line)
+	with contextlib.redirect_stdout(io.StringIO()):		# what older versions print before an error
+		s_ref, s_cand = reference.load(line), candidate.load(line)
+		for passes in range(1, max_passes + 1):
+			before = candidate.cands(s_cand)[:]
+			for rule in rules_to_use:
+				if rule not in candidate.container_rules and passes == 1:	# advanced rules not sought on first pass
+					continue
+				for engine, s in (reference, s_ref), (candidate, s_cand):
+					try:
+						engine.apply(s, rule)
+					except Exception as error:
+						return failure("error", rule, passes, "{} raised: {}".format(engine.name, error))
+				cands_ref, cands_cand = reference.cands(s_ref), candidate.cands(s_cand)
+				if cands_ref != cands_cand:
+					cells = [i for i in range(81) if cands_ref[i] != cands_cand[i]]
+					i = cells[0]
+					return failure("mismatch", rule, passes, "cell r{}c{}: {} has {}, {} has {}".format(i // 9 + 1, i % 9 + 1,
+						reference.name, MASK_DIGITS[cands_ref[i]], candidate.name, MASK_DIGITS[cands_cand[i]]), cells)
+				if solution is not None:
+					cells = [i for i in range(81) if not cands_cand[i] & solution[i]]
+					if cells:
+						i = cells[0]
+						return failure("unsound", rule, passes, "cell r{}c{}: {} eliminated, but the solution has it".format(
+							i // 9 + 1, i % 9 + 1, MASK_DIGITS[solution[i]][0]), cells)
+			if candidate.cands(s_cand) == before or s_cand.is_solved():
+				break
+	return None
+
+def same_failure(found, wanted):	# does found fail the same way as wanted (for shrinking)?
+	return found is not None and found["kind"] == wanted["kind"] and found["rule"] == wanted["rule"]
+
+# Shrink a failing puzzle: leave out givens, then rules, one at a time, keeping each change that still fails the
+# same way, until none can be left out.  Returns (line, rules_to_use, failure).  A solution of the puzzle is still a
+# solution with fewer givens, so it is found once, not searched for again on every sparser puzzle.
+def shrink(reference, candidate, line, rules_to_use, found, solution=None):
+	if solution is None:
+		solution = solution_of(line)
+	shrinking = True
+	while shrinking:
+		shrinking = False
+		for i in [i for i in range(81) if line[i] != "-"]:
+			trial = line[:i] + "-" + line[i + 1:]
+			result = check_puzzle(reference, candidate, trial, rules_to_use, solution)
+			if same_failure(result, found):
+				line, found, shrinking = trial, result, True
+		for rule in rules_to_use:
+			if rule != found["rule"]:
+				trial = rules_to_use.replace(rule, "")
+				result = check_puzzle(reference, candidate, line, trial, solution)
+				if same_failure(result, found):
+					rules_to_use, found, shrinking = trial, result, True
+	return line, rules_to_use, found
+
+def print_failure(title, line, rules_to_use, found):
+	print("{}: {} with rule {} ({}) on pass {}".format(title, found["kind"].upper(), found["rule"],
+		RULE_NAMES.get(found["rule"], "?"), found["pass"]))
+	print("  {}".format(found["message"]))
+	print("  puzzle {}  rules {}".format(line, rules_to_use))
+
+
+### Main driver
+
+def puzzle_lines(args, rng):		# (title, 81-character line, rules, solution or None) of every puzzle to check
+	if args.input:
+		ifile = sys.stdin if args.input == "-" else open(args.input, "r")
+		for number, (rules_line, grid_text) in enumerate(read_puzzle_texts(ifile), 1):
+			line = sudoku_from_grid(grid_text).to_line()
+			yield "Puzzle {}".format(number), line, args.rules or rules_line, solution_of(line)
+	for number in range(1, args.random + 1):
+		line, solution = random_puzzle(rng, args.givens)
+		yield "Random {}".format(number), line, args.rules or DEFAULT_RULES, solution
+
+def print_speed(reference, candidate):
+	print("{:22} {:>10} {:>10} {:>7}".format("Rule", "ref (s)", "cand (s)", "speed"))
+	for rule in sorted(candidate.seconds, key=sudoku_solver.RULE_ORDER.index):
+		ref, cand = reference.seconds.get(rule, 0.0), candidate.seconds[rule]
+		print("{:22} {:10.4f} {:10.4f} {:6.2f}x".format("R{} {}".format(rule, RULE_NAMES[rule]), ref, cand, ref / cand if cand else 0.0))
+	ref, cand = sum(reference.seconds.values()), sum(candidate.seconds.values())
+	print("{:22} {:10.4f} {:10.4f} {:6.2f}x".format("Total", ref, cand, ref / cand if cand else 0.0))
+
+def main():
+	parser = argparse.ArgumentParser(description="Check one version of the sudoku rules against another, rule by rule.")
+	parser.add_argument("input", nargs="?", default="sudoku.txt",
+		help="puzzles in the sudoku.txt layout (default sudoku.txt; '-' for stdin, '' for none)")
+	parser.add_argument("--reference", default="HEAD", metavar="REV_OR_DIR",
+		help="version to check against: a git revision or a directory (default HEAD)")
+	parser.add_argument("--candidate", metavar="REV_OR_DIR", help="version to check (default: the working tree)")
+	parser.add_argument("--rules", help="rules to use (default: each puzzle's Rules line; all rules for random puzzles)")
+	parser.add_argument("--random", type=int, default=0, metavar="N", help="also check N random puzzles")
+	parser.add_argument("--givens", type=int, default=26, metavar="N", help="givens in each random puzzle (default 26)")
+	parser.add_argument("--seed", type=int, help="seed for the random puzzles, to repeat a run")
+	parser.add_argument("--shrink", action="store_true", help="shrink each failing puzzle to a minimal one that fails")
+	parser.add_argument("--stop", action="store_true", help="stop at the first failure")
+	args = parser.parse_args()
+
+	reference, candidate = get_engine(args.reference), get_engine(args.candidate)
+	seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+	rng = random.Random(seed)
+	print("Checking {} against {}{}".format(candidate.name, reference.name, ", random seed {}".format(seed) if args.random else ""))
+	checked = failed = 0
+	for title, line, rules_to_use, solution in puzzle_lines(args, rng):
+		rules_to_use = "".join([rule for rule in rules_to_use if candidate.has_rule(rule) and reference.has_rule(rule)])
+		found = check_puzzle(reference, candidate, line, rules_to_use, solution)
+		checked += 1
+		if found is None:
+			continue
+		failed += 1
+		print_failure(title, line, rules_to_use, found)
+		if args.shrink:
+			print_failure("Shrunk", *shrink(reference, candidate, line, rules_to_use, found, solution))
+		if args.stop:
+			break
+	print()
+	print_speed(reference, candidate)
+	print()
+	print("{} puzzles checked, {} failed.".format(checked, failed))
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,191 @@
+import argparse
+import json
+import sys
+import time
+from functools import partial
+from itertools import islice
+from sudoku import sudoku_from_grid
+from sudoku_jobs import resume_message, run_resumable
+from sudoku_solver import RULE_NAMES, RULE_ORDER, RuleProfiler, read_puzzle_texts, run_chunk_jobs, solve_sudoku, solve_sudoku_adaptive
+
+# Difficulty grading: for each puzzle, the easiest set of rules that solves it, how many passes that takes, how
+# often each rule was needed, and a score and grade worked out from those.
+#
+# Rules are tried as a ladder from easiest to hardest (GRADE_ORDER) with the adaptive engine: a harder rule is only
+# tried once every easier rule is stuck, and as soon as it eliminates anything the easier rules take over again,
+# from the grid as it now stands.  So one solve climbs only as high as the puzzle needs, and the rules that
+# eliminated something are the ones it used -- without solving it again for every subset of the rules.  Those are
+# not always all needed: an easier rule that happened to fire first may do work a later one would have done anyway.
+# So the puzzle is then solved again from its givens with the usual pass-by-pass engine, leaving out one rule at a
+# time (hardest first) and keeping it out whenever the rest still solve it, until no rule can be left out.  That
+# also counts passes the way the notes in sudoku.txt do.  If any rule was left out, the ladder is climbed again
+# with the rules that are left, for the usage counts.
+#
+# The score adds up RULE_WEIGHTS of every rule application that eliminated something; the grade follows from the
+# hardest rule needed (GRADES).  A grid that is solved already needs no rules, and is graded EASY.
+
+GRADE_ORDER = "015234" + "69A8B7CD"		# rules from easiest to hardest for a person
+RULE_WEIGHTS = {"0": 1, "1": 1, "5": 2, "2": 3, "3": 4, "4": 5, "6": 6, "9": 6, "A": 6, "8": 7, "B": 8, "7": 8,
+	"C": 10, "D": 12}
+GRADES = [(1, "EASY"), (2, "MEDIUM"), (5, "HARD"), (8, "VERY HARD"), (12, "EXTREMELY HARD")]	# (hardest weight, grade)
+
+def grade_name(weight):
+	for most, name in GRADES:
+		if weight <= most:
+			return name
+	return GRADES[-1][1]
+
+def solve_from(s, givens, rules):	# put s back to its givens and solve it with rules; returns (solved, passes)
+	s.restore(givens)
+	return solve_sudoku(s, rules, verbose=False)
+
+# The rules of a set that solves s from its givens with none left out that can be: rules are left out one at a time,
+# hardest first, for as long as the rest still solve it.  Returns (rules, passes to solve with them).
+def fewest_rules(s, givens, rules, passes):
+	dropped = True
+	while dropped:
+		dropped = False
+		for rule in sorted(rules, key=GRADE_ORDER.index, reverse=True):
+			fewer = rules.replace(rule, "")
+			solved, fewer_passes = solve_from(s, givens, fewer)
+			if solved:
+				rules, passes, dropped = fewer, fewer_passes, True
+	return rules, passes
+
+def ladder_usage(s, order):		# climb the ladder of rules in order: (solved, {rule: times it eliminated something})
+	profile = RuleProfiler()
+	solved, steps = solve_sudoku_adaptive(s, order, verbose=False, profile=profile, order=order)
+	return solved, dict([(rule, counters["hits"]) for rule, counters in profile.as_dict()["rules"].items() if counters["hits"]])
+
+# Grade Sudoku s, using only the rules in rules_to_use.  Returns a record: "grade" ("STUCK" if the rules can't solve
+# it), "score", "rules" (the rules it needs: none can be left out), "hardest" (name of the hardest one, None if it
+# needs none), "passes" (to solve with those rules, or to get stuck with all of them), "usage" ({rule: times it
+# eliminated something}), and "candidates" left.  s is left as far as the rules could take it.
+def grade_sudoku(s, rules_to_use=RULE_ORDER):
+	givens = s.snapshot()
+	order = "".join([rule for rule in GRADE_ORDER if rule in rules_to_use])
+	solved, usage = ladder_usage(s, order)
+	candidates = s.count_options()
+	needed = "".join([rule for rule in RULE_ORDER if rule in usage])
+	if solved:
+		confirmed, passes = solve_from(s, givens, needed)
+		if not confirmed:			# the easier rules got further in another order; start from every rule up to the hardest
+			needed = order[:max([order.index(rule) for rule in usage]) + 1]
+			confirmed, passes = solve_from(s, givens, needed)
+		needed, passes = fewest_rules(s, givens, needed, passes)
+		if [rule for rule in usage if rule not in needed]:
+			s.restore(givens)
+			climbed, fewer_usage = ladder_usage(s, "".join([rule for rule in order if rule in needed]))
+			if climbed:				# else keep the first climb's counts
+				usage = fewer_usage
+		solve_from(s, givens, needed)
+	else:
+		confirmed, passes = solve_from(s, givens, order)
+	record = {"solved": solved, "rules": needed, "passes": passes, "candidates": candidates,
+		"usage": usage, "score": sum([RULE_WEIGHTS[rule] * usage[rule] for rule in usage])}
+	if not solved:
+		record["hardest"] = None
+		record["grade"] = "STUCK"
+	elif needed:
+		hardest = max(needed, key=lambda rule: (RULE_WEIGHTS[rule], order.index(rule)))
+		record["hardest"] = RULE_NAMES[hardest]
+		record["grade"] = grade_name(RULE_WEIGHTS[hardest])
+	else:						# solved already
+		record["hardest"] = None
+		record["grade"] = GRADES[0][1]
+	return record
+
+def grade_record(number, grid_text, rules_to_use=RULE_ORDER):
+	start = time.perf_counter()
+	record = {"puzzle": number}
+	record.update(grade_sudoku(sudoku_from_grid(grid_text), rules_to_use))
+	record["seconds"] = time.perf_counter() - start
+	return record
+
+def grade_text(number, rules_line, grid_text, rules_to_use=RULE_ORDER):	# grade_record, called like sudoku_jobs work
+	return grade_record(number, grid_text, rules_to_use)
+
+
+### Batch grading
+
+def puzzle_texts(path):			# (rules line, grid text) of every puzzle in a text or packed file ('-' for stdin)
+	if path == "-":
+		return read_puzzle_texts(sys.stdin)
+	from sudoku_pack import is_packed, packed_texts
+	if is_packed(path):
+		return packed_texts(path)
+	return read_puzzle_texts(open(path, "r"))
+
+def grade_chunk(chunk, rules_to_use=RULE_ORDER):	# worker side: grade (number, grid_text) puzzles, like solve_chunk
+	return [grade_record(number, grid_text, rules_to_use) for number, grid_text in chunk], None
+
+# Grade every puzzle in path, yielding one record per puzzle (see grade_sudoku).  Each puzzle's own "Rules" line is
+# ignored: grading decides which rules it needs.  With more than one worker, chunk_size puzzles at a time are sent to
+# a pool of worker processes.  If results_path is given, grading is a resumable job (see sudoku_jobs.py): the
+# records are saved there, puzzles that can't be graded go to rejects_path, and a job stopped part way goes on from
+# its last checkpoint.
+def grade_batch(path, rules_to_use=RULE_ORDER, workers=1, chunk_size=50, ordered=True, results_path=None, rejects_path=None):
+	if results_path:
+		yield from run_resumable(path, partial(grade_text, rules_to_use=rules_to_use), results_path, rejects_path,
+			workers, chunk_size, {"job": "grade", "rules": rules_to_use})
+		return
+	numbered = ((number, grid_text) for number, (rules_line, grid_text) in enumerate(puzzle_texts(path), 1))
+	if workers == 1:
+		for number, grid_text in numbered:
+			yield grade_record(number, grid_text, rules_to_use)
+		return
+	chunks = iter(lambda: list(islice(numbered, chunk_size)), [])
+	yield from run_chunk_jobs(((grade_chunk, chunk, rules_to_use) for chunk in chunks), workers, ordered)
+
+def print_grade(record):
+	if record.get("error"):
+		print("Puzzle {}: ERROR, {}".format(record["puzzle"], record["error"]))
+	elif record["solved"] and not record["rules"]:
+		print("Puzzle {}: {}, solved already".format(record["puzzle"], record["grade"]))
+	elif record["solved"]:
+		print("Puzzle {}: {} (score {}), needs {} up to {}, solves in {} passes".format(record["puzzle"], record["grade"],
+			record["score"], "+".join(["R" + rule for rule in record["rules"]]), record["hardest"], record["passes"]))
+	else:
+		print("Puzzle {}: STUCK, {} candidates left (stuck on pass {})".format(record["puzzle"], record["candidates"],
+			record["passes"]))
+
+
+### Main driver
+
+def main():
+	parser = argparse.ArgumentParser(description="Grade sudoku puzzles by the easiest rules that solve them.")
+	parser.add_argument("input", help="puzzle file in the sudoku.txt layout, or a packed file ('-' for stdin)")
+	parser.add_argument("--rules", default=RULE_ORDER, help="rules grading may use (default all: {})".format(RULE_ORDER))
+	parser.add_argument("--workers", type=int, default=1, metavar="N", help="grade on N worker processes (0 = one per CPU)")
+	parser.add_argument("--chunk-size", type=int, default=50, metavar="N", help="puzzles sent to a worker at a time")
+	parser.add_argument("--unordered", action="store_true", help="print results as they finish, not in input order")
+	parser.add_argument("--json", action="store_true", help="print one JSON record per puzzle")
+	parser.add_argument("--results", metavar="FILE", help="save every record to FILE (JSON lines) as a resumable job; "
+		"run again to go on from where it stopped")
+	parser.add_argument("--rejects", metavar="FILE", help="with --results: save puzzles that can't be graded to FILE")
+	args = parser.parse_args()
+	if args.results and (args.input == "-" or args.unordered):
+		parser.error("--results needs an input file, and works without --unordered")
+	if args.rejects and not args.results:
+		parser.error("--rejects works only with --results")
+	message = resume_message(args.results) if args.results else None
+	if message and not args.json:
+		print(message)
+
+	counts = {}
+	for record in grade_batch(args.input, args.rules, args.workers or None, args.chunk_size, not args.unordered,
+			args.results, args.rejects):
+		grade = record.get("grade", "ERROR")
+		counts[grade] = counts.get(grade, 0) + 1
+		if args.json:
+			print(json.dumps(record))
+		else:
+			print_grade(record)
+	if not args.json:
+		print()
+		for weight, grade in GRADES + [(None, "STUCK"), (None, "ERROR")]:
+			if grade in counts:
+				print("{:15} {}".format(grade, counts[grade]))
+
+if __name__ == "__main__":
+	main()
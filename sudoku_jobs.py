@@ -0,0 +1,147 @@
+import json
+import os
+import time
+from collections import deque
+from itertools import islice
+from sudoku_solver import run_chunk_jobs
+
+# Resumable batch jobs: solve or grade every puzzle in a large file, keeping each puzzle's outcome in an append-only
+# results file (JSON Lines, one record per puzzle, in input order) so a job that stops part way -- interrupted,
+# killed, or the machine going down -- can be started again and carry on where it got to.
+#
+# Every few seconds the job saves a checkpoint next to the results file (FILE.checkpoint): how many puzzles are done,
+# where in the input the next one starts (a byte offset in a text file, a puzzle index in a packed one), and how long
+# the results and rejects files were at that point.  Run again with the same input and results file, the job cuts
+# both files back to those lengths -- dropping anything written after the checkpoint -- and goes on from that
+# offset, so only the puzzles since the last checkpoint are done twice.  A finished job's checkpoint stays, and
+# running it again does nothing.
+#
+# A puzzle that can't be read or solved (an invalid character, too few lines, givens that contradict each other)
+# doesn't stop the job: its record has an "error" instead of a result, and the puzzle itself is written to the
+# rejects file in the sudoku.txt layout, with the error as a note, so it can be fixed and run again.
+
+CHECKPOINT_SECONDS = 5.0			# most time between checkpoints
+
+
+### Reading from an offset
+
+# (rules_to_use, grid_text, offset after the puzzle) of each puzzle in a sudoku.txt-style file, from byte offset on
+def text_puzzles(path, offset=0):
+	with open(path, "rb") as ifile:
+		ifile.seek(offset)
+		while True:
+			line = ifile.readline()
+			if not line:
+				return
+			if line.startswith(b"Rules"):
+				grid_text = b"".join([ifile.readline() for i in range(9)])
+				yield line[len(b"Rules"):].strip().decode("utf-8", "replace"), grid_text.decode("utf-8", "replace"), ifile.tell()
+
+def packed_puzzles(path, offset=0):	# the same for a packed file, from puzzle index offset on
+	from sudoku_pack import open_packed
+	puzzles = open_packed(path)
+	for i in range(offset, len(puzzles)):
+		yield puzzles.get_rules(i), puzzles.get_line(i), i + 1
+
+def puzzles_from(path, offset=0):
+	from sudoku_pack import is_packed
+	return packed_puzzles(path, offset) if is_packed(path) else text_puzzles(path, offset)
+
+
+### Worker side
+
+# work(number, rules_to_use, grid_text)'s record for one puzzle, or if it raises, an error record with the puzzle's
+# rules and grid (the grid is taken out again for the rejects file before the record is saved)
+def run_guarded(work, number, rules_to_use, grid_text):
+	try:
+		return work(number, rules_to_use, grid_text)
+	except Exception as error:
+		return {"puzzle": number, "rules": rules_to_use, "error": str(error) or type(error).__name__, "grid": grid_text}
+
+def guarded_chunk(work, chunk):		# run_guarded on a chunk of (number, rules_to_use, grid_text); like solve_chunk
+	return [run_guarded(work, *puzzle) for puzzle in chunk], None
+
+
+### Checkpoints
+
+def read_checkpoint(path):			# the saved checkpoint, or None if there is none
+	if not os.path.exists(path):
+		return None
+	with open(path, "r") as ifile:
+		return json.load(ifile)
+
+def save_checkpoint(path, checkpoint, ofiles):		# flush and sync ofiles, then replace the checkpoint file in one step
+	for ofile in ofiles:
+		ofile.flush()
+		os.fsync(ofile.fileno())
+	with open(path + ".tmp", "w") as ofile:
+		json.dump(checkpoint, ofile)
+	os.replace(path + ".tmp", path)
+
+def open_at(path, size):			# open path for appending, cut back to size bytes (a new job: 0)
+	ofile = open(path, "ab")
+	ofile.truncate(size)
+	ofile.seek(size)				# so tell() gives the length: truncate() doesn't move the position
+	return ofile
+
+def write_reject(rejects, record, grid_text):
+	text = "Puzzle {}: {}\nRules {}\n{}".format(record["puzzle"], record["error"], record["rules"], grid_text)
+	rejects.write((text if text.endswith("\n") else text + "\n").encode("utf-8"))
+
+
+### Job driver
+
+# Run work(number, rules_to_use, grid_text) -> record on every puzzle in path (a text or packed file), saving the
+# records to results_path and the puzzles that raise to rejects_path (if given), yielding each record as it is
+# saved.  options describes the job (e.g. its engine and rules); a checkpoint is only resumed by the same job on the
+# same input.  With more than one worker, chunk_size puzzles at a time go to a pool of worker processes (work must
+# be a module-level function, or a partial of one, so it can be sent to them).  Records are always in input order,
+# so everything before the checkpointed offset is done.
+def run_resumable(path, work, results_path, rejects_path=None, workers=1, chunk_size=50, options=None,
+		checkpoint_seconds=CHECKPOINT_SECONDS):
+	checkpoint_path = results_path + ".checkpoint"
+	job = {"input": os.path.abspath(path), "size": os.path.getsize(path), "options": options}
+	checkpoint = read_checkpoint(checkpoint_path)
+	if checkpoint is None:
+		checkpoint = {"job": job, "puzzles": 0, "offset": 0, "results": 0, "rejects": 0}
+	elif checkpoint["job"] != job:
+		raise Exception ("{} belongs to another job (input or options differ); delete it to start again.".format(checkpoint_path))
+	results = open_at(results_path, checkpoint["results"])
+	rejects = open_at(rejects_path, checkpoint["rejects"]) if rejects_path else None
+	ofiles = [results] + ([rejects] if rejects else [])
+
+	offsets = deque()				# input offset after each puzzle handed out and not yet saved, in order
+	def numbered():
+		for number, (rules_to_use, grid_text, offset) in enumerate(puzzles_from(path, checkpoint["offset"]), checkpoint["puzzles"] + 1):
+			offsets.append(offset)
+			yield number, rules_to_use, grid_text
+	if workers == 1:
+		records = (run_guarded(work, *puzzle) for puzzle in numbered())
+	else:
+		puzzles = numbered()
+		chunks = iter(lambda: list(islice(puzzles, chunk_size)), [])
+		records = run_chunk_jobs(((guarded_chunk, work, chunk) for chunk in chunks), workers, True)
+
+	saved = time.perf_counter()
+	try:
+		for record in records:
+			grid_text = record.pop("grid", None)
+			if rejects and record.get("error"):
+				write_reject(rejects, record, grid_text)
+			results.write((json.dumps(record) + "\n").encode("utf-8"))
+			checkpoint.update(puzzles=record["puzzle"], offset=offsets.popleft(), results=results.tell(),
+				rejects=rejects.tell() if rejects else 0)
+			if time.perf_counter() - saved >= checkpoint_seconds:
+				save_checkpoint(checkpoint_path, checkpoint, ofiles)
+				saved = time.perf_counter()
+			yield record
+	finally:						# finished, or stopped part way: either way, save how far the job got
+		save_checkpoint(checkpoint_path, checkpoint, ofiles)
+		for ofile in ofiles:
+			ofile.close()
+
+def resume_message(results_path):	# how far an earlier run of the job got, or None for a new job
+	checkpoint = read_checkpoint(results_path + ".checkpoint")
+	if checkpoint is None:
+		return None
+	return "Resuming after puzzle {} (saved in {}).".format(checkpoint["puzzles"], results_path)
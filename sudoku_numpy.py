@@ -0,0 +1,222 @@
+import time
+from sudoku import (ALL_DIGITS, BOX_INDICES, BOX_OF, CELL_UNITS, COL_OF, DIGIT_BIT, MASK_COUNT, PEERS, ROW_OF,
+	UNIT_INDICES, sudoku_from_masks)
+from sudoku_solver import apply_grid_rules, get_engine
+
+try:
+	import numpy as np
+except ImportError:		# NumPy is optional; only this engine needs it
+	np = None
+
+# Vectorized batch engine: holds N puzzles as an (N, 81) array of candidate bitmasks (same bit layout as sudoku.py)
+# and applies rules 0 (naked single), 1 (hidden single) and 5 (locked single, both 5rc and 5b) to the whole batch at
+# once with NumPy, until no puzzle changes.  Puzzles that stall without being solved are handed to the usual rule
+# functions (any engine in sudoku_solver.ENGINES) with all their rules, starting from the state reached here.
+#
+# The batch stops only when a whole pass changes nothing.  Rules 0 and 1 only ever find more as options are removed,
+# so the order they are applied in doesn't matter and the batch ends in the same state logic_rule_0/logic_rule_1
+# reach one container at a time.  Rule 5 is not like that: it needs a digit in 2 or more cells of a container, so
+# an elimination it would have made is lost once another rule leaves the digit in one cell, and applied to every
+# container at once it can stop elsewhere than logic_rule_5rc/logic_rule_5b one container after another.  Rule 1
+# settles such a digit either way, so puzzles whose rules include 5 but not 1 skip the vector rules and are solved
+# by the engine from the start.  Every puzzle thus ends in exactly the scalar engine's state (test_sudoku.py checks
+# this on sudoku.txt).  Pass counts are not comparable: one vectorized pass applies each rule to every container of
+# every puzzle at the same time.
+
+VECTOR_RULES = "015"
+
+def vector_rules_exact(rules_to_use):	# do the vector rules end where the scalar ones do, with these rules?
+	return "5" not in rules_to_use or "1" in rules_to_use
+
+TABLES = None		# index arrays, built on first use by numpy_tables()
+
+def numpy_tables():
+	global TABLES
+	if np is None:
+		raise ImportError("The vectorized batch engine needs NumPy (pip install numpy).")
+	if TABLES is None:
+		band_rows = [[r2 for r2 in range(ROW_OF[i] // 3 * 3, ROW_OF[i] // 3 * 3 + 3) if r2 != ROW_OF[i]] for i in range(81)]
+		band_boxes = [[b for b in range(BOX_OF[i] // 3 * 3, BOX_OF[i] // 3 * 3 + 3) if b != BOX_OF[i]] for i in range(81)]
+		stack_boxes = [[b for b in range(BOX_OF[i] % 3, 9, 3) if b != BOX_OF[i]] for i in range(81)]
+		TABLES = {
+			"count": np.array(MASK_COUNT, dtype=np.uint8),			# candidates in each mask
+			"shifts": np.arange(9, dtype=np.uint16),				# bit of each digit 1-9
+			"weights": np.array(DIGIT_BIT[1:], dtype=np.uint16),	# mask value of each digit 1-9
+			"peers": np.array(PEERS),								# (81, 20) peers of each cell
+			"units": np.array(UNIT_INDICES),						# (27, 9) cells of each unit
+			"cell_units": np.array(CELL_UNITS),						# (81, 3) units of each cell
+			"cell_unit_pos": np.array([[UNIT_INDICES[u].index(i) for u in CELL_UNITS[i]] for i in range(81)]),	# (81, 3)
+			"boxes": np.array(BOX_INDICES).reshape(9, 3, 3),		# (9, 3, 3) cells of each box by row and col
+			"transpose": np.array([c * 9 + r for r in range(9) for c in range(9)]),	# cell index with rows and cols swapped
+			"band_rows": np.array(band_rows),						# (81, 2) other rows of each cell's band
+			"seg": np.array([COL_OF[i] // 3 for i in range(81)]),	# which box-wide third of its row each cell is in
+			"band_boxes": np.array(band_boxes),						# (81, 2) other boxes in each cell's band
+			"stack_boxes": np.array(stack_boxes),					# (81, 2) other boxes in each cell's stack
+			"row_in_box": np.array([ROW_OF[i] % 3 for i in range(81)]),
+			"col_in_box": np.array([COL_OF[i] % 3 for i in range(81)]),
+		}
+	return TABLES
+
+
+### Vectorized rules: each takes and returns an (n, 81) uint16 mask array
+
+def to_bits(t, masks):				# (n, 81, 9) bool: is digit d+1 possible in each cell?
+	return ((masks[:, :, None] >> t["shifts"]) & 1).astype(bool)
+
+def to_masks(t, bits):				# inverse of to_bits, over the last axis
+	return (bits * t["weights"]).sum(axis=-1).astype(np.uint16)
+
+# Rule 0: Naked single -- remove each settled cell's digit from its unsettled peers
+def vector_rule_0(t, masks):
+	settled = t["count"][masks] == 1
+	settled_bits = np.where(settled, masks, 0).astype(np.uint16)
+	seen = np.bitwise_or.reduce(settled_bits[:, t["peers"]], axis=2)
+	return np.where(settled, masks, masks & ~seen)
+
+# Rule 1: Hidden single -- a digit possible in only one cell of a unit settles that cell (unless already settled)
+def vector_rule_1(t, masks):
+	unit_bits = to_bits(t, masks)[:, t["units"], :]				# (n, 27, 9 cells, 9 digits)
+	hidden = unit_bits.sum(axis=2) == 1							# (n, 27, 9 digits)
+	unit_singles = to_masks(t, unit_bits & hidden[:, :, None, :])	# (n, 27, 9 cells): digit each cell must be
+	singles = np.bitwise_or.reduce(unit_singles[:, t["cell_units"], t["cell_unit_pos"]], axis=2)
+	return np.where((singles != 0) & (t["count"][masks] != 1), singles, masks)
+
+# Rule 5rc for rows: a digit possible in 2+ cells of a row, all in one box, is removed from the rest of that box
+def row_locked_eliminations(t, masks):
+	n = masks.shape[0]
+	row_bits = to_bits(t, masks).reshape(n, 9, 9, 9)			# (n, row, col, digit)
+	thirds = row_bits.reshape(n, 9, 3, 3, 9).any(axis=3)		# (n, row, third, digit)
+	locked = (row_bits.sum(axis=2) > 1) & (thirds.sum(axis=2) == 1)
+	locked_thirds = thirds & locked[:, :, None, :]
+	eliminate = locked_thirds[:, t["band_rows"], t["seg"][:, None], :].any(axis=2)	# (n, 81, digit)
+	return to_masks(t, eliminate)
+
+def vector_rule_5rc(t, masks):
+	masks = masks & ~row_locked_eliminations(t, masks)
+	transposed = masks[:, t["transpose"]]						# cols as rows
+	transposed = transposed & ~row_locked_eliminations(t, transposed)
+	return transposed[:, t["transpose"]]
+
+# Rule 5b: a digit possible in 2+ cells of a box, all in one row (col), is removed from the rest of that row (col)
+def vector_rule_5b(t, masks):
+	box_bits = to_bits(t, masks)[:, t["boxes"], :]				# (n, box, row in box, col in box, digit)
+	several = box_bits.sum(axis=(2, 3)) > 1						# (n, box, digit)
+	rows = box_bits.any(axis=3)									# (n, box, row in box, digit)
+	rows = rows & (several & (rows.sum(axis=2) == 1))[:, :, None, :]
+	cols = box_bits.any(axis=2)
+	cols = cols & (several & (cols.sum(axis=2) == 1))[:, :, None, :]
+	eliminate = rows[:, t["band_boxes"], t["row_in_box"][:, None], :].any(axis=2)
+	eliminate |= cols[:, t["stack_boxes"], t["col_in_box"][:, None], :].any(axis=2)
+	return masks & ~to_masks(t, eliminate)
+
+
+### Batch driver
+
+def grid_to_masks(grid_text):		# 81 candidate masks from 9 lines in the sudoku.txt layout (or one 81-char line)
+	chars = "".join([line[:9] for line in grid_text.split("\n")[:9]]) if "\n" in grid_text.strip() else grid_text.strip()
+	masks = []
+	for c in chars[:81]:
+		if c in "-_ .0":
+			masks.append(ALL_DIGITS)
+		elif c in "123456789":
+			masks.append(DIGIT_BIT[int(c)])
+		else:
+			raise Exception ("Invalid character {} in input.".format(c))
+	if len(masks) != 81:
+		raise Exception ("Grid has {} cells; a sudoku needs 81.".format(len(masks)))
+	return masks
+
+# Apply the enabled vector rules to every puzzle until none changes.  masks is (N, 81) and is updated in place;
+# rules_list gives each puzzle's rules.  Puzzles whose rules are not vector_rules_exact are left as they are.
+# Returns (passes, error): per-puzzle pass counts and whether a cell ran out of candidates.
+def propagate(masks, rules_list):
+	t = numpy_tables()
+	use = {rule: np.array([rule in rules for rules in rules_list])[:, None] for rule in VECTOR_RULES}
+	passes = np.zeros(len(masks), dtype=np.int64)
+	error = np.zeros(len(masks), dtype=bool)
+	active = np.array([k for k, rules in enumerate(rules_list) if vector_rules_exact(rules)], dtype=np.int64)
+	while active.size:
+		m = masks[active]
+		before = m.copy()
+		if use["0"][active].any():
+			m = np.where(use["0"][active], vector_rule_0(t, m), m)
+		if use["1"][active].any():
+			m = np.where(use["1"][active], vector_rule_1(t, m), m)
+		if use["5"][active].any():
+			m = np.where(use["5"][active], vector_rule_5rc(t, m), m)
+			m = np.where(use["5"][active], vector_rule_5b(t, m), m)
+		masks[active] = m
+		passes[active] += 1
+		counts = t["count"][m]
+		broken = (counts == 0).any(axis=1)
+		error[active[broken]] = True
+		keep = (m != before).any(axis=1) & ~broken & (counts > 1).any(axis=1)
+		active = active[keep]
+	return passes, error
+
+# Finish a puzzle the vector rules left stalled, with all its rules.  If the engine finds nothing on its first pass,
+# the pass driver reports the puzzle stuck without having tried the advanced rules (they are skipped on pass 1),
+# so try them here and hand back to the engine whenever they find something.  Returns (solved, passes).
+def finish_puzzle(s, rules_to_use, engine):
+	passes = 0
+	while True:
+		solved, more_passes = get_engine(engine)(s, rules_to_use, verbose=False)
+		passes += more_passes
+		if solved or more_passes > 1:		# after its first pass the engine has tried the advanced rules itself
+			return solved, passes
+		passes += 1
+		s.clear_changed()
+		apply_grid_rules(s, rules_to_use)
+		if s.is_solved():
+			return True, passes
+		if not s.is_changed():
+			return False, passes
+
+# Solve a list of (rules_to_use, grid_text) puzzles together.  Returns (s, solved, passes, error, seconds) for each
+# puzzle: its final state as a Sudoku, whether it was solved, passes used, whether a cell ran out of candidates, and
+# its time (including its share of the vectorized part).
+def solve_states(puzzles, engine="passes"):
+	start = time.perf_counter()
+	rules_list = [rules_to_use for rules_to_use, grid_text in puzzles]
+	masks = np.array([grid_to_masks(grid_text) for rules_to_use, grid_text in puzzles], dtype=np.uint16).reshape(-1, 81)
+	passes, error = propagate(masks, rules_list)
+	share = (time.perf_counter() - start) / max(len(puzzles), 1)	# each puzzle's share of the vectorized time
+	states = []
+	for k in range(len(puzzles)):
+		record_start = time.perf_counter()
+		s = sudoku_from_masks(masks[k])
+		solved = s.is_solved() and not error[k]
+		more_passes = 0
+		if not solved and not error[k]:
+			if not vector_rules_exact(rules_list[k]):		# untouched by propagate(): the engine does it all
+				solved, more_passes = get_engine(engine)(s, rules_list[k], verbose=False)
+			elif [rule for rule in rules_list[k] if rule not in VECTOR_RULES]:
+				solved, more_passes = finish_puzzle(s, rules_list[k], engine)
+		states.append((s, solved, int(passes[k]) + more_passes, bool(error[k]), share + time.perf_counter() - record_start))
+	return states
+
+# Solve a list of (rules_to_use, grid_text) puzzles together.  Returns one batch result record per puzzle (see
+# sudoku_solver.solve_record), plus an "error" message for puzzles left with a cell that has no candidates.
+def solve_many(puzzles, engine="passes", first_number=1):
+	records = []
+	for k, (s, solved, passes, error, seconds) in enumerate(solve_states(puzzles, engine)):
+		record = {"puzzle": first_number + k, "rules": puzzles[k][0], "solved": solved, "passes": passes,
+			"candidates": s.count_options(), "seconds": seconds}
+		if error:
+			record["error"] = "Houston, we have a problem! A cell has no options left."
+		records.append(record)
+	return records
+
+# Solve every puzzle of texts, (rules_to_use, grid_text) pairs as read_puzzle_texts gives them, batch_size puzzles
+# at a time, yielding one record per puzzle in input order
+def solve_batch_numpy(texts, batch_size=4096, engine="passes"):
+	numbered = 1
+	puzzles = []
+	for puzzle in texts:
+		puzzles.append(puzzle)
+		if len(puzzles) == batch_size:
+			yield from solve_many(puzzles, engine, numbered)
+			numbered += len(puzzles)
+			puzzles = []
+	if puzzles:
+		yield from solve_many(puzzles, engine, numbered)
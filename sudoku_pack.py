@@ -0,0 +1,206 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+from sudoku import ALL_DIGITS, DIGIT_BIT, MASK_COUNT, sudoku_from_masks
+from sudoku_solver import ENGINES, RuleProfiler, get_engine, read_puzzle_texts, run_chunk_jobs, solve_record
+
+# Packed binary puzzle files: the same puzzles as sudoku.txt, stored so they can be read without parsing.
+#
+# The file is a 32-byte header followed by fixed-size records, all little-endian:
+#
+#   header  8s magic b"SUDOKUPK", H version, H flags, I record size, Q record count, 8 bytes reserved
+#   record  16s rules (the "Rules" line's text, zero-padded), 81 bytes givens (digit 1-9, 0 for an empty cell),
+#           1 byte status (0 not solved yet, 1 solved, 2 stuck), and if flags has HAS_MASKS:
+#           81 H final candidate masks (bit n-1 set when digit n is possible, as in sudoku.py)
+#
+# PackedPuzzles memory-maps such a file, so puzzle i is a slice of the map at a fixed offset: nothing is read
+# until it is used, and processes working on the same file share one copy of it in the page cache.
+
+MAGIC = b"SUDOKUPK"
+VERSION = 1
+HAS_MASKS = 1						# flags bit: each record ends with the final candidate masks
+HEADER = struct.Struct("<8sHHIQ8x")
+RULES_SIZE = 16
+GIVENS_SIZE = 81
+MASKS_SIZE = 162
+STATUS = {0: "unsolved", 1: "solved", 2: "stuck"}
+
+def record_size(flags):
+	return RULES_SIZE + GIVENS_SIZE + 1 + (MASKS_SIZE if flags & HAS_MASKS else 0)
+
+def is_packed(path):
+	with open(path, "rb") as ifile:
+		return ifile.read(len(MAGIC)) == MAGIC
+
+
+### Writing
+
+def grid_to_givens(grid_text):		# 81 given bytes from 9 grid lines in the sudoku.txt layout
+	givens = bytearray(GIVENS_SIZE)
+	lines = grid_text.split("\n")
+	for i in range(9):
+		for j in range(9):
+			c = lines[i][j]
+			if c in "123456789":
+				givens[i * 9 + j] = int(c)
+			elif c not in "-_ ":
+				raise Exception ("Invalid character {} in input.".format(c))
+	return bytes(givens)
+
+def pack_record(rules_to_use, givens, status=0, masks=None):
+	rules = rules_to_use.encode("ascii")
+	if len(rules) > RULES_SIZE:
+		raise Exception ("Rules {} do not fit in a packed record.".format(rules_to_use))
+	record = rules.ljust(RULES_SIZE, b"\0") + givens + bytes([status])
+	if masks is not None:
+		record += struct.pack("<81H", *masks)
+	return record
+
+# Convert puzzles from an open sudoku.txt-style file to a packed file at path.  If engine is given, every puzzle is
+# solved with it and its final candidate masks and status are stored too.  Returns the number of puzzles written.
+def convert_text(ifile, path, engine=None):
+	flags = HAS_MASKS if engine else 0
+	count = 0
+	with open(path, "wb") as ofile:
+		ofile.write(HEADER.pack(MAGIC, VERSION, flags, record_size(flags), 0))	# count filled in at the end
+		for rules_to_use, grid_text in read_puzzle_texts(ifile):
+			givens = grid_to_givens(grid_text)
+			if engine:
+				s = givens_to_sudoku(givens)
+				solved, passes = get_engine(engine)(s, rules_to_use, verbose=False)
+				ofile.write(pack_record(rules_to_use, givens, 1 if solved else 2, s.get_cands()))
+			else:
+				ofile.write(pack_record(rules_to_use, givens))
+			count += 1
+		ofile.seek(0)
+		ofile.write(HEADER.pack(MAGIC, VERSION, flags, record_size(flags), count))
+	return count
+
+
+### Reading
+
+def givens_to_sudoku(givens):		# Sudoku from 81 given bytes
+	return sudoku_from_masks([DIGIT_BIT[n] if n else ALL_DIGITS for n in givens])
+
+class PackedPuzzles:
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, "rb") as ifile:
+			self.map = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)	# the map stays valid after close
+		self.view = memoryview(self.map)
+		magic, version, self.flags, self.record_size, self.count = HEADER.unpack_from(self.map)
+		if magic != MAGIC or version != VERSION or self.record_size != record_size(self.flags):
+			raise Exception ("{} is not a version {} packed puzzle file.".format(path, VERSION))
+		if len(self.map) < HEADER.size + self.count * self.record_size:
+			raise Exception ("{} is truncated.".format(path))
+
+	def __len__(self):
+		return self.count
+
+	def record(self, i):				# zero-copy view of puzzle i's record
+		if not 0 <= i < self.count:
+			raise IndexError("Puzzle index {} out of range.".format(i))
+		start = HEADER.size + i * self.record_size
+		return self.view[start:start + self.record_size]
+
+	def get_rules(self, i):
+		return bytes(self.record(i)[:RULES_SIZE]).rstrip(b"\0").decode("ascii")
+
+	def get_givens(self, i):			# zero-copy view of 81 bytes, digit or 0 for each cell
+		return self.record(i)[RULES_SIZE:RULES_SIZE + GIVENS_SIZE]
+
+	def get_status(self, i):			# "unsolved", "solved", or "stuck"
+		return STATUS[self.record(i)[RULES_SIZE + GIVENS_SIZE]]
+
+	def has_masks(self):
+		return bool(self.flags & HAS_MASKS)
+
+	def get_masks(self, i):				# the 81 final candidate masks stored for puzzle i, or None
+		if not self.has_masks():
+			return None
+		return struct.unpack_from("<81H", self.record(i), RULES_SIZE + GIVENS_SIZE + 1)
+
+	def get_sudoku(self, i):
+		return givens_to_sudoku(self.get_givens(i))
+
+	def get_line(self, i):				# puzzle i's givens as one 81-character line, '-' for empty cells
+		return "".join([str(n) if n else "-" for n in self.get_givens(i)])
+
+	def to_text(self, i):				# puzzle i in the sudoku.txt layout
+		line = self.get_line(i)
+		return "\n".join(["Rules " + self.get_rules(i)] + [line[r * 9:r * 9 + 9] for r in range(9)]) + "\n"
+
+	def close(self):
+		self.view.release()
+		self.map.close()
+
+
+### Batch solving
+
+def packed_texts(path):			# (rules_to_use, grid line) of every puzzle in a packed file, like read_puzzle_texts
+	puzzles = open_packed(path)
+	for i in range(len(puzzles)):
+		yield puzzles.get_rules(i), puzzles.get_line(i)
+
+OPEN_FILES = {}		# path -> PackedPuzzles, kept open in each worker process for the chunks that follow
+
+def open_packed(path):
+	if path not in OPEN_FILES:
+		OPEN_FILES[path] = PackedPuzzles(path)
+	return OPEN_FILES[path]
+
+# Worker side: solve puzzles start to stop - 1 of a packed file; returns (records, profile_dict) like solve_chunk
+def solve_packed_chunk(path, start, stop, engine="passes", profiling=False):
+	puzzles = open_packed(path)
+	profile = RuleProfiler() if profiling else None
+	records = [solve_record(i + 1, puzzles.get_rules(i), puzzles.get_sudoku(i), engine, profile) for i in range(start, stop)]
+	return records, profile.as_dict() if profiling else None
+
+# Solve every puzzle in a packed file, yielding one result record per puzzle.  With more than one worker, each is
+# sent only a range of puzzle numbers and reads the puzzles from its own map of the file.
+def solve_packed(path, workers=1, chunk_size=50, ordered=True, engine="passes", profile=None):
+	puzzles = open_packed(path)
+	if workers == 1:
+		for i in range(len(puzzles)):
+			yield solve_record(i + 1, puzzles.get_rules(i), puzzles.get_sudoku(i), engine, profile)
+		return
+	jobs = ((solve_packed_chunk, path, start, min(start + chunk_size, len(puzzles)), engine, profile is not None)
+		for start in range(0, len(puzzles), chunk_size))
+	yield from run_chunk_jobs(jobs, workers, ordered, profile)
+
+
+### Main driver
+
+def main():
+	parser = argparse.ArgumentParser(description="Convert sudoku.txt-style puzzle files to the packed binary format and back.")
+	parser.add_argument("input", help="puzzle file to convert ('-' for stdin), or a packed file with --text")
+	parser.add_argument("output", nargs="?", help="packed file to write")
+	parser.add_argument("--results", choices=sorted(ENGINES), metavar="ENGINE",
+		help="also solve each puzzle with ENGINE ({}) and store its final candidates".format(", ".join(sorted(ENGINES))))
+	parser.add_argument("--text", action="store_true", help="print a packed file's puzzles in the sudoku.txt layout")
+	args = parser.parse_args()
+
+	if args.text:
+		puzzles = PackedPuzzles(args.input)
+		try:
+			for i in range(len(puzzles)):
+				print(puzzles.to_text(i))
+				masks = puzzles.get_masks(i)
+				if masks is not None:
+					print("{}, {} candidates left".format(puzzles.get_status(i), sum([MASK_COUNT[mask] for mask in masks])))
+					print()
+		except BrokenPipeError:		# e.g. piped into head: stop quietly
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())	# so flushing stdout at exit doesn't fail too
+			sys.exit(1)
+		return
+	if not args.output:
+		parser.error("an output file is needed to convert to the packed format")
+	ifile = sys.stdin if args.input == "-" else open(args.input, "r")
+	count = convert_text(ifile, args.output, args.results)
+	print("Packed {} puzzles into {}.".format(count, args.output))
+
+if __name__ == "__main__":
+	main()
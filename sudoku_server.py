@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+from sudoku import Contradiction, grid_to_lines
+from sudoku_cache import lines_to_key, normal_rules
+from sudoku_solver import ENGINES, RULE_ORDER, solve
+
+# Solving service: a small HTTP/JSON server, so other programs can have sudokus solved without starting Python and
+# importing the solver for each one.  It runs on asyncio and hands every solve to a pool of worker processes, so a
+# slow sudoku never holds up the server.  Requests for the same sudoku with the same rules, engine, and pass limit
+# that arrive while it is being solved all wait for that one solve.
+#
+#   POST /solve   body: JSON {"grid": ..., "rules": ..., "engine": ..., "max_passes": N, "timeout": seconds}, where
+#                 grid is one 81-character line, 9 lines, or a 9x9 list (as solve() accepts) and the rest are
+#                 optional; or the grid as plain text, with the options in the query string (/solve?rules=0125)
+#                 reply: JSON result (see SolveResult.as_dict), plus "coalesced": true if another request's solve
+#                 was shared
+#   GET /stats    reply: JSON counts of requests, solves, shared solves, timeouts, and solves in progress
+#
+# Every request has a pass budget and a time budget: what it asks for, but never more than the server's limits.
+# A solve stops starting new passes once the time of the request that started it is up, so an abandoned solve
+# doesn't hold its worker for long; a request out of time gets a 504 reply.  A request sharing a solve that stops
+# that way while it still has time left starts the solve again.  A grid whose givens contradict each other gets a
+# 422 reply.
+
+DEFAULT_RULES = "0123456789AB"
+MAX_BODY = 65536					# longest request body accepted, in bytes
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+	422: "Unprocessable Entity", 500: "Internal Server Error", 504: "Gateway Timeout"}
+
+class RequestError(Exception):		# a request the server can't handle; status is the HTTP status to reply with
+
+	def __init__(self, status, message):
+		Exception.__init__(self, message)
+		self.status = status
+
+# Worker side: solve one sudoku, return its result as a dict, or None if deadline (a time.time() value, since the
+# clocks of other processes can't be compared) passes first
+def solve_job(line, rules, engine, max_passes, deadline):
+	seconds_left = deadline - time.time()
+	if seconds_left <= 0:			# waited too long for a worker
+		return None
+	until = time.perf_counter() + seconds_left
+	result = solve(line, rules, max_passes=max_passes, engine=engine, deadline=until)
+	if result.status == "limit" and time.perf_counter() >= until:
+		return None
+	return result.as_dict()
+
+
+### Requests
+
+# Read one HTTP request from reader.  Returns (method, path, query, headers, body), or None at end of connection.
+async def read_request(reader):
+	request_line = await reader.readline()
+	if not request_line.strip():
+		return None
+	parts = request_line.decode("latin-1").split()
+	if len(parts) != 3:
+		raise RequestError(400, "Malformed request line.")
+	method, target, version = parts
+	headers = {}
+	while True:
+		line = await reader.readline()
+		if not line.strip():
+			break
+		name, sep, value = line.decode("latin-1").partition(":")
+		headers[name.strip().lower()] = value.strip()
+	length = int(headers.get("content-length", "0") or 0)
+	if length > MAX_BODY:
+		raise RequestError(413, "Request body is longer than {} bytes.".format(MAX_BODY))
+	body = await reader.readexactly(length) if length else b""
+	url = urlsplit(target)
+	headers["http-version"] = version
+	return method, url.path, dict(parse_qsl(url.query)), headers, body
+
+# The options of a /solve request, from a JSON body or a plain-text grid and the query string
+def parse_solve_request(query, headers, body):
+	text = body.decode("utf-8", "replace")
+	if "json" in headers.get("content-type", "") or text.lstrip().startswith("{"):
+		try:
+			options = json.loads(text)
+		except ValueError as error:
+			raise RequestError(400, "Body is not valid JSON: {}".format(error))
+		if not isinstance(options, dict) or "grid" not in options:
+			raise RequestError(400, "JSON body needs a \"grid\".")
+	else:
+		options = dict(query)
+		options["grid"] = text
+	return options
+
+def grid_key(grid):				# 81-character line of the grid, '-' for empty cells, checked
+	try:
+		key = lines_to_key(grid_to_lines(grid))
+	except Exception as error:
+		raise RequestError(400, str(error))
+	if len(key) != 81 or [c for c in key if c not in "123456789-"]:
+		raise RequestError(400, "Grid must be 81 cells of digits 1-9 or '-', '_', ' ', '0', '.' for empty cells.")
+	return key
+
+def number_option(options, name, limit, kind=int):	# the request's budget for name, no more than limit
+	value = options.get(name)
+	if value is None:
+		return limit
+	try:
+		value = kind(value)
+	except (TypeError, ValueError, OverflowError):
+		raise RequestError(400, "{} must be a number.".format(name))
+	if not math.isfinite(value) or value <= 0:		# "nan" and "inf" convert to floats too
+		raise RequestError(400, "{} must be a positive number.".format(name))
+	return value if limit is None else min(value, limit)
+
+
+### Server
+
+class SolveServer:
+
+	def __init__(self, workers=None, max_passes=100, timeout=10.0, rules=DEFAULT_RULES):
+		self.pool = ProcessPoolExecutor(max_workers=workers)
+		self.max_passes = max_passes	# most passes any request may use (None: no limit)
+		self.timeout = timeout			# most seconds any request may wait for its result
+		self.rules = rules				# rules used when a request names none
+		self.in_flight = {}				# (grid key, rules, engine, max_passes) -> future of the solve in progress
+		self.stats = {"requests": 0, "solves": 0, "coalesced": 0, "timeouts": 0, "errors": 0}
+		self.server = None
+
+	async def start(self, host="127.0.0.1", port=8080):
+		self.server = await asyncio.start_server(self.handle_connection, host, port)
+		return self.server
+
+	async def close(self):
+		if self.server is not None:
+			self.server.close()
+			await self.server.wait_closed()
+		self.pool.shutdown(wait=False)
+
+	async def handle_connection(self, reader, writer):	# serve requests on one connection until it closes
+		try:
+			while True:
+				keep_alive = False
+				try:
+					request = await read_request(reader)
+					if request is None:
+						break
+					method, path, query, headers, body = request
+					keep_alive = headers["http-version"] == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+					status, reply = await self.route(method, path, query, headers, body)
+				except RequestError as error:
+					status, reply = error.status, {"error": str(error)}
+				except (ValueError, asyncio.IncompleteReadError):
+					status, reply = 400, {"error": "Malformed request."}
+				if status != 200:
+					self.stats["errors"] += 1
+				send_reply(writer, status, reply, keep_alive)
+				await writer.drain()
+				if not keep_alive:
+					break
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+	async def route(self, method, path, query, headers, body):
+		if path == "/solve":
+			if method != "POST":
+				raise RequestError(405, "Use POST to solve.")
+			self.stats["requests"] += 1
+			return 200, await self.solve_request(parse_solve_request(query, headers, body))
+		if path == "/stats":
+			return 200, dict(self.stats, in_flight=len(self.in_flight))
+		raise RequestError(404, "No such path: {}".format(path))
+
+	async def solve_request(self, options):
+		key = grid_key(options["grid"])
+		rules = options.get("rules") or self.rules
+		if not isinstance(rules, str) or [rule for rule in rules if rule not in RULE_ORDER and not rule.isspace()]:
+			raise RequestError(400, "Rules must be characters of {}.".format(RULE_ORDER))
+		engine = options.get("engine", "passes")
+		if not isinstance(engine, str) or engine not in ENGINES:
+			raise RequestError(400, "Engine must be one of {}.".format(", ".join(sorted(ENGINES))))
+		max_passes = number_option(options, "max_passes", self.max_passes)
+		timeout = number_option(options, "timeout", self.timeout, float)
+		job = (key, normal_rules(rules), engine, max_passes)
+		deadline = time.time() + timeout
+		while True:
+			future = self.in_flight.get(job)
+			coalesced = future is not None
+			if coalesced:
+				self.stats["coalesced"] += 1
+			else:
+				self.stats["solves"] += 1
+				future = asyncio.get_running_loop().run_in_executor(self.pool, solve_job, *job, deadline)
+				self.in_flight[job] = future
+				future.add_done_callback(lambda done: self.in_flight.pop(job, None))
+			try:	# shield: the solve outlives this request
+				result = await asyncio.wait_for(asyncio.shield(future), max(deadline - time.time(), 0))
+			except asyncio.TimeoutError:
+				result = None
+			except Contradiction as error:
+				raise RequestError(422, "Grid has no solution: {}".format(error))
+			except Exception as error:		# e.g. a worker process died
+				raise RequestError(500, "Solve failed: {}".format(error))
+			if result is not None:
+				return dict(result, coalesced=coalesced)
+			if not coalesced or time.time() >= deadline:	# out of time, here or in the worker
+				self.stats["timeouts"] += 1
+				raise RequestError(504, "Not solved within the time budget of {} seconds.".format(timeout))
+			# the shared solve ran out of its request's time, but this one has some left: solve again
+
+def send_reply(writer, status, reply, keep_alive):
+	body = json.dumps(reply).encode("utf-8")
+	head = "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+		status, REASONS.get(status, ""), len(body), "keep-alive" if keep_alive else "close")
+	writer.write(head.encode("latin-1") + body)
+
+
+### Main driver
+
+async def serve(args):
+	workers = args.workers or os.cpu_count()
+	server = SolveServer(workers, args.max_passes or None, args.timeout, args.rules)
+	await server.start(args.host, args.port)
+	print("Solving sudokus at http://{}:{}/solve with {} workers.".format(args.host, args.port, workers))
+	try:
+		await asyncio.Event().wait()	# serve until interrupted
+	finally:
+		await server.close()
+
+def main():
+	parser = argparse.ArgumentParser(description="Serve the sudoku solver over HTTP/JSON.")
+	parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default 127.0.0.1)")
+	parser.add_argument("--port", type=int, default=8080, help="port to listen on (default 8080)")
+	parser.add_argument("--workers", type=int, default=0, metavar="N", help="solve on N worker processes (default: one per CPU)")
+	parser.add_argument("--max-passes", type=int, default=100, metavar="N",
+		help="most passes a request may use (default 100; 0 = no limit)")
+	parser.add_argument("--timeout", type=float, default=10.0, metavar="SECONDS",
+		help="most time a request may wait for its result (default 10)")
+	parser.add_argument("--rules", default=DEFAULT_RULES, help="rules used when a request names none (default {})".format(DEFAULT_RULES))
+	args = parser.parse_args()
+	try:
+		asyncio.run(serve(args))
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,158 @@
+import os
+import time
+from array import array
+from itertools import islice
+from multiprocessing import shared_memory
+from sudoku import ALL_DIGITS, DIGIT_BIT, MASK_COUNT, grid_to_lines, sudoku_from_masks
+from sudoku_solver import RuleProfiler, chunk_records, get_engine, read_puzzle_texts
+
+# Shared-memory puzzle batches: puzzles handed to worker processes without pickling them.
+#
+# The parent writes a batch of puzzles -- each one's rules and 81 candidate masks -- into a block of shared memory.
+# Each worker is sent only the block's name and a range of puzzle numbers; it solves those puzzles and writes each
+# one's final candidates, status, passes, and time back into the block, where the parent reads them.  All that is
+# pickled is a few numbers each way per chunk, whatever the chunk holds.
+#
+# A block for capacity puzzles holds one array per field, each starting on an 8-byte boundary:
+#
+#   seconds  capacity d          time each solve took
+#   masks    capacity * 81 H     candidate masks (bit n-1 set when digit n is possible, as in sudoku.py): the givens
+#                                going in, the final candidates coming out
+#   passes   capacity H
+#   status   capacity B          0 not solved yet, 1 solved, 2 stuck (as in sudoku_pack.py)
+#   rules    capacity * 16 s     the "Rules" line's text, zero-padded
+#
+# A long file is solved a batch at a time through two blocks, so memory stays flat however many puzzles it has: while
+# the workers solve the batch in one block, the parent reads the next batch into the other.  The same pool of
+# workers solves every batch.
+
+BATCH_CAPACITY = 4096				# puzzles per batch
+RULES_SIZE = 16
+CELL_MASKS = dict([(str(n), DIGIT_BIT[n]) for n in range(1, 10)] + [(c, ALL_DIGITS) for c in "-_ "])
+
+def block_layout(capacity):			# (offset of each array by name, total size in bytes)
+	layout = {}
+	offset = 0
+	for name, size in (("seconds", 8), ("masks", 162), ("passes", 2), ("status", 1), ("rules", RULES_SIZE)):
+		layout[name] = offset
+		offset += (capacity * size + 7) // 8 * 8
+	return layout, offset
+
+def grid_masks(grid_text):			# the 81 candidate masks of a grid given as text, without making a Sudoku
+	masks = array("H")
+	for line in grid_to_lines(grid_text):
+		if len(line) < 9:
+			raise Exception ("Grid line {!r} has fewer than 9 cells.".format(line))
+		for c in line[:9]:
+			if c not in CELL_MASKS:
+				raise Exception ("Invalid character {} in input.".format(c))
+			masks.append(CELL_MASKS[c])
+	return masks
+
+class SharedBatch:
+
+	# Make a new block for capacity puzzles, or with name, attach to one another process made
+	def __init__(self, capacity=BATCH_CAPACITY, name=None):
+		layout, size = block_layout(capacity)
+		self.owner = name is None
+		self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+		self.name = self.shm.name
+		self.capacity = capacity
+		self.count = 0				# puzzles in the batch now
+		buf = self.shm.buf
+		self.seconds = buf[layout["seconds"]:layout["seconds"] + capacity * 8].cast("d")
+		self.masks = buf[layout["masks"]:layout["masks"] + capacity * 162].cast("H")
+		self.passes = buf[layout["passes"]:layout["passes"] + capacity * 2].cast("H")
+		self.status = buf[layout["status"]:layout["status"] + capacity]
+		self.rules = buf[layout["rules"]:layout["rules"] + capacity * RULES_SIZE]
+
+	# Parent side: fill the block with (rules_to_use, grid_text) puzzles, at most capacity of them.  Returns how many.
+	def load(self, puzzles):
+		self.count = 0
+		for rules_to_use, grid_text in islice(puzzles, self.capacity):
+			i = self.count
+			rules = rules_to_use.encode("ascii")
+			if len(rules) > RULES_SIZE:
+				raise Exception ("Rules {} do not fit in a shared batch.".format(rules_to_use))
+			self.rules[i * RULES_SIZE:(i + 1) * RULES_SIZE] = rules.ljust(RULES_SIZE, b"\0")
+			self.masks[i * 81:i * 81 + 81] = grid_masks(grid_text)
+			self.status[i] = 0
+			self.count += 1
+		return self.count
+
+	def get_rules(self, i):
+		return bytes(self.rules[i * RULES_SIZE:(i + 1) * RULES_SIZE]).rstrip(b"\0").decode("ascii")
+
+	def get_sudoku(self, i):
+		return sudoku_from_masks(self.masks[i * 81:i * 81 + 81])
+
+	def put_result(self, i, s, solved, passes, seconds):	# worker side: puzzle i's outcome, in place
+		self.masks[i * 81:i * 81 + 81] = array("H", s.get_cands())
+		self.status[i] = 1 if solved else 2
+		self.passes[i] = passes
+		self.seconds[i] = seconds
+
+	def record(self, i, number):	# parent side: puzzle i's result record, as solve_record makes
+		return {"puzzle": number, "rules": self.get_rules(i), "solved": self.status[i] == 1, "passes": self.passes[i],
+			"candidates": sum(map(MASK_COUNT.__getitem__, self.masks[i * 81:i * 81 + 81])), "seconds": self.seconds[i]}
+
+	def close(self):				# let go of the block; the process that made it also frees it
+		for view in (self.seconds, self.masks, self.passes, self.status, self.rules):
+			view.release()
+		self.shm.close()
+		if self.owner:
+			self.shm.unlink()
+
+
+### Worker side
+
+ATTACHED = {}		# block name -> SharedBatch, kept attached in each worker process for the chunks that follow
+
+def attached_batch(name, capacity):
+	if name not in ATTACHED:
+		ATTACHED[name] = SharedBatch(capacity, name)
+	return ATTACHED[name]
+
+# Solve puzzles start to stop - 1 of the block name, in place.  Returns (the puzzle numbers, profile_dict) like
+# solve_chunk: the parent reads the records themselves from the block.
+def solve_shared_chunk(name, capacity, start, stop, engine="passes", profiling=False):
+	batch = attached_batch(name, capacity)
+	profile = RuleProfiler() if profiling else None
+	solver = get_engine(engine)
+	for i in range(start, stop):
+		s = batch.get_sudoku(i)
+		begin = time.perf_counter()
+		solved, passes = solver(s, batch.get_rules(i), verbose=False, profile=profile)
+		batch.put_result(i, s, solved, passes, time.perf_counter() - begin)
+	return range(start, stop), profile.as_dict() if profiling else None
+
+
+### Batch solving
+
+def submit_batch(pool, batch, chunk_size, engine, profiling):	# a job on pool for each chunk of batch; their futures
+	return [pool.submit(solve_shared_chunk, batch.name, batch.capacity, start, min(start + chunk_size, batch.count), engine,
+		profiling) for start in range(0, batch.count, chunk_size)]
+
+# Solve every puzzle in an open file on a pool of worker processes through shared blocks of capacity puzzles,
+# chunk_size puzzles to a job, yielding one result record per puzzle like solve_batch_parallel.
+def solve_batch_shared(ifile, workers=None, chunk_size=50, ordered=True, engine="passes", profile=None,
+		capacity=BATCH_CAPACITY):
+	from concurrent.futures import ProcessPoolExecutor, as_completed	# here, not at the top: slow to import
+	puzzles = read_puzzle_texts(ifile)
+	batches = [SharedBatch(capacity), SharedBatch(capacity)]
+	try:
+		with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+			batch, spare = batches
+			batch.load(puzzles)
+			number = 0
+			while batch.count:
+				futures = submit_batch(pool, batch, chunk_size, engine, profile is not None)
+				spare.load(puzzles)		# read the next batch while the workers solve this one
+				for future in futures if ordered else as_completed(futures):
+					for i in chunk_records(future, profile):
+						yield batch.record(i, number + i + 1)
+				number += batch.count
+				batch, spare = spare, batch
+	finally:
+		for batch in batches:
+			batch.close()
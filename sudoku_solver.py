@@ -1,5 +1,12 @@
-from itertools import combinations
-from sudoku import Sudoku, Cell  # import Sudoku and Cell classes
+import io
+import os
+import struct
+import sys
+import time
+from collections import deque
+from functools import partial
+from itertools import combinations, islice
+from sudoku import Sudoku, Cell, BOX_OF, CELL_UNITS, COMMON_PEERS, DIGIT_BIT, MASK_COUNT, MASK_DIGITS, PEER_BITS, PEERS, SEES, UNIT_INDICES, digits_to_mask, sudoku_from_grid  # import Sudoku and Cell classes
 
 
 ### Sudoku Logic Rules -- operate on containers (row/col/box)
@@ -7,21 +14,34 @@ from sudoku import Sudoku, Cell  # import Sudoku and Cell classes
 # Logic Rule 0: Naked single - Settled cells eliminate those options elsewhere in container (row/col/box)
 def logic_rule_0(s, container):
 	settled = [cell.get_possible()[0] for cell in container if cell.number_of_options() == 1] # Get numbers for settled cells
+	recorder = s.recorder
+	if recorder is not None:
+		recorder.begin("0", digits_to_mask(settled), [cell.get_index() for cell in container if cell.number_of_options() == 1])
 	for j in range(9):	# delete known numbers as possibilities in other cells of container
-		before = container[j].number_of_options()
-		if before != 1:
+		before = container[j].get_mask()
+		if MASK_COUNT[before] != 1:
 			container[j].remove_possible(settled)
-			if before > container[j].number_of_options():	# did we actually remove any options?
+			if before != container[j].get_mask():	# did we actually remove any options?
 				s.set_changed()		# yes; flag that we made a change
+				if recorder is not None:
+					recorder.removed(container[j], before)
+	if recorder is not None:
+		recorder.end()
 
 # Logic Rule 1: Hidden single - Numbers confined to only one cell in container (row/col/box) can be settled
 def logic_rule_1(s, container):
-	tally_d = make_tally_d(container)
-	for n in tally_d:
-		if len(tally_d[n]) == 1:	#if n is possible in only 1 cell
-			if container[tally_d[n][0]].number_of_options() != 1: # and cell isn't settled, set to n
-				container[tally_d[n][0]].set_possible([n])
+	positions = make_position_masks(container)	# shared with rule 4 (hidden n-ples)
+	for n in range(1, 10):
+		if MASK_COUNT[positions[n]] == 1:	#if n is possible in only 1 cell
+			cell = container[MASK_DIGITS[positions[n]][0] - 1]
+			if cell.number_of_options() != 1: # and cell isn't settled, set to n
+				before = cell.get_mask()
+				cell.set_possible([n])
 				s.set_changed()		# flag that we made a change
+				if s.recorder is not None:
+					s.recorder.begin("1", DIGIT_BIT[n], [cell.get_index()])
+					s.recorder.removed(cell, before)
+					s.recorder.end()
 				
 # Logic Rule 2: Naked pair -- Two cells in container with same 2 options eliminate those options elsewhere in container
 def logic_rule_2(s, container):
@@ -29,11 +49,19 @@ def logic_rule_2(s, container):
 	dup_pairs = set([tuple(pair) for pair in pair_list if pair_list.count(pair) == 2])
 	while dup_pairs:
 		pair = list(dup_pairs.pop())
+		recorder = s.recorder
+		if recorder is not None:
+			recorder.begin("2", digits_to_mask(pair), [cell.get_index() for cell in container if cell.get_possible() == pair])
 		for cell in container:
 			cell_possible = cell.get_possible()
 			if cell_possible != pair and (set(pair) & set(cell_possible)):			
+				before = cell.get_mask()
 				cell.remove_possible(pair)
 				s.set_changed()		# flag that we made a change
+				if recorder is not None:
+					recorder.removed(cell, before)
+		if recorder is not None:
+			recorder.end()
 
 # Logic Rule 3: Naked triple -- Three cells in container with only 3 options between them eliminate those options
 #								elsewhere in container
@@ -44,44 +72,70 @@ def logic_rule_3(s, container):
 		for trio in possible_trios:
 			trio_digits = set(trio[0][1]) | set(trio[1][1]) | set(trio[2][1])
 			if len(trio_digits) == 3:
+				recorder = s.recorder
+				if recorder is not None:
+					recorder.begin("3", digits_to_mask(trio_digits), [trio[k][0].get_index() for k in range(3)])
 				for cell in container:					# Remove extra values from other cells in container
 					if cell != trio[0][0] and cell != trio[1][0] and cell != trio[2][0]:
 						if trio_digits & set(cell.get_possible()):		
+							before = cell.get_mask()
 							cell.remove_possible(trio_digits)
 							s.set_changed()		# flag that we made a change
+							if recorder is not None:
+								recorder.removed(cell, before)
+				if recorder is not None:
+					recorder.end()
 
 # Logic Rule 4: Hidden n-ples -- If N numbers are confined to N cells in a container, other options in those cells
 #				(not so confined) can be eliminated
+#				Works on digit position masks (bit i set if the digit is possible in container[i]) and only tries combos
+#				of digits that could qualify: a digit must be possible in at least 2 and at most N cells, and the
+#				digits of a partial combo must not already span more than N cells.
 def logic_rule_4(s, container):
-	group_name_d = {2: "pair", 3:"trio", 4:"quartet", 5:"quintet", 6:"sextet", 7:"septet"}
 	for N in range(2,8):
-		l = list(combinations([1,2,3,4,5,6,7,8,9],N))	# Make list of all combos of 1-9 taken N at a time
-		combos_d = {}									# Create blank dictionary
-		for t in l:										# Load dictionary with empty list for each combo
-			combos_d[t] = []
-		for combo in combos_d:							# For each combo, record all cells with possible
-			for i in range(9):								# ... values matching any numbers in combo
-				if set(combo) & set(container[i].get_possible()): # Non-empty set?  
-					combos_d[combo].append(i)				# Number in combo is in cell.  Add cell index to combo's list.
-		for combo in combos_d:							# Check each combo in dictionary
-			if len(combos_d[combo]) == N:					# Are combo's numbers found in only N cells in container?
-				cell_index_list = combos_d[combo]			# Yes.  Check if cells also have numbers not in combo.
-				nested_possibles = [container[cell].get_possible() for cell in cell_index_list]	# All cells' possible lists
-				flat_possibles = []						# Start with null list
-				for sublist in nested_possibles:		# Flatten nested list of possible #s for the N cells
-					flat_possibles += sublist
-				if set(combo) < set(flat_possibles):		# Does possible set include numbers not in combo?
-					if [flat_possibles.count(n) for n in combo if flat_possibles.count(n) < 2]: # Yes. If any of combo's...
-						continue						# ... numbers not in at least 2 of N cells, skip this combo
-				else:
-					continue 							# Possibles include no options not in combo; skip this combo
-				# If we get here, this combo passed all the tests
-				for cell_index in cell_index_list:		# Remove extra options from those cells.
-					old_possible = container[cell_index].get_possible()
-					diff = set(old_possible).difference(set(combo))
-					if diff:
-						container[cell_index].remove_possible(diff)
-						s.set_changed()		# flag that we made a change
+		positions = make_position_masks(container)	# Where each number is possible, as of the start of this N
+		digits = [n for n in range(1, 10) if 2 <= MASK_COUNT[positions[n]] <= N]
+		if len(digits) >= N:
+			hidden_nple_search(s, container, N, digits, positions, 0, [], 0)
+
+# Hidden n-ple search: extend combo (digits found so far, spanning the cells in span) with digits[start:], trying
+#				combos in the same order as combinations(1..9, N) would, and apply each complete combo that qualifies
+def hidden_nple_search(s, container, N, digits, positions, start, combo, span):
+	for k in range(start, len(digits) - (N - len(combo)) + 1):
+		new_span = span | positions[digits[k]]
+		if MASK_COUNT[new_span] > N:			# combo's numbers already found in more than N cells
+			continue
+		new_combo = combo + [digits[k]]
+		if len(new_combo) < N:
+			hidden_nple_search(s, container, N, digits, positions, k + 1, new_combo, new_span)
+		elif MASK_COUNT[new_span] == N:			# combo's numbers found in only N cells in container
+			hidden_nple_apply(s, container, new_combo, MASK_DIGITS[new_span])
+
+def hidden_nple_apply(s, container, combo, cell_bits):
+	cell_index_list = [i - 1 for i in cell_bits]	# Position-mask digit d stands for container[d - 1]
+	combo_mask = digits_to_mask(combo)
+	flat_mask = 0
+	for i in cell_index_list:
+		flat_mask |= container[i].get_mask()
+	if flat_mask & combo_mask != combo_mask or not flat_mask & ~combo_mask:
+		return						# Possibles include no options not in combo (or lack one of combo's numbers)
+	for n in combo:					# If any of combo's numbers not in at least 2 of N cells, skip this combo
+		if len([i for i in cell_index_list if container[i].is_possible(n)]) < 2:
+			return
+	# If we get here, this combo passed all the tests
+	recorder = s.recorder
+	if recorder is not None:
+		recorder.begin("4", combo_mask, [container[i].get_index() for i in cell_index_list])
+	for i in cell_index_list:		# Remove extra options from those cells.
+		before = container[i].get_mask()
+		diff = before & ~combo_mask
+		if diff:
+			container[i].remove_possible(MASK_DIGITS[diff])
+			s.set_changed()		# flag that we made a change
+			if recorder is not None:
+				recorder.removed(container[i], before)
+	if recorder is not None:
+		recorder.end()
 
 # Logic Rule 5rc: Single locked in row/col -- If a number in a row or col is confined to a single box,
 #				that number can be eliminated elsewhere in the box (AKA pointing pairs & triples)
@@ -93,7 +147,7 @@ def logic_rule_5rc(s, row_or_col, boxes):
 			cell_list = [row_or_col[i] for i in i_list]	# get list of cells from indices
 			box_index_list = [cell.get_box() for cell in cell_list]	# get list of all boxes the cells are in
 			if len(set(box_index_list)) == 1:	# if all the cells are in the same box...
-				eliminate_elsewhere_in_container(s, n, cell_list, boxes[box_index_list[0]]) #cut options elsewhere in box
+				eliminate_elsewhere_in_container(s, n, cell_list, boxes[box_index_list[0]], "5") #cut options elsewhere in box
 
 # Logic Rule 5b: Single locked in box -- If a number in a box is confined to a single row or col,
 #				that number can be eliminated elsewhere in the row or column (AKA pointing pairs & triples)
@@ -105,96 +159,101 @@ def logic_rule_5b(s, box, rows, cols):
 			cell_list = [box[i] for i in i_list]	# get list of cells from indices
 			row_index_list = [cell.get_row() for cell in cell_list]	# get list of all rows the cells are in
 			if len(set(row_index_list)) == 1:	# if all the cells are in the same row...
-				eliminate_elsewhere_in_container(s, n, cell_list, rows[row_index_list[0]]) # cut options elsewhere in row
+				eliminate_elsewhere_in_container(s, n, cell_list, rows[row_index_list[0]], "5") # cut options elsewhere in row
 			col_index_list = [cell.get_col() for cell in cell_list] # get list of cols the cells are in
 			if len(set(col_index_list)) == 1:	# if all the cells are in the same col...
-				eliminate_elsewhere_in_container(s, n, cell_list, cols[col_index_list[0]]) # cut options elsewhere in col
+				eliminate_elsewhere_in_container(s, n, cell_list, cols[col_index_list[0]], "5") # cut options elsewhere in col
 
 # Logic Rule 6: X-wing -- if 2 rows have the same number possible in only the same 2 cols (i.e., they are a conjugate pair) 
 #				delete that number from other cells of those cols (replace "row" with "col" and vice-versa to apply to cols)
-def logic_rule_6(s, rows, cols, direction):		# direction parameter used only to select debugging printout
-	tally_d_list = [make_tally_d(row) for row in rows]  #make a tally_d_list for every row
-	tally_d_list_pairs = [{},{},{},{},{},{},{},{},{}]   #create list of empty sets for recording conjugate pairs
-	for i in range(9):
-		for n in tally_d_list[i]:
-			if len(tally_d_list[i][n]) == 2:	# Find all numbers that occur exactly 2x in row (conjugate pairs)
-				tally_d_list_pairs[i][n] = tally_d_list[i][n]
-	for i in range(8):						#Check list of row-dictionaries, looking for X-wing. Impossible after 2nd-to-last row.
-		for n in tally_d_list_pairs[i]:		# find digits that occur in same 2 cols of 2 different rows
-			for j in range(i+1, 9):			# does n occur in same 2 cols in a later row?
-				if n in tally_d_list_pairs[j] and tally_d_list_pairs[j][n] == tally_d_list_pairs[i][n]:
-					print("Found X-wing!")
-					if direction == 'r':
-						print("  {} is in cols {} and {} of rows {} and {}".format(n, tally_d_list_pairs[i][n][0], tally_d_list_pairs[i][n][1], i, j))
-					else:
-						print("  {} is in rows {} and {} of cols {} and {}".format(n, tally_d_list_pairs[i][n][0], tally_d_list_pairs[i][n][1], i, j))
-					#Delete the candidate digit from other cells in the two cols
-					col_l = cols[tally_d_list_pairs[j][n][0]]	# Left col (or upper row)
-					cell_list_l = [col_l[i], col_l[j]]
-					eliminate_elsewhere_in_container(s, n, cell_list_l, col_l) # cut n elsewhere in left col
-					col_r = cols[tally_d_list_pairs[i][n][1]]	# Right col (or lower row)
-					cell_list_r = [col_r[i], col_r[j]]
-					eliminate_elsewhere_in_container(s, n, cell_list_r, col_r) # cut n elsewhere in right col
+def logic_rule_6(s, rows, cols, direction):		# direction: 'r' if rows are the rows, 'c' if they are the cols
+	logic_rule_fish(s, 2, rows, cols, direction)
 
 # Logic Rule 7: Swordfish -- if 3 rows have the same number possible in only the SAME 2 or 3 cols, delete that
 #				number from other cells of those cols (replace "row" with "col" and vice-versa to apply to cols)
-def logic_rule_7(s, rows, cols, direction):		# direction parameter used only to select debugging printout
-	tally_d_list = [make_tally_d(row) for row in rows]
-	tally_d_list_pairs_and_trios = [{},{},{},{},{},{},{},{},{}]
-	for i in range(9):
-		for n in tally_d_list[i]:
-			times_in_row = len(tally_d_list[i][n])
-			if times_in_row == 2 or times_in_row == 3:	# Record numbers that occur 2x or 3x in row
-				tally_d_list_pairs_and_trios[i][n] = tally_d_list[i][n]
-	for i in range(7):			# Check list of row-dictionaries, looking for swordfish. Impossible after 3rd-to-last row.
-		for n in tally_d_list_pairs_and_trios[i]:		# find numbers that occur in same 2 or 3 cols of 3 different rows
-			for j in range(i+1, 8):			# does n occur in same 2 or 3 cols in a later row?
-				if n in tally_d_list_pairs_and_trios[j] and len(set(tally_d_list_pairs_and_trios[j][n]) & set(tally_d_list_pairs_and_trios[i][n])) >= 1:
-					for k in range(j+1, 9):
-						if n in tally_d_list_pairs_and_trios[k] and len(set(tally_d_list_pairs_and_trios[k][n]) & set(tally_d_list_pairs_and_trios[j][n])) >= 1:
-							col_list = list(set(tally_d_list_pairs_and_trios[k][n]) | set(tally_d_list_pairs_and_trios[j][n]) | set(tally_d_list_pairs_and_trios[i][n]))
-							if len(col_list) == 3:
-								print("Found swordfish!")
-								if direction == 'r':
-									print("  {} is in cols {} of rows {}, {}, and {}".format(n, col_list, i, j, k))
-								else:
-									print("  {} is in rows {} of cols {}, {}, and {}".format(n, col_list, i, j, k))
-								#Delete the candidate digit from other cells in the three cols
-								col_l = cols[col_list[0]]	# Left col (or top row)
-								cell_list_l = [col_l[i], col_l[j], col_l[k]]
-								eliminate_elsewhere_in_container(s, n, cell_list_l, col_l) # cut n elsewhere in left col (top row)
-								col_m = cols[col_list[1]]	# Middle col (or middle row)
-								cell_list_m = [col_m[i], col_m[j], col_m[k]]
-								eliminate_elsewhere_in_container(s, n, cell_list_m, col_m) # cut n elsewhere in middle col (middle row)
-								col_r = cols[col_list[2]]	# Right col (or bottom row)
-								cell_list_r = [col_r[i], col_r[j], col_r[k]]
-								eliminate_elsewhere_in_container(s, n, cell_list_r, col_r) # cut n elsewhere in right col (bottom row)
+def logic_rule_7(s, rows, cols, direction):		# direction: 'r' if rows are the rows, 'c' if they are the cols
+	logic_rule_fish(s, 3, rows, cols, direction)
+
+# Logic Rule C: Jellyfish -- if 4 rows have the same number possible in only the SAME 2, 3 or 4 cols, delete that
+#				number from other cells of those cols (replace "row" with "col" and vice-versa to apply to cols)
+def logic_rule_C(s, rows, cols, direction):		# direction: 'r' if rows are the rows, 'c' if they are the cols
+	logic_rule_fish(s, 4, rows, cols, direction)
+
+# Basic fish of any size (2 X-wing, 3 Swordfish, 4 Jellyfish): if size rows each have number n possible in 2 to size
+# cols, and together in only size cols, n can be deleted from the other cells of those cols.  Each row's positions
+# of each number are a bitmask (bit j set if possible in col j), so a set of rows is a fish when the OR of their
+# masks has size bits set.  All fish are found from the candidates as they were when the rule was called; the masks
+# are the rows' (cols') slices of the link graph's positions.
+FISH_NAMES = {2: "X-wing", 3: "swordfish", 4: "jellyfish"}
+FISH_RULES = {2: "6", 3: "7", 4: "C"}
+
+def logic_rule_fish(s, size, rows, cols, direction):
+	positions = link_graph(s).positions
+	first = 0 if direction == 'r' else 9		# rows are units 0-8, cols units 9-17
+	for n in range(1, 10):
+		row_cols = positions[n][first:first + 9]
+		base = [i for i in range(9) if 2 <= MASK_COUNT[row_cols[i]] <= size]
+		if len(base) >= size:
+			find_fish(s, size, n, row_cols, base, 0, [], 0, cols, direction)
+
+# Extend fish_rows (whose possible cols for n are fish_cols) with rows from base[start:] until there are size rows
+def find_fish(s, size, n, row_cols, base, start, fish_rows, fish_cols, cols, direction):
+	if len(fish_rows) == size:
+		if MASK_COUNT[fish_cols] == size:
+			eliminate_fish(s, n, row_cols, fish_rows, fish_cols, cols, direction)
+		return
+	for k in range(start, len(base) - (size - len(fish_rows)) + 1):
+		i = base[k]
+		if MASK_COUNT[fish_cols | row_cols[i]] <= size:		# more than size cols can't make a fish
+			fish_rows.append(i)
+			find_fish(s, size, n, row_cols, base, k + 1, fish_rows, fish_cols | row_cols[i], cols, direction)
+			fish_rows.pop()
+
+def eliminate_fish(s, n, row_cols, fish_rows, fish_cols, cols, direction):
+	col_list = [j - 1 for j in MASK_DIGITS[fish_cols]]
+	s.trace("Found {}!".format(FISH_NAMES[len(fish_rows)]))
+	lines, covers = ("rows", "cols") if direction == 'r' else ("cols", "rows")
+	if len(fish_rows) == 2:
+		s.trace("  {} is in {} {} and {} of {} {} and {}".format(n, covers, col_list[0], col_list[1], lines, fish_rows[0], fish_rows[1]))
+	else:
+		row_text = ", ".join([str(i) for i in fish_rows[:-1]]) + ", and " + str(fish_rows[-1])
+		s.trace("  {} is in {} {} of {} {}".format(n, covers, col_list, lines, row_text))
+	if [i for i in range(9) if i not in fish_rows and row_cols[i] & fish_cols]:	# anything to delete?
+		recorder = s.recorder
+		if recorder is not None:
+			recorder.begin(FISH_RULES[len(fish_rows)], DIGIT_BIT[n],
+				[cols[j][i].get_index() for i in fish_rows for j in col_list if cols[j][i].is_possible(n)])
+		for j in col_list:					# Delete the candidate digit from other cells in the fish's cols
+			eliminate_elsewhere_in_container(s, n, [cols[j][i] for i in fish_rows], cols[j])
+		if recorder is not None:
+			recorder.end()
 
 # Logic Rule 8: Y-wing -- if 3 cells (A, B, C) contain only 2 numbers each, and cell A contains XY and sees
 #				cells B and C, and cells B and C contain XZ and YZ and don't see each other, then Z can be
 #				eliminated from any other cell that sees both cells B and C.
 def logic_rule_8(s):
-	rows = s.get_rows()
-	pair_cells = []
-	for row in rows:	# Make a list of all cells containing two candidates
-		pair_cells.extend([cell for cell in row if cell.number_of_options() == 2])
-	for cell in pair_cells: # search cell's containers for pair-cells sharing 1 of its 2 options
-		if cell.number_of_options() == 2:	# Needed because pair-cells may lose options during this loop
-			possible_wing_cells = [c for c in pair_cells if cell.sees(c) and len(c.get_possible()) == 2 and len(set(cell.get_possible()) & set(c.get_possible())) == 1]
+	cells = s.cells
+	cands = s.get_cands()
+	graph = link_graph(s)
+	was_pair = graph.is_bivalue		# Note all cells containing two candidates
+	for c in graph.bivalue: # search cell's containers (its peers) for pair-cells sharing 1 of its 2 options
+		if MASK_COUNT[cands[c]] == 2:	# Needed because pair-cells may lose options during this loop
+			possible_wing_cells = [w for w in PEERS[c] if was_pair[w] and MASK_COUNT[cands[w]] == 2 and MASK_COUNT[cands[c] & cands[w]] == 1]
 			# search possible_wing_cells for two that don't see each other, and one has x, one has y, and they both have z
 			# if only two possible wing cells, check if they see each other, and if not, if one has x, the other has y
 			for i in range(len(possible_wing_cells)):
 				for j in range(i+1, len(possible_wing_cells)):
-					if len(set(cell.get_possible()) | set(possible_wing_cells[i].get_possible()) | set(possible_wing_cells[j].get_possible())) == 3:
-						if not possible_wing_cells[i].sees(possible_wing_cells[j]) and possible_wing_cells[i].get_possible() != possible_wing_cells[j].get_possible():
-							print("Found Y-wing!")
-							print("  Wing cells: ", possible_wing_cells[i], possible_wing_cells[j])
-							z = list(set(possible_wing_cells[i].get_possible()) & set(possible_wing_cells[j].get_possible()))
-							print("  z =", z[0])
-							# Get list of cells both wing-cells can affect.
-							# List cells that each wing-cell can see, convert to sets and take intersection.
-							possible_affected_cells = list(can_see(s, possible_wing_cells[i]) & can_see(s, possible_wing_cells[j]))
-							eliminate_n_in_affected_cells(s, z[0], possible_affected_cells)
+					wing_i = possible_wing_cells[i]
+					wing_j = possible_wing_cells[j]
+					if MASK_COUNT[cands[c] | cands[wing_i] | cands[wing_j]] == 3:
+						if not SEES[wing_i][wing_j] and cands[wing_i] != cands[wing_j]:
+							s.trace("Found Y-wing!")
+							s.trace("  Wing cells: ", cells[wing_i], cells[wing_j])
+							z = MASK_DIGITS[cands[wing_i] & cands[wing_j]]
+							s.trace("  z =", z[0])
+							# Get list of cells both wing-cells can affect (from the precomputed common-peer table)
+							possible_affected_cells = [cells[k] for k in COMMON_PEERS[wing_i][wing_j]]
+							eliminate_n_in_affected_cells(s, z[0], possible_affected_cells, "8", [c, wing_i, wing_j])
 
 # Logic Rule 9: Skyscraper -- Find two columns (or rows) that contain a conjugate pair of the same digit as candidates.
 #				If two of those candidate digits are in the same row (or column), they form the "base" of the skyscraper
@@ -202,76 +261,69 @@ def logic_rule_8(s):
 #				one of the two roof cells will be the candidate digit, so that digit can be eliminated in any other cell 
 #				that sees both roof cells.
 def logic_rule_9(s, cols, rows, direction):
-	tally_d_list = [make_tally_d(col) for col in cols]  #make a tally_d_list for every col
-	tally_d_list_pairs = [{},{},{},{},{},{},{},{},{}]   #create list of empty sets for recording conjugate pairs
+	positions = link_graph(s).positions
+	first = 9 if direction == 'c' else 0	# cols are units 9-17, rows units 0-8
+	conj_pairs = [{},{},{},{},{},{},{},{},{}]	# conj_pairs[i][n]: positions mask of n in col i, if n occurs there exactly 2x
 	for i in range(9):
-		for n in tally_d_list[i]:
-			if len(tally_d_list[i][n]) == 2:	# Find all numbers that occur exactly 2x in col (conjugate pairs)
-				tally_d_list_pairs[i][n] = tally_d_list[i][n]
+		for n in range(1, 10):
+			if MASK_COUNT[positions[n][first + i]] == 2:	# Find all numbers that occur exactly 2x in col (conjugate pairs)
+				conj_pairs[i][n] = positions[n][first + i]
 	for i in range(8):						#Check list of col-dictionaries, looking for skyscraper. Impossible after 2nd-to-last col.
-		for n in tally_d_list_pairs[i]:		# find conjugate pairs of same digit in two cols that share one row
+		for n in conj_pairs[i]:				# find conjugate pairs of same digit in two cols that share one row
 			for j in range(i+1, 9):			# look for second col containing same conjugate pair sharing only 1 row
-				if n in tally_d_list_pairs[j]:
-					conjugatepair1 = tally_d_list_pairs[i][n]
-					conjugatepair2 = tally_d_list_pairs[j][n]
-					intersection = set(conjugatepair1) & set(conjugatepair2)
-					if len(intersection) == 1:
-						print("Found possible skyscraper", end=" ")
-						base = intersection.pop()
+				if n in conj_pairs[j]:
+					conjugatepair1 = [k - 1 for k in MASK_DIGITS[conj_pairs[i][n]]]	# rows of the pair in col i
+					conjugatepair2 = [k - 1 for k in MASK_DIGITS[conj_pairs[j][n]]]
+					intersection = conj_pairs[i][n] & conj_pairs[j][n]
+					if MASK_COUNT[intersection] == 1:
+						base = MASK_DIGITS[intersection][0] - 1
 						if direction == 'c':
-							print("in cols")
+							s.trace("Found possible skyscraper in cols")
 							col_i_cells = [s.get_cell(conjugatepair1[0], i), s.get_cell(conjugatepair1[1], i)]
 							col_j_cells = [s.get_cell(conjugatepair2[0], j), s.get_cell(conjugatepair2[1], j)]
 							all_four_cells = col_i_cells + col_j_cells
-							print("  Skyscraper digit:", n)
+							s.trace("  Skyscraper digit:", n)
 							base_cells = [s.get_cell(base, i), s.get_cell(base, j)]
-							print("  Base cells:", base_cells[0], base_cells[1])
+							s.trace("  Base cells:", base_cells[0], base_cells[1])
 							roof_cells = [c for c in all_four_cells if c not in base_cells]
-							print("  Roof cells:", roof_cells[0], roof_cells[1])
+							s.trace("  Roof cells:", roof_cells[0], roof_cells[1])
 						else:
-							print("in rows.")
+							s.trace("Found possible skyscraper in rows.")
 							row_i_cells = [s.get_cell(i, conjugatepair1[0]), s.get_cell(i, conjugatepair1[1])]
 							row_j_cells = [s.get_cell(j, conjugatepair2[0]), s.get_cell(j, conjugatepair2[1])]
 							all_four_cells = row_i_cells + row_j_cells
-							print("  Skyscraper digit:", n)
+							s.trace("  Skyscraper digit:", n)
 							base_cells = [s.get_cell(i, base), s.get_cell(j, base)]
-							print("  Base cells:", base_cells[0], base_cells[1])
+							s.trace("  Base cells:", base_cells[0], base_cells[1])
 							roof_cells = [c for c in all_four_cells if c not in base_cells]
-							print("  Roof cells:", roof_cells[0], roof_cells[1])
+							s.trace("  Roof cells:", roof_cells[0], roof_cells[1])
 						#Delete candidate digit from cells that see both roof cells
-						# List cells that each roof-cell can see, convert to sets and take intersection.
-						possible_affected_cells = list((can_see(s, roof_cells[0]) & can_see(s, roof_cells[1])) - set(roof_cells))
-						eliminate_n_in_affected_cells(s, n, possible_affected_cells)
+						# List cells (other than the roof cells) that see both roof cells
+						pattern = [cell.get_index() for cell in all_four_cells]
+						possible_affected_cells = common_peer_cells(s, roof_cells[0], roof_cells[1])
+						eliminate_n_in_affected_cells(s, n, possible_affected_cells, "9", pattern)
 						if roof_cells[0].sees(roof_cells[1]):	#If roof cells are in same box, only one is true, so one of the
 																# base cells is true, so delete n from other cells that see both
-							possible_affected_cells = list((can_see(s, base_cells[0]) & can_see(s, base_cells[1])) - set(base_cells))
-							eliminate_n_in_affected_cells(s, n, possible_affected_cells)
+							possible_affected_cells = common_peer_cells(s, base_cells[0], base_cells[1])
+							eliminate_n_in_affected_cells(s, n, possible_affected_cells, "9", pattern)
 		
 # Logic Rule A: Two-String Kite -- Two perpendicular conjugate pairs that end in the same box (but not in same cell)
 #				that share a digit allow that digit to be eliminated in any cell that sees the
 #				other ends of both conjugate pairs.
 def logic_rule_A(s):
-	cols = s.get_cols()
-	rows = s.get_rows()
-	tally_d_list_cols = [make_tally_d(col) for col in cols]  # Make a tally_d_list for every col
+	cells = s.cells
+	graph = link_graph(s)
 	conj_pairs_cols_cells = [{},{},{},{},{},{},{},{},{}]
-	tally_d_list_rows = [make_tally_d(row) for row in rows]  # Make a tally_d_list for every row
 	conj_pairs_rows_cells = [{},{},{},{},{},{},{},{},{}]
 	for i in range(9):
-		for n in tally_d_list_cols[i]:
-			if len(tally_d_list_cols[i][n]) == 2:	# Find all n that occur 2x in col (conj pairs) in separate boxes
-				cp_row = tally_d_list_cols[i][n]
-				cell1 = s.get_cell(cp_row[0], i)
-				cell2 = s.get_cell(cp_row[1], i)
-				if cell1.get_box() != cell2.get_box():#					conj_pairs_cols[i][n] = tally_d_list_cols[i][n]
-					conj_pairs_cols_cells[i][n] = [cell1, cell2]
-		for n in tally_d_list_rows[i]:
-			if len(tally_d_list_rows[i][n]) == 2:	# Find all n that occur 2x in row (conj pairs) in separate boxes
-				cp_col = tally_d_list_rows[i][n]
-				cell1 = s.get_cell(i, cp_col[0])
-				cell2 = s.get_cell(i, cp_col[1])
-				if cell1.get_box() != cell2.get_box():
-					conj_pairs_rows_cells[i][n] = [cell1, cell2]
+		for n in range(1, 10):
+			pair = graph.conjugates(n, 9 + i)	# Find all n that occur 2x in col (conj pairs) in separate boxes
+			if pair and BOX_OF[pair[0]] != BOX_OF[pair[1]]:
+				conj_pairs_cols_cells[i][n] = [cells[pair[0]], cells[pair[1]]]
+		for n in range(1, 10):
+			pair = graph.conjugates(n, i)		# Find all n that occur 2x in row (conj pairs) in separate boxes
+			if pair and BOX_OF[pair[0]] != BOX_OF[pair[1]]:
+				conj_pairs_rows_cells[i][n] = [cells[pair[0]], cells[pair[1]]]
 	for i in range (9):
 		for n_in_col in conj_pairs_cols_cells[i]:
 			col_cell1 = conj_pairs_cols_cells[i][n_in_col][0]
@@ -283,28 +335,33 @@ def logic_rule_A(s):
 						row_cell2 = conj_pairs_rows_cells[j][n_in_row][1]
 						if col_cell1 != row_cell1 and col_cell1 != row_cell2 and col_cell2 != row_cell1 and col_cell2 != row_cell2:
 							if col_cell1.get_box() == row_cell1.get_box():
-								print("1. Fulcrum of 2-string kite. Digit:", n_in_col, " Col cell:", col_cell1, "Row cell:", row_cell1, "Box:", col_cell1.get_box())
-								two_string_finish(s, n_in_col, col_cell2, row_cell2)
+								s.trace("1. Fulcrum of 2-string kite. Digit:", n_in_col, " Col cell:", col_cell1, "Row cell:", row_cell1, "Box:", col_cell1.get_box())
+								two_string_finish(s, n_in_col, col_cell2, row_cell2, [col_cell1, col_cell2, row_cell1, row_cell2])
 							elif col_cell1.get_box() == row_cell2.get_box():
-								print("2. Fulcrum of 2-string kite. Digit:", n_in_col, " Col cell:", col_cell1, "Row cell:", row_cell2, "Box:", col_cell1.get_box())
-								two_string_finish(s, n_in_col, col_cell2, row_cell1)
+								s.trace("2. Fulcrum of 2-string kite. Digit:", n_in_col, " Col cell:", col_cell1, "Row cell:", row_cell2, "Box:", col_cell1.get_box())
+								two_string_finish(s, n_in_col, col_cell2, row_cell1, [col_cell1, col_cell2, row_cell1, row_cell2])
 							elif col_cell2.get_box() == row_cell1.get_box():
-								print("3. Fulcrum of 2-string kite. Digit:", n_in_col, " Col cell:", col_cell2, "Row cell:", row_cell1, "Box:", col_cell2.get_box())
-								two_string_finish(s, n_in_col, col_cell1, row_cell2)
+								s.trace("3. Fulcrum of 2-string kite. Digit:", n_in_col, " Col cell:", col_cell2, "Row cell:", row_cell1, "Box:", col_cell2.get_box())
+								two_string_finish(s, n_in_col, col_cell1, row_cell2, [col_cell1, col_cell2, row_cell1, row_cell2])
 							elif col_cell2.get_box() == row_cell2.get_box():
-								print("4. Fulcrum of 2-string kite. Digit:", n_in_col, " Col cell:", col_cell2, "Row cell:", row_cell2, "Box:", col_cell2.get_box())
-								two_string_finish(s, n_in_col, col_cell1, row_cell1)
+								s.trace("4. Fulcrum of 2-string kite. Digit:", n_in_col, " Col cell:", col_cell2, "Row cell:", row_cell2, "Box:", col_cell2.get_box())
+								two_string_finish(s, n_in_col, col_cell1, row_cell1, [col_cell1, col_cell2, row_cell1, row_cell2])
 							else:
 								continue
 
 #Two-String Kite Common code to all four cases
-def two_string_finish(s, n, col_cell, row_cell):
+def two_string_finish(s, n, col_cell, row_cell, kite_cells):
 	target_cell = s.get_cell(col_cell.get_row(), row_cell.get_col())
-	print("   Target cell:", target_cell)
+	s.trace("   Target cell:", target_cell)
 	if target_cell.is_possible(n):
+		before = target_cell.get_mask()
 		target_cell.remove_possible([n])
 		s.set_changed()
-		print("   Target cell after:", target_cell)
+		s.trace("   Target cell after:", target_cell)
+		if s.recorder is not None:
+			s.recorder.begin("A", DIGIT_BIT[n], [cell.get_index() for cell in kite_cells])
+			s.recorder.removed(target_cell, before)
+			s.recorder.end()
 
 # Logic Rule B: XYZ-Wing -- Find a trio and subset pair in the same box, with a pair in the same row or col
 #				as the trio that is a different subset of the trio.  Eliminate the shared digit in any cell
@@ -316,163 +373,1133 @@ def logic_rule_B(s):
 	for box in boxes:
 		trio_cells = [cell for cell in box if cell.number_of_options() == 3]
 		for trio_cell in trio_cells:
-			duo_cells_near_trio_cell = [cell for cell in box if cell.number_of_options() == 2 and set(cell.get_possible()) < set(trio_cell.get_possible())]
+			duo_cells_near_trio_cell = [cell for cell in box if is_duo_of(cell, trio_cell)]
 			for duo_cell in duo_cells_near_trio_cell:
 				pivot_col = trio_cell.get_col()
 				pivot_row = trio_cell.get_row()
 				if duo_cell.get_col() != pivot_col:
-					other_duo_cells = [cell for cell in cols[pivot_col] if cell.number_of_options() == 2 and set(cell.get_possible()) < set(trio_cell.get_possible()) and cell.get_possible() != duo_cell.get_possible()]
+					other_duo_cells = [cell for cell in cols[pivot_col] if is_duo_of(cell, trio_cell) and cell.get_mask() != duo_cell.get_mask()]
 					XYZwing_final_test(s, trio_cell, duo_cell, other_duo_cells, pivot_col, "col")
 				if duo_cell.get_row() != pivot_row:
-					other_duo_cells = [cell for cell in rows[pivot_row] if cell.number_of_options() == 2 and set(cell.get_possible()) < set(trio_cell.get_possible()) and cell.get_possible() != duo_cell.get_possible()]
+					other_duo_cells = [cell for cell in rows[pivot_row] if is_duo_of(cell, trio_cell) and cell.get_mask() != duo_cell.get_mask()]
 					XYZwing_final_test(s, trio_cell, duo_cell, other_duo_cells, pivot_row, "row")
 
+def is_duo_of(cell, trio_cell):	# does cell have 2 options, both of them options of trio_cell (but not all of them)?
+	mask = cell.get_mask()
+	trio = trio_cell.get_mask()
+	return MASK_COUNT[mask] == 2 and mask & trio == mask and mask != trio
+
 # XYZ-Wing Common code to col & row orientations
 def XYZwing_final_test(s, trio_cell, duo_cell, other_duo_cells, pivot, orientation):
 	if other_duo_cells:
 		other_duo_cell = other_duo_cells[0]
-		print("*** Found XYZ-wing in", orientation, pivot)
-		print("  Pivot:", trio_cell, "Near wing:", duo_cell, "Far wing:", other_duo_cell)
-		n = (set(duo_cell.get_possible()) & set(other_duo_cell.get_possible())).pop()
-		print("  n:", n)
-		possible_affected_cells = list(can_see(s, trio_cell) & can_see(s, duo_cell) & can_see(s, other_duo_cell) - {trio_cell, duo_cell, other_duo_cell})
+		s.trace("*** Found XYZ-wing in", orientation, pivot)
+		s.trace("  Pivot:", trio_cell, "Near wing:", duo_cell, "Far wing:", other_duo_cell)
+		n = MASK_DIGITS[duo_cell.get_mask() & other_duo_cell.get_mask()][0]
+		s.trace("  n:", n)
+		far_wing_peers = SEES[other_duo_cell.get_index()]
+		possible_affected_cells = [c for c in common_peer_cells(s, trio_cell, duo_cell) if far_wing_peers[c.get_index()]]
 		# Alternate way to find possible affected cells: trio_cell's box & trio_cell's row/col - trio_cell
-		eliminate_n_in_affected_cells(s, n, possible_affected_cells)
+		eliminate_n_in_affected_cells(s, n, possible_affected_cells, "B",
+			[trio_cell.get_index(), duo_cell.get_index(), other_duo_cell.get_index()])
+
+# Logic Rule D: X-chain and XY-chain -- chains of alternating strong and weak links (see LinkGraph).
+#				X-chain: for one digit, if the first cell of a chain is not n, the strong link makes the next cell n,
+#				the weak link makes the cell after that not n, and so on, so one of the two end cells must be n and n
+#				can be eliminated from any other cell that sees both ends.  (Skyscrapers and two-string kites are
+#				X-chains with 2 strong links.)
+#				XY-chain: a chain of cells with 2 options each, each seeing the next and sharing a digit with it.  If
+#				the first cell is not n it is its other digit, so the next cell is not that digit and is its own other
+#				digit, and so on; if the last cell's other digit is n again, one of the two end cells must be n and n
+#				can be eliminated from any other cell that sees both ends.  (A Y-wing is an XY-chain of 3 cells.)
+#				Chains are followed from the candidates as they were when the rule was called, up to CHAIN_LENGTH
+#				cells long.  Only each chain's end cells are reported.
+CHAIN_LENGTH = 8
+
+def logic_rule_D(s):
+	graph = link_graph(s)
+	for n in range(1, 10):
+		for start in sorted(graph.strong_links(n)):
+			for end in bit_cells(x_chain_ends(graph, n, start)):
+				if end > start:			# the same chain is found from both ends
+					eliminate_chain(s, "X-chain", n, start, end)
+	for start in graph.bivalue:
+		for n in MASK_DIGITS[graph.cands[start]]:
+			for end in xy_chain_ends(graph, start, n):
+				if end > start:
+					eliminate_chain(s, "XY-chain", n, start, end)
+
+# Cells (as an 81-bit set) that must be n if start is not n, by X-chains of 2 or more strong links from start.  A cell
+# reached again by a longer chain is not followed again, since anything it leads to was reached the first time.
+def x_chain_ends(graph, n, start):
+	strong = graph.strong_links(n)
+	not_n = 1 << start				# cells that can't be n if start isn't, after the last weak link
+	seen_n = 0
+	seen_not_n = not_n
+	ends = 0
+	for links in range(1, CHAIN_LENGTH // 2 + 1):
+		is_n = 0					# cells that must be n, after one more strong link
+		for i in bit_cells(not_n):
+			is_n |= strong.get(i, 0)
+		if links >= 2:
+			ends |= is_n
+		is_n &= ~seen_n
+		seen_n |= is_n
+		not_n = 0
+		for i in bit_cells(is_n):
+			not_n |= graph.weak_links(n, i)
+		not_n &= ~seen_not_n
+		seen_not_n |= not_n
+	return ends & ~(1 << start)
+
+# Cells that must be n if start (a cell with 2 options, one of them n) is not n, by XY-chains of 3 or more cells
+def xy_chain_ends(graph, start, n):
+	cands = graph.cands
+	links = graph.bivalue_links()
+	chain = [(start, MASK_DIGITS[cands[start] & ~DIGIT_BIT[n]][0])]		# (cell, digit it must be) at the chain's end
+	seen = set(chain)
+	ends = set()
+	for length in range(2, CHAIN_LENGTH + 1):
+		next_chain = []
+		for i, d in chain:
+			for j in links.get((i, d), ()):
+				other = MASK_DIGITS[cands[j] & ~DIGIT_BIT[d]][0]
+				if other == n and length >= 3 and j != start:
+					ends.add(j)
+				if (j, other) not in seen:
+					seen.add((j, other))
+					next_chain.append((j, other))
+		chain = next_chain
+	return sorted(ends)
+
+def eliminate_chain(s, name, n, start, end):	# eliminate n from the other cells that see both ends of a chain
+	cells = s.cells
+	affected_cells = [cells[k] for k in COMMON_PEERS[start][end] if cells[k].number_of_options() > 1 and cells[k].is_possible(n)]
+	if affected_cells:
+		s.trace("Found {}!".format(name))
+		s.trace("  Digit:", n, " Ends: ({}, {}) and ({}, {})".format(start // 9, start % 9, end // 9, end % 9))
+		eliminate_n_in_affected_cells(s, n, affected_cells, "D", [start, end])
+
+
+### Link graph
+#
+# Strong and weak links between candidates, shared by the fish and chain rules (6-D except B).  Two cells are strongly linked
+# for digit n when they are the only two cells of a row, col, or box where n is possible (a conjugate pair: if one is
+# not n, the other is), and weakly linked when they see each other and both have n possible (if one is n, the other
+# is not).  Each Sudoku keeps one LinkGraph (s.links); link_graph() brings it up to date with the candidates,
+# redoing only the units of cells that changed since it was last used, and the rules query that snapshot.
+
+CELL_UNIT_BITS = [tuple((u, DIGIT_BIT[UNIT_INDICES[u].index(i) + 1]) for u in CELL_UNITS[i]) for i in range(81)]	# (unit, position bit) of each cell's 3 units
+
+class LinkGraph:
+
+	def __init__(self):
+		self.cands = [0] * 81		# the candidate masks the graph describes
+		self.positions = [[0] * 27 for n in range(10)]	# positions[n][u] has bit j set if n is possible in cell j of unit u
+		self.bivalue = []			# cells with exactly 2 options
+		self.is_bivalue = [False] * 81
+		self.clear_derived()
+
+	def clear_derived(self):		# drop the links worked out from the old candidates
+		self.strong = [None] * 10	# strong[n]: {cell: 81-bit set of the cells strongly linked to it for n}
+		self.cells_of = [None] * 10	# cells_of[n]: 81-bit set of the cells where n is possible
+		self.xy_links = None		# {(cell, d): bivalue peers of bivalue cell that have d possible}
+
+	def update(self, cands):		# flip the position bits of the digits each changed cell lost (or gained)
+		old = self.cands
+		changed = [i for i in range(81) if cands[i] != old[i]]
+		if not changed:
+			return
+		positions = self.positions
+		is_bivalue = self.is_bivalue
+		for i in changed:
+			for n in MASK_DIGITS[old[i] ^ cands[i]]:
+				positions_n = positions[n]
+				for u, bit in CELL_UNIT_BITS[i]:
+					positions_n[u] ^= bit
+			is_bivalue[i] = MASK_COUNT[cands[i]] == 2
+		self.cands = list(cands)
+		self.bivalue = [i for i in range(81) if is_bivalue[i]]
+		self.clear_derived()
+
+	def conjugates(self, n, u):		# the 2 cells of unit u where n is possible, if there are exactly 2, else None
+		mask = self.positions[n][u]
+		if MASK_COUNT[mask] == 2:
+			j, k = MASK_DIGITS[mask]
+			return UNIT_INDICES[u][j - 1], UNIT_INDICES[u][k - 1]
+		return None
+
+	def strong_links(self, n):
+		if self.strong[n] is None:
+			links = {}
+			for u in range(27):
+				pair = self.conjugates(n, u)
+				if pair:
+					i, j = pair
+					links[i] = links.get(i, 0) | 1 << j
+					links[j] = links.get(j, 0) | 1 << i
+			self.strong[n] = links
+		return self.strong[n]
+
+	def digit_cells(self, n):
+		if self.cells_of[n] is None:
+			bit = DIGIT_BIT[n]
+			self.cells_of[n] = sum([1 << i for i in range(81) if self.cands[i] & bit])
+		return self.cells_of[n]
+
+	def weak_links(self, n, i):		# 81-bit set of the cells weakly linked to cell i for n
+		return PEER_BITS[i] & self.digit_cells(n)
+
+	def bivalue_links(self):
+		if self.xy_links is None:
+			links = {}
+			for i in self.bivalue:
+				for j in PEERS[i]:
+					if self.is_bivalue[j]:
+						for d in MASK_DIGITS[self.cands[i] & self.cands[j]]:
+							links.setdefault((i, d), []).append(j)
+			self.xy_links = links
+		return self.xy_links
+
+def link_graph(s):			# s's LinkGraph, up to date with its candidates
+	if s.links is None:
+		s.links = LinkGraph()
+	s.links.update(s.get_cands())
+	return s.links
+
+def bit_cells(bits):		# cell indices in an 81-bit set, in order
+	while bits:
+		low = bits & -bits
+		yield low.bit_length() - 1
+		bits ^= low
+
 
 ### Utility functions
 
-def eliminate_n_in_affected_cells(s, n, possible_affected_cells):
+# Rule and pattern (indices of the cells making the pattern), if given, start a step for s's step recorder; without
+# them the eliminations are added to the step already started
+def eliminate_n_in_affected_cells(s, n, possible_affected_cells, rule=None, pattern=None):
 	affected_cells = [c for c in possible_affected_cells if c.number_of_options() > 1 and c.is_possible(n)]
+	recorder = s.recorder
+	if recorder is not None and rule is not None:
+		recorder.begin(rule, DIGIT_BIT[n], pattern)
 	if affected_cells:
 		for c in affected_cells:
-			print("  Affected cell before:", c, end = " ")
+			before = c.get_possible()
 			c.remove_possible([n])
 			s.set_changed()		# note that we made a change
-			print("  After:", c)
+			s.trace("  Affected cell before:", before, "  After:", c)
+			if recorder is not None:
+				recorder.removed(c, digits_to_mask(before))
 	else:
-		print("  No affected cells.")
+		s.trace("  No affected cells.")
+	if recorder is not None and rule is not None:
+		recorder.end()
 
-def eliminate_elsewhere_in_container(s, n, save_cell_list, container):
+def eliminate_elsewhere_in_container(s, n, save_cell_list, container, rule=None):
+	recorder = s.recorder
+	if recorder is not None and rule is not None:
+		recorder.begin(rule, DIGIT_BIT[n], [cell.get_index() for cell in save_cell_list])
 	for cell in container:
 		if cell not in save_cell_list and n in cell.get_possible():	#delete n from unsettled cells in which n is an option
 			cell.remove_possible([n])	#cut n only from other cells in container
 			s.set_changed()		# note that we made a change
+			if recorder is not None:
+				recorder.removed(cell, cell.get_mask() | DIGIT_BIT[n])
+	if recorder is not None and rule is not None:
+		recorder.end()
 
 def make_tally_d(container):
 	d = {1:[],2:[],3:[],4:[],5:[],6:[],7:[],8:[],9:[]}  # initialize dictionary of digits as keys
 	for j in range(9):	# collect indices in container of cells for which each number is possible
-		cell_options = container[j].get_possible()
-		for k in range(len(cell_options)):
-			d[cell_options[k]].append(j)
+		for n in container[j].get_possible():
+			d[n].append(j)
 	return d
 
-def can_see(s, cell):	#Returns set of all cells this cell can see. Probably should be a sudoku or cell method
-	return set(s.get_rows()[cell.get_row()]) | set(s.get_cols()[cell.get_col()]) | set(s.get_boxes()[cell.get_box()]) - {cell}
+def make_position_masks(container):	# positions[n] has bit i set (i.e. "digit" i+1) if n is possible in container[i]
+	positions = [0] * 10
+	for i in range(9):
+		bit = DIGIT_BIT[i + 1]
+		for n in container[i].get_possible():
+			positions[n] |= bit
+	return positions
 
+def can_see(s, cell):	#Returns set of all cells this cell can see (its 20 peers)
+	return set([s.cells[i] for i in PEERS[cell.get_index()]])
 
-### Main driver
+def common_peer_cells(s, cell1, cell2):	#Returns list of all cells (other than these two) that see both cells
+	return [s.cells[i] for i in COMMON_PEERS[cell1.get_index()][cell2.get_index()]]
 
-def main():
 
-	# Open data file
-	ifile = open("sudoku.txt", "r")
+### Rule profiling
+#
+# A RuleProfiler counts, for each rule and each pass number, the calls made to the rule, the time they took, the
+# candidates they eliminated, and how many calls eliminated anything (hits).  Pass one to an engine (or to
+# solve()) to fill it in; reuse it across puzzles to add them up.  Each rule call costs two clock readings and a copy
+# of the 81 masks; the candidates eliminated are counted only in the cells the call changed.  Over sudoku.txt that
+# is within the noise (a few percent) for the passes and adaptive engines, and about a quarter more time for the
+# queue engine, whose calls -- one rule on one container -- are many and short.
 
-	rules_to_use = ifile.readline() # first line of file is logic rules (0-9) to use
-	print("Solving sudoku using", rules_to_use)
+class RuleProfiler:
+
+	def __init__(self):
+		self.totals = {}			# rule -> [calls, seconds, eliminated, hits] over all passes
+		self.passes = []			# passes[p - 1] is the same for pass p alone
+		self.current = None			# counters of the pass being recorded
+
+	def start_pass(self, pass_number):
+		while len(self.passes) < pass_number:
+			self.passes.append({})
+		self.current = self.passes[pass_number - 1]
+
+	def record(self, rule, seconds, eliminated):
+		if self.current is None:
+			self.start_pass(1)
+		for counters in (self.totals, self.current):
+			if rule not in counters:
+				counters[rule] = [0, 0.0, 0, 0]
+			rule_counters = counters[rule]
+			rule_counters[0] += 1
+			rule_counters[1] += seconds
+			rule_counters[2] += eliminated
+			if eliminated:
+				rule_counters[3] += 1
+
+	def add(self, profile_dict):	# add in counters exported by another RuleProfiler's as_dict() (e.g. from a worker)
+		for pass_index, pass_dict in enumerate(profile_dict["passes"]):
+			self.start_pass(pass_index + 1)
+			for rule in pass_dict:
+				counters = pass_dict[rule]
+				for rule_counters in (self.totals.setdefault(rule, [0, 0.0, 0, 0]), self.current.setdefault(rule, [0, 0.0, 0, 0])):
+					rule_counters[0] += counters["calls"]
+					rule_counters[1] += counters["seconds"]
+					rule_counters[2] += counters["eliminated"]
+					rule_counters[3] += counters["hits"]
+		self.current = None
+
+	def as_dict(self):				# {"rules": {rule: counters}, "passes": [{rule: counters}, ...]}, in RULE_ORDER
+		return {"rules": counters_dict(self.totals), "passes": [counters_dict(pass_counters) for pass_counters in self.passes]}
+
+	def to_json(self):
+		import json		# imported where needed: it is slow to import, and most runs never use it
+		return json.dumps(self.as_dict())
+
+	def report(self):				# readable table of the totals, one line per rule used
+		lines = ["Rule  Name                 Calls   Seconds  Eliminated  Hit rate  us/elim"]
+		for rule, counters in counters_dict(self.totals).items():
+			lines.append("{:4}  {:16} {:9} {:9.4f} {:11} {:8.1%} {:>8}".format(rule, RULE_NAMES[rule], counters["calls"],
+				counters["seconds"], counters["eliminated"], counters["hit_rate"],
+				"{:.1f}".format(counters["seconds"] * 1e6 / counters["eliminated"]) if counters["eliminated"] else "-"))
+		return "\n".join(lines)
+
+def counters_dict(counters):		# export a RuleProfiler's {rule: [calls, seconds, eliminated, hits]} as named fields
+	d = {}
+	for rule in RULE_ORDER:
+		if rule in counters:
+			calls, seconds, eliminated, hits = counters[rule]
+			d[rule] = {"calls": calls, "seconds": seconds, "eliminated": eliminated, "hits": hits,
+				"hit_rate": hits / calls if calls else 0.0}
+	return d
+
+
+### Step recording
+#
+# A StepRecorder keeps a log of every step the rules take: which rule, the digits of its pattern, the cells that
+# make the pattern, and the candidates it eliminated from each cell.  Attach one to a Sudoku with set_recorder() (or
+# pass it to solve()); each rule then calls begin() when it finds a pattern, removed() for each cell it takes
+# candidates from, and end(), which appends the step to the log if anything was eliminated.  Without a recorder the
+# rules only check that s.recorder is None.
+#
+# Steps are packed into one bytearray, grown by doubling: a header "<cHBB" (rule, digits mask, number of pattern
+# cells, number of eliminated cells), a byte per pattern cell index, and "<BH" (cell index, mask of digits removed)
+# per eliminated cell.  write_binary() saves that buffer as it is, after a STEP_MAGIC and a step count.
+
+STEP_HEADER = struct.Struct("<cHBB")
+STEP_ELIMINATION = struct.Struct("<BH")
+STEP_MAGIC = b"SUDSTEP1"
+
+class StepRecorder:
+
+	def __init__(self, capacity=65536):
+		self.buffer = bytearray(capacity)	# packed steps; bytes past self.size are free space
+		self.size = 0
+		self.count = 0				# steps recorded
+		self.rule = None			# the step being recorded: rule, digits mask, pattern cells, eliminations
+		self.digits = 0
+		self.pattern = ()
+		self.eliminated = []
+
+	def __len__(self):
+		return self.count
+
+	def begin(self, rule, digits, pattern):
+		self.rule = rule
+		self.digits = digits
+		self.pattern = pattern
+		self.eliminated = []
+
+	def removed(self, cell, before):	# cell lost the candidates that were in mask before and are no longer
+		lost = before & ~cell.get_mask()
+		if lost:
+			self.eliminated.append((cell.get_index(), lost))
+
+	def end(self):
+		if self.eliminated:
+			self.append(self.rule, self.digits, self.pattern, self.eliminated)
+		self.rule = None
+		self.eliminated = []
+
+	def append(self, rule, digits, pattern, eliminated):
+		pattern = pattern[:255]
+		needed = STEP_HEADER.size + len(pattern) + len(eliminated) * STEP_ELIMINATION.size
+		if self.size + needed > len(self.buffer):
+			self.buffer.extend(bytes(max(len(self.buffer), needed)))
+		STEP_HEADER.pack_into(self.buffer, self.size, rule.encode("ascii"), digits, len(pattern), len(eliminated))
+		offset = self.size + STEP_HEADER.size
+		self.buffer[offset:offset + len(pattern)] = bytes(pattern)
+		offset += len(pattern)
+		for i, lost in eliminated:
+			STEP_ELIMINATION.pack_into(self.buffer, offset, i, lost)
+			offset += STEP_ELIMINATION.size
+		self.size = offset
+		self.count += 1
+
+	def clear(self):
+		self.size = 0
+		self.count = 0
+
+	def steps(self):				# yields (rule, digits mask, [pattern cells], [(cell, mask of digits removed)])
+		buffer = self.buffer
+		offset = 0
+		while offset < self.size:
+			rule, digits, n_pattern, n_eliminated = STEP_HEADER.unpack_from(buffer, offset)
+			offset += STEP_HEADER.size
+			pattern = list(buffer[offset:offset + n_pattern])
+			offset += n_pattern
+			eliminated = []
+			for k in range(n_eliminated):
+				eliminated.append(STEP_ELIMINATION.unpack_from(buffer, offset))
+				offset += STEP_ELIMINATION.size
+			yield rule.decode("ascii"), digits, pattern, eliminated
+
+	def as_dicts(self):				# the steps as JSON-ready dicts, cells as [row, col]
+		for number, (rule, digits, pattern, eliminated) in enumerate(self.steps(), 1):
+			yield {"step": number, "rule": rule, "name": RULE_NAMES.get(rule, rule), "digits": MASK_DIGITS[digits],
+				"pattern": [[i // 9, i % 9] for i in pattern],
+				"eliminated": [[i // 9, i % 9, MASK_DIGITS[lost]] for i, lost in eliminated]}
+
+	def write_jsonl(self, ofile):	# one JSON object per line, per step
+		import json
+		for step in self.as_dicts():
+			ofile.write(json.dumps(step) + "\n")
+
+	def write_binary(self, ofile):	# ofile opened in binary mode
+		ofile.write(STEP_MAGIC + struct.pack("<Q", self.count))
+		ofile.write(memoryview(self.buffer)[:self.size])
+
+	@classmethod
+	def read_binary(cls, ifile):	# a StepRecorder holding the steps saved by write_binary()
+		if ifile.read(len(STEP_MAGIC)) != STEP_MAGIC:
+			raise Exception ("Not a step log.")
+		count, = struct.unpack("<Q", ifile.read(8))
+		recorder = cls(0)
+		recorder.buffer = bytearray(ifile.read())
+		recorder.size = len(recorder.buffer)
+		recorder.count = count
+		return recorder
+
+def save_steps(recorder, path):		# write a StepRecorder's steps to path: a binary log if it ends in .bin, else JSON Lines
+	if path.endswith(".bin"):
+		with open(path, "wb") as ofile:
+			recorder.write_binary(ofile)
+	else:
+		with open(path, "w") as ofile:
+			recorder.write_jsonl(ofile)
+
+
+### Live display
+#
+# Printing the whole grid after every pass (verbose mode) can take longer than solving.  A GridDisplay instead keeps
+# one grid on a terminal and redraws it in place: each frame is built in one buffer and written at once, only the
+# cells that changed since the last frame are redrawn, and frames come at most fps times a second -- passes that go
+# by faster than that are skipped, apart from the last, which is always shown.  If out is not a terminal, each frame
+# is written out in full below the last one (still at most fps a second).
+
+FIELD_TEXT = ["".join([str(n) for n in digits]).ljust(9) for digits in MASK_DIGITS]	# a cell's candidates, 9 wide
+FIELD_COLUMN = [(c // 3) * 32 + (c % 3) * 10 + 1 for c in range(9)]		# screen column of each col's field, from 1
+GRID_LINE = [1 + r + r // 3 for r in range(9)]			# line of each row in a frame; line 0 is the status line
+FRAME_LINES = 12
+FRAME_RULE = "-+-".join(["-" * 29] * 3)
+
+class GridDisplay:
+
+	def __init__(self, out=sys.stdout, fps=10.0):
+		self.out = out
+		self.interval = 1.0 / fps if fps else 0.0	# least time between frames (fps 0: no limit)
+		self.in_place = hasattr(out, "isatty") and out.isatty()
+		self.shown = None			# candidates on the screen, or None before the first frame
+		self.shown_pass = None		# the pass they are from
+		self.last = 0.0				# time of the last frame
+		self.frames = 0
+		self.skipped = 0
+
+	def status(self, s, passes):
+		return "Pass {}: {} candidates left".format(passes, s.count_options())
+
+	# Show s after pass passes, unless the last frame was less than 1/fps seconds ago.  final shows it anyway, unless
+	# it is on the screen already.
+	def show(self, s, passes, final=False):
+		now = time.perf_counter()
+		cands = s.get_cands()
+		if final and passes == self.shown_pass and cands == self.shown:
+			return
+		if not final and self.shown is not None and now - self.last < self.interval:
+			self.skipped += 1
+			return
+		if self.shown is None or not self.in_place:
+			text = self.frame(s, passes)
+		else:
+			text = self.changes(s, passes, cands)
+		self.out.write(text)
+		self.out.flush()
+		self.shown = cands[:]
+		self.shown_pass = passes
+		self.last = now
+		self.frames += 1
+
+	def frame(self, s, passes):		# the whole grid
+		lines = [self.status(s, passes)]
+		cands = s.get_cands()
+		for r in range(9):
+			fields = [FIELD_TEXT[mask] for mask in cands[r * 9:r * 9 + 9]]
+			lines.append(" | ".join([" ".join(fields[c:c + 3]) for c in (0, 3, 6)]))
+			if r in (2, 5):
+				lines.append(FRAME_RULE)
+		return "\n".join(lines) + "\n"
+
+	# Cursor moves and text that turn the frame on the screen into this one.  The cursor sits below the frame: each
+	# changed field is reached by going up to its line and across to its column, then back down.
+	def changes(self, s, passes, cands):
+		shown = self.shown
+		parts = ["\x1b[{}A\r{}\x1b[K\x1b[{}B".format(FRAME_LINES, self.status(s, passes), FRAME_LINES)]
+		for i in range(81):
+			if cands[i] != shown[i]:
+				up = FRAME_LINES - GRID_LINE[i // 9]
+				parts.append("\x1b[{}A\x1b[{}G{}\x1b[{}B".format(up, FIELD_COLUMN[i % 9], FIELD_TEXT[cands[i]], up))
+		parts.append("\r")
+		return "".join(parts)
+
+
+### Solving driver
+
+RULE_ORDER = "0123456789ABCD"		# every rule, in the order a pass applies them
+CONTAINER_RULES = "012345"			# rules applied container by container; the rest look at the whole grid
+RULE_NAMES = {"0": "Naked single", "1": "Hidden single", "2": "Naked pair", "3": "Naked triple", "4": "Hidden n-ple",
+	"5": "Locked single", "6": "X-wing", "7": "Swordfish", "8": "Y-wing", "9": "Skyscraper", "A": "Two-string kite",
+	"B": "XYZ-wing", "C": "Jellyfish", "D": "X/XY-chain"}
+
+# Apply one rule (a character of RULE_ORDER) once to the whole sudoku
+def apply_rule(s, rule):
+	if rule == "0":					# Apply Logic Rule 0?  (Naked Single)
+		for i in range(9):
+			logic_rule_0(s, s.rows[i])	#These should probably be s.get_rows()[i]
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_0(s, s.cols[i])
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_0(s, s.boxes[i])
+
+	elif rule == "1":				# Apply Logic Rule 1? (Hidden Single)
+		for i in range(9):
+			logic_rule_1(s, s.rows[i])
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_1(s, s.cols[i])
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_1(s, s.boxes[i])
+
+	elif rule == "2":				# Apply Logic Rule 2? (Naked Pair)
+		for i in range(9):
+			logic_rule_2(s, s.rows[i])
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_2(s, s.cols[i])
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_2(s, s.boxes[i])
+
+	elif rule == "3":				# Apply Logic Rule 3? (Naked Triple)
+		for i in range(9):
+			logic_rule_3(s, s.rows[i])
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_3(s, s.cols[i])
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_3(s, s.boxes[i])
+
+	elif rule == "4":				# Apply Logic Rule 4? (Hidden N-ple)
+		for i in range(9):
+			logic_rule_4(s, s.rows[i])
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_4(s, s.cols[i])
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_4(s, s.boxes[i])
 
-	s = Sudoku(ifile)		# initialize Sudoku from data file
+	elif rule == "5":  				# Apply Logic Rule 5? (Locked Single)
+		for i in range(9):
+			logic_rule_5rc(s, s.rows[i], s.boxes)
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_5rc(s, s.cols[i], s.boxes) 
+		for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
+			logic_rule_5b(s, s.boxes[i], s.rows, s.cols)
 
-	ifile.close()	# close data file 
+	elif rule == "6":  				# Apply Logic Rule 6? (X-wing)
+		logic_rule_6(s, s.rows, s.cols, 'r')	# Look for X-wings in rows
+		logic_rule_6(s, s.cols, s.rows, 'c')	# Look for X-wings in columns
 
+	elif rule == "7":				# Apply Logic Rule 7? (Swordfish)
+		logic_rule_7(s, s.rows, s.cols, 'r')	# Look for Swordfish in rows
+		logic_rule_7(s, s.cols, s.rows, 'c')	# Look for Swordfish in columns
+
+	elif rule == "C":				# Apply Logic Rule C? (Jellyfish)
+		logic_rule_C(s, s.rows, s.cols, 'r')	# Look for Jellyfish in rows
+		logic_rule_C(s, s.cols, s.rows, 'c')	# Look for Jellyfish in columns
+
+	elif rule == "8":				# Apply Logic Rule 8? (Y-wing)
+		logic_rule_8(s)
+
+	elif rule == "9":  				# Apply Logic Rule 9? (Skyscraper)
+		logic_rule_9(s, s.cols, s.rows, 'c')	# Look for skyscraper in columns
+		logic_rule_9(s, s.rows, s.cols, 'r')	# Look for skyscraper in rows
+
+	elif rule == "A":  				# Apply Logic Rule A (Two-string Kite)
+		logic_rule_A(s)
+
+	elif rule == "B":  				# Apply Logic Rule B (XYZ-wing)
+		logic_rule_B(s)
+
+	elif rule == "D":  				# Apply Logic Rule D (X-chain and XY-chain)
+		logic_rule_D(s)
+
+# Call function(s, *args) and record the call, its time, and the candidates it eliminated under rule in profile.
+# Only the cells the call added to the change log are counted, against a copy of the masks taken before it.
+def apply_timed(profile, rule, s, function, *args):
+	changes = s.get_changes()
+	logged = len(changes)
+	before = s.cands[:]
+	start = time.perf_counter()
+	function(s, *args)
+	seconds = time.perf_counter() - start
+	eliminated = 0
+	if len(changes) > logged:
+		cands = s.cands
+		for i in set(changes[logged:]):
+			eliminated += MASK_COUNT[before[i]] - MASK_COUNT[cands[i]]
+	profile.record(rule, seconds, eliminated)
+
+# Apply each rule allowed for this run once to the whole sudoku (one pass).  If profile is a RuleProfiler, each
+# rule's call is recorded in it (see apply_timed).
+def apply_rules(s, rules_to_use, passes, profile=None):
+	# On each pass, look for Sudoku Deduction Patterns allowed for this run
+	for rule in RULE_ORDER:
+		if rule in rules_to_use and (rule in CONTAINER_RULES or passes > 1):	# Advanced rules not sought on first pass
+			if profile is None:
+				apply_rule(s, rule)
+			else:
+				apply_timed(profile, rule, s, apply_rule, rule)
+
+# Apply each advanced (whole-grid) rule allowed for this run once
+def apply_grid_rules(s, rules_to_use, profile=None):
+	for rule in RULE_ORDER:
+		if rule in rules_to_use and rule not in CONTAINER_RULES:
+			if profile is None:
+				apply_rule(s, rule)
+			else:
+				apply_timed(profile, rule, s, apply_rule, rule)
+
+# May a solving driver start another pass, after passes of them?  Not once max_passes are done, nor once the clock
+# (time.perf_counter()) has reached deadline -- checked between passes, and never before the first.
+def more_passes(passes, max_passes, deadline):
+	return (max_passes is None or passes < max_passes) and (deadline is None or passes == 0 or time.perf_counter() < deadline)
+
+# Apply rules repeatedly until the sudoku is solved or stuck, or max_passes passes are done, or deadline (see
+# more_passes) has passed.  Returns (solved, passes).
+# If profile is a RuleProfiler, every rule call is recorded in it, pass by pass.
+def solve_sudoku(s, rules_to_use, verbose=True, max_passes=None, profile=None, deadline=None):
 	passes = 0
-	keep_going = True
-	while keep_going:	# Apply heuristics repeatedly until sudoku solved or stuck
+	while more_passes(passes, max_passes, deadline):	# Apply heuristics repeatedly until sudoku solved or stuck
 
 		passes += 1
 		s.clear_changed()			# Clear change-flag for this pass
-		print("Pass", passes)
-
-# On each pass, look for Sudoku Deduction Patterns allowed for this run
-		if "0" in rules_to_use:			# Apply Logic Rule 0?  (Naked Single)
-			for i in range(9):
-				logic_rule_0(s, s.rows[i])	#These should probably be s.get_rows()[i]
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_0(s, s.cols[i])
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_0(s, s.boxes[i])
-		
-		if "1" in rules_to_use:			# Apply Logic Rule 1? (Hidden Single)
-			for i in range(9):
-				logic_rule_1(s, s.rows[i])
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_1(s, s.cols[i])
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_1(s, s.boxes[i])
-		
-		if "2" in rules_to_use:			# Apply Logic Rule 2? (Naked Pair)
-			for i in range(9):
-				logic_rule_2(s, s.rows[i])
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_2(s, s.cols[i])
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_2(s, s.boxes[i])
-
-		if "3" in rules_to_use:			# Apply Logic Rule 3? (Naked Triple)
-			for i in range(9):
-				logic_rule_3(s, s.rows[i])
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_3(s, s.cols[i])
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_3(s, s.boxes[i])
-
-		if "4" in rules_to_use:			# Apply Logic Rule 4? (Hidden N-ple)
-			for i in range(9):
-				logic_rule_4(s, s.rows[i])
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_4(s, s.cols[i])
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_4(s, s.boxes[i])
-
-		if "5" in rules_to_use:  		# Apply Logic Rule 5? (Locked Single)
-			for i in range(9):
-				logic_rule_5rc(s, s.rows[i], s.boxes)
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_5rc(s, s.cols[i], s.boxes) 
-			for i in range(9):			# comment out to interleave applying rules to rows, cols, boxes
-				logic_rule_5b(s, s.boxes[i], s.rows, s.cols)
-
-# Advanced Sudoku Deduction Patterns; not sought on first pass
-
-		if "6" in rules_to_use and passes > 1:  	# Apply Logic Rule 6? (X-wing)
-			logic_rule_6(s, s.rows, s.cols, 'r')	# Look for X-wings in rows
-			logic_rule_6(s, s.cols, s.rows, 'c')	# Look for X-wings in columns
-
-		if "7" in rules_to_use and passes > 1:		# Apply Logic Rule 7? (Swordfish)
-			logic_rule_7(s, s.rows, s.cols, 'r')	# Look for Swordfish in rows
-			logic_rule_7(s, s.cols, s.rows, 'c')	# Look for Swordfish in columns
-
-		if "8" in rules_to_use and passes > 1:		# Apply Logic Rule 8? (Y-wing)
-			logic_rule_8(s)
-
-		if "9" in rules_to_use and passes > 1:  	# Apply Logic Rule 9? (Skyscraper)
-			logic_rule_9(s, s.cols, s.rows, 'c')	# Look for skyscraper in columns
-			logic_rule_9(s, s.rows, s.cols, 'r')	# Look for skyscraper in rows
-
-		if "A" in rules_to_use and passes > 1:  	# Apply Logic Rule A (Two-string Kite)
-			logic_rule_A(s)
-
-		if "B" in rules_to_use and passes > 1:  	# Apply Logic Rule B (XYZ-wing)
-			logic_rule_B(s)
-
-		s.print_sudoku(s.rows)
+		if verbose:
+			print("Pass", passes)
+
+		if profile is not None:
+			profile.start_pass(passes)
+		apply_rules(s, rules_to_use, passes, profile)
+
+		if verbose:
+			s.print_sudoku(s.rows)
+		if s.display is not None:
+			s.display.show(s, passes)
+
+		if s.is_solved():
+			if verbose:
+				print("Solved in", passes, "passes.")
+			return True, passes
+		elif not s.is_changed():
+			if verbose:
+				print("Stuck on pass", passes)
+			return False, passes
+	return False, passes		# out of passes; s.is_changed() tells that apart from being stuck
+
+
+
+### Propagation queue driver
+#
+# Instead of re-running every rule on all 27 containers each pass, keep a work queue of (rule, container) pairs.
+# Each time a rule removes options from cells, only the containers those cells are in (their row, col, and box)
+# are queued again, for every container rule (0-5) in use.  Advanced rules (6-B), which look at the whole grid,
+# are run only when the queue runs dry; if they change anything, the affected containers are queued again.
+# A "pass" here is one such round: the container rules to a standstill, then the advanced rules once.  Since the
+# container rules have already done all they can, the advanced rules are sought on the first pass too.
+
+# Apply container rule (a character of CONTAINER_RULES) to container number u (0-8 rows, 9-17 cols, 18-26 boxes)
+def apply_container_rule(s, rule, u):
+	container = s.units[u]
+	if rule == "0":
+		logic_rule_0(s, container)
+	elif rule == "1":
+		logic_rule_1(s, container)
+	elif rule == "2":
+		logic_rule_2(s, container)
+	elif rule == "3":
+		logic_rule_3(s, container)
+	elif rule == "4":
+		logic_rule_4(s, container)
+	elif u < 18:
+		logic_rule_5rc(s, container, s.boxes)
+	else:
+		logic_rule_5b(s, container, s.rows, s.cols)
+
+# Queue every container holding a cell in the change log for each rule, then empty the log
+def queue_changed_containers(changes, queues, queued):
+	for i in set(changes):
+		for u in CELL_UNITS[i]:
+			for k in range(len(queues)):
+				if not queued[k][u]:
+					queued[k][u] = True
+					queues[k].append(u)
+	del changes[:]
+
+def solve_sudoku_queue(s, rules_to_use, verbose=True, max_passes=None, profile=None, deadline=None):
+	rules = [rule for rule in CONTAINER_RULES if rule in rules_to_use]
+	queues = [deque(range(27)) for rule in rules]		# containers waiting for each rule; cheapest rule first
+	queued = [[True] * 27 for rule in rules]			# queued[k][u]: is container u waiting for rules[k]?
+	changes = s.get_changes()
+	passes = 0
+	while more_passes(passes, max_passes, deadline):
+
+		passes += 1
+		if verbose:
+			print("Pass", passes)
+		if profile is not None:
+			profile.start_pass(passes)
+
+		k = 0
+		while k < len(rules):		# container rules, always going back to the cheapest rule with work waiting
+			if not queues[k]:
+				k += 1
+				continue
+			u = queues[k].popleft()
+			queued[k][u] = False
+			if profile is None:
+				apply_container_rule(s, rules[k], u)
+			else:
+				apply_timed(profile, rules[k], s, apply_container_rule, rules[k], u)
+			if changes:
+				queue_changed_containers(changes, queues, queued)
+				k = 0
+
+		s.clear_changed()			# From here the change-flag means the advanced rules found more work to do
+		if not s.is_solved():
+			apply_grid_rules(s, rules_to_use, profile)
+			queue_changed_containers(changes, queues, queued)
+
+		if verbose:
+			s.print_sudoku(s.rows)
+		if s.display is not None:
+			s.display.show(s, passes)
 
 		if s.is_solved():
-			print("Solved in", passes, "passes.")
-			keep_going = False
+			if verbose:
+				print("Solved in", passes, "passes.")
+			return True, passes
 		elif not s.is_changed():
-			print("Stuck on pass", passes)
-			keep_going = False
+			if verbose:
+				print("Stuck on pass", passes)
+			return False, passes
+	return False, passes		# out of passes; s.is_changed() tells that apart from being stuck
+
+
+
+### Adaptive rule scheduler
+#
+# Rules are climbed like a ladder, cheapest first: the first rule is applied to the whole grid again and again until
+# it changes nothing, then the next one is tried, and so on.  As soon as any rule changes something, the scheduler
+# drops back to the bottom of the ladder.  The advanced rules are therefore only sought once all cheaper rules have
+# stalled.  Each rule application that changes something ends a pass, so pass counts are not comparable with
+# those of the other engines.
+
+ADAPTIVE_ORDER = "015234" + "6789ABCD"		# default ladder: singles and locked singles, subsets, then advanced rules
+
+# Ladder order learned from a RuleProfiler.as_dict(): rules by measured time per eliminated candidate, cheapest
+# first; rules that never eliminated anything go last, fastest first
+def order_from_profile(profile_dict):
+	rules = profile_dict["rules"]
+	productive = [rule for rule in rules if rules[rule]["eliminated"]]
+	productive.sort(key=lambda rule: rules[rule]["seconds"] / rules[rule]["eliminated"])
+	unproductive = [rule for rule in rules if not rules[rule]["eliminated"]]
+	unproductive.sort(key=lambda rule: rules[rule]["seconds"] / max(rules[rule]["calls"], 1))
+	order = "".join(productive + unproductive)
+	return order + "".join([rule for rule in ADAPTIVE_ORDER if rule not in order])
+
+def solve_sudoku_adaptive(s, rules_to_use, verbose=True, max_passes=None, profile=None, order=ADAPTIVE_ORDER,
+		deadline=None):
+	ladder = [rule for rule in order if rule in rules_to_use]
+	changes = s.get_changes()
+	passes = 0
+	while more_passes(passes, max_passes, deadline):
+
+		passes += 1
+		s.clear_changed()			# Clear change-flag (and change log) for this pass
+		if verbose:
+			print("Pass", passes)
+		if profile is not None:
+			profile.start_pass(passes)
+
+		for rule in ladder:			# climb until a rule changes something
+			if profile is None:
+				apply_rule(s, rule)
+			else:
+				apply_timed(profile, rule, s, apply_rule, rule)
+			if changes:
+				break
+
+		if verbose:
+			s.print_sudoku(s.rows)
+		if s.display is not None:
+			s.display.show(s, passes)
+
+		if s.is_solved():
+			if verbose:
+				print("Solved in", passes, "passes.")
+			return True, passes
+		elif not s.is_changed():
+			if verbose:
+				print("Stuck on pass", passes)
+			return False, passes
+	return False, passes		# out of passes; s.is_changed() tells that apart from being stuck
+
+ENGINES = {"passes": solve_sudoku, "queue": solve_sudoku_queue, "adaptive": solve_sudoku_adaptive}	# solving drivers, by name
+
+def get_engine(engine):		# engine is a name in ENGINES or a driver function, e.g. partial(solve_sudoku_adaptive, order=...)
+	return ENGINES[engine] if isinstance(engine, str) else engine
+
+
+### Library API
+
+class SolveResult:
+
+	def __init__(self, s, solved, passes, seconds):
+		if solved:
+			self.status = "solved"
+		elif s.is_changed():
+			self.status = "limit"		# stopped by max_passes or a deadline while still making progress
 		else:
-			continue
+			self.status = "stuck"
+		self.solved = solved
+		self.passes = passes			# passes made
+		self.candidates = s.count_options()	# candidates left in all cells (81 when solved)
+		self.seconds = seconds
+		self.grid = s.to_line()			# 81 characters: settled digits, '-' for unsettled cells
+		self.masks = list(s.get_cands())	# final candidate bitmask of each cell (see sudoku.py)
+
+	def __str__(self):
+		return "{} after {} passes, {} candidates left".format(self.status, self.passes, self.candidates)
+
+	def get_options(self, r, c):		# list of digits still possible in row r, col c
+		return list(MASK_DIGITS[self.masks[r * 9 + c]])
+
+	def as_dict(self):
+		return {"status": self.status, "solved": self.solved, "passes": self.passes,
+			"candidates": self.candidates, "seconds": self.seconds, "grid": self.grid}
+
+# Solve one sudoku without printing anything.  grid is text (9 lines, or one 81-character line) or a 9x9 list.
+# rules selects the logic rules to use, as on a "Rules" line.  trace, if given, is called with each rule's
+# diagnostic messages (e.g. trace=print).  engine is the solving driver: "passes", "queue", "adaptive" (see ENGINES)
+# or a driver function.
+# profile, if given, is a RuleProfiler to record every rule call in.  recorder, if given, is a StepRecorder to log
+# every step in.  cache, if given, is a sudoku_cache.SolveCache that answers sudokus solved before (used only
+# without max_passes, trace, profile, recorder, or deadline).  deadline, if given, is a time.perf_counter() value
+# after which no new pass is started.
+def solve(grid, rules="0123456789AB", max_passes=None, trace=None, engine="passes", profile=None, cache=None, recorder=None,
+		deadline=None):
+	if cache is not None and max_passes is None and trace is None and profile is None and recorder is None and deadline is None:
+		return cache.solve(grid, rules, engine)
+	start = time.perf_counter()
+	s = sudoku_from_grid(grid)
+	s.set_trace(trace)
+	s.set_recorder(recorder)
+	limits = {"max_passes": max_passes} if deadline is None else {"max_passes": max_passes, "deadline": deadline}	# a driver
+																# function need not take a deadline unless given one
+	solved, passes = get_engine(engine)(s, rules, verbose=False, profile=profile, **limits)
+	return SolveResult(s, solved, passes, time.perf_counter() - start)
+
+
+### Batch driver
+
+# Read puzzles one at a time from an open file: each is a "Rules ..." line followed by 9 grid lines.
+# Notes and other lines between puzzles are skipped.  Yields (rules_to_use, Sudoku) pairs.
+def read_puzzles(ifile):
+	for line in ifile:
+		if line.startswith("Rules"):
+			yield line[len("Rules"):].strip(), Sudoku(ifile)
+
+# Same as read_puzzles, but yields (rules_to_use, grid_text) pairs, which are cheap to send to other processes
+def read_puzzle_texts(ifile):
+	for line in ifile:
+		if line.startswith("Rules"):
+			yield line[len("Rules"):].strip(), "".join([ifile.readline() for i in range(9)])
+
+# Solve one puzzle and return its result record
+def solve_record(number, rules_to_use, s, engine="passes", profile=None):
+	start = time.perf_counter()
+	solved, passes = get_engine(engine)(s, rules_to_use, verbose=False, profile=profile)
+	return {"puzzle": number, "rules": rules_to_use, "solved": solved, "passes": passes,
+		"candidates": s.count_options(), "seconds": time.perf_counter() - start}
+
+def solve_text(number, rules_to_use, grid_text, engine="passes"):	# solve_record of a puzzle given as text
+	return solve_record(number, rules_to_use, sudoku_from_grid(grid_text), engine)
+
+# Solve every puzzle in an open file, yielding one result record (a dict) per puzzle as it is solved
+def solve_batch(ifile, engine="passes", profile=None):
+	for number, (rules_to_use, s) in enumerate(read_puzzles(ifile), 1):
+		yield solve_record(number, rules_to_use, s, engine, profile)
+
+# Worker side of solve_batch_parallel: solve a chunk of (number, rules_to_use, grid_text) puzzles.
+# Returns (records, profile_dict); profile_dict is the chunk's RuleProfiler.as_dict() if profiling, else None.
+def solve_chunk(chunk, engine="passes", profiling=False):
+	profile = RuleProfiler() if profiling else None
+	records = [solve_record(number, rules_to_use, Sudoku(io.StringIO(grid_text)), engine, profile)
+		for number, rules_to_use, grid_text in chunk]
+	return records, profile.as_dict() if profiling else None
+
+# Parent side: add a finished chunk's profile to profile, and return its records
+def chunk_records(future, profile):
+	records, profile_dict = future.result()
+	if profile is not None:
+		profile.add(profile_dict)
+	return records
+
+# Solve every puzzle in an open file on a pool of worker processes, sending them chunk_size puzzles at a time.
+# If ordered, records are yielded in input order; otherwise each chunk's records are yielded as soon as it finishes.
+# If profile is a RuleProfiler, the workers' rule profiles are added to it.
+def solve_batch_parallel(ifile, workers=None, chunk_size=50, ordered=True, engine="passes", profile=None):
+	numbered = ((number, rules_to_use, grid_text) for number, (rules_to_use, grid_text) in enumerate(read_puzzle_texts(ifile), 1))
+	chunks = iter(lambda: list(islice(numbered, chunk_size)), [])
+	jobs = ((solve_chunk, chunk, engine, profile is not None) for chunk in chunks)
+	return run_chunk_jobs(jobs, workers, ordered, profile)
+
+# Run jobs, each a (function, *args) tuple returning (records, profile_dict) like solve_chunk, on a pool of worker
+# processes, yielding their records.  At most two jobs per worker are in flight, so memory stays flat however many
+# jobs there are.
+def run_chunk_jobs(jobs, workers=None, ordered=True, profile=None):
+	from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED	# here, not at the top: slow to import
+	workers = workers or os.cpu_count() or 1
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		pending = deque()
+		while True:
+			job = next(jobs, None)
+			if job:
+				pending.append(pool.submit(*job))
+			if not pending:
+				break
+			if job and len(pending) < 2 * workers:
+				continue				# keep the pool busy before waiting on results
+			if ordered:
+				yield from chunk_records(pending.popleft(), profile)
+			else:
+				done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+				pending = deque(f for f in pending if f in not_done)
+				for future in done:
+					yield from chunk_records(future, profile)
+
+def print_batch_result(result):
+	if result.get("error"):
+		print("Puzzle {} (Rules {}): error: {}".format(result["puzzle"], result["rules"], result["error"]))
+		return
+	outcome = "solved in {} passes".format(result["passes"]) if result["solved"] else "stuck on pass {}".format(result["passes"])
+	print("Puzzle {} (Rules {}): {}, {} candidates left, {:.3f} s".format(result["puzzle"], result["rules"],
+		outcome, result["candidates"], result["seconds"]))
+
+# Solve every puzzle in path ('-' for stdin), printing one result line each.  If results_path is given, the batch is a
+# resumable job (see sudoku_jobs.py): the records are saved there, a puzzle that raises an error is saved to
+# rejects_path instead of stopping the batch, and a batch stopped part way goes on from its last checkpoint.
+def run_batch(path, workers=1, chunk_size=50, ordered=True, engine="passes", profile=None, numpy_batch=None, cache=None,
+		results_path=None, rejects_path=None, shared_batch=None):
+	from sudoku_pack import is_packed, packed_texts, solve_packed
+	packed = path != "-" and is_packed(path)
+	ifile = sys.stdin if path == "-" else None if packed or results_path else open(path, "r")
+	if results_path:
+		from sudoku_jobs import resume_message, run_resumable
+		message = resume_message(results_path)
+		if message:
+			print(message)
+		results = run_resumable(path, partial(solve_text, engine=engine), results_path, rejects_path, workers, chunk_size,
+			{"job": "solve", "engine": getattr(engine, "keywords", engine)})
+	elif cache is not None:
+		from sudoku_cache import solve_batch_cached
+		results = solve_batch_cached(packed_texts(path) if packed else read_puzzle_texts(ifile), cache, engine)
+	elif numpy_batch:
+		from sudoku_numpy import solve_batch_numpy		# optional; needs NumPy
+		results = solve_batch_numpy(packed_texts(path) if packed else read_puzzle_texts(ifile), numpy_batch, engine)
+	elif packed:
+		results = solve_packed(path, workers, chunk_size, ordered, engine, profile)
+	elif shared_batch:
+		from sudoku_shared import solve_batch_shared
+		results = solve_batch_shared(ifile, workers, chunk_size, ordered, engine, profile, shared_batch)
+	elif workers == 1:
+		results = solve_batch(ifile, engine, profile)
+	else:
+		results = solve_batch_parallel(ifile, workers, chunk_size, ordered, engine, profile)
+	solved = stuck = errors = 0
+	for result in results:
+		print_batch_result(result)
+		if result.get("error"):
+			errors += 1
+		elif result["solved"]:
+			solved += 1
+		else:
+			stuck += 1
+	if ifile not in (sys.stdin, None):
+		ifile.close()
+	print("Batch done:", solved, "solved,", stuck, "stuck" + (", {} errors.".format(errors) if errors else "."))
+
+
+### Main driver
+
+def main():
+	import argparse		# here, not at the top, so importing the library stays quick
+
+	parser = argparse.ArgumentParser(description="Solve sudoku puzzles with deductive rules.")
+	parser.add_argument("input", nargs="?", default="sudoku.txt", help="puzzle to solve: a Rules line and 9 grid lines, "
+		"or just the grid (9 lines or one 81-character line), ('-' for stdin; default sudoku.txt)")
+	parser.add_argument("--rules", metavar="RULES", help="rules to use, instead of the input's Rules line")
+	parser.add_argument("--quiet", action="store_true", help="print only the result and the final grid, not each pass")
+	parser.add_argument("--live", type=float, nargs="?", const=10.0, metavar="FPS", help="show the grid redrawn in place "
+		"as it is solved, at most FPS times a second (default 10), instead of printing every pass")
+	parser.add_argument("--batch", metavar="FILE", help="solve every puzzle in FILE ('-' for stdin), one result line each")
+	parser.add_argument("--workers", type=int, default=1, metavar="N",
+		help="batch mode: solve on N worker processes (0 = one per CPU; default 1, no pool)")
+	parser.add_argument("--chunk-size", type=int, default=50, metavar="N", help="batch mode: puzzles sent to a worker at a time")
+	parser.add_argument("--unordered", action="store_true", help="batch mode: print results as they finish, not in input order")
+	parser.add_argument("--numpy", type=int, nargs="?", const=4096, metavar="N", help="batch mode: apply rules 0, 1 and 5 "
+		"to N puzzles at a time with NumPy (default 4096), then finish stalled puzzles with --engine")
+	parser.add_argument("--shared", type=int, nargs="?", const=4096, metavar="N", help="batch mode with workers: hand "
+		"puzzles to the workers and results back through shared memory, N at a time (default 4096), not by pickling")
+	parser.add_argument("--cache", nargs="?", const="", metavar="DB_FILE", help="batch mode: answer sudokus seen before "
+		"(also rotated, shuffled, or relabeled) from a cache, kept in memory, and in DB_FILE if given")
+	parser.add_argument("--engine", choices=sorted(ENGINES), default="passes",
+		help="passes: every rule on every container each pass (default); queue: only recheck containers that changed; "
+			"adaptive: cheapest rules first, costlier ones only when those stall")
+	parser.add_argument("--order", metavar="RULES", help="adaptive engine: ladder order of the rules (default {})".format(ADAPTIVE_ORDER))
+	parser.add_argument("--learn-order", metavar="JSON_FILE", help="adaptive engine: order rules by cost per elimination "
+		"measured in a --profile JSON_FILE")
+	parser.add_argument("--profile", nargs="?", const="-", metavar="JSON_FILE",
+		help="count calls, time, and eliminations of each rule; print a table at the end, or save JSON to JSON_FILE")
+	parser.add_argument("--steps", metavar="FILE", help="save every step the rules take to FILE, as JSON lines (or a "
+		"binary log if FILE ends in .bin)")
+	parser.add_argument("--results", metavar="FILE", help="batch mode: save every result to FILE (JSON lines) as a "
+		"resumable job; run again to go on from where it stopped")
+	parser.add_argument("--rejects", metavar="FILE", help="batch mode with --results: save puzzles that can't be read or "
+		"solved to FILE instead of stopping")
+	args = parser.parse_args()
+
+	profile = RuleProfiler() if args.profile else None
+	engine = args.engine
+	if args.learn_order:
+		import json
+		with open(args.learn_order, "r") as ifile:
+			args.order = order_from_profile(json.load(ifile))
+	if args.order:
+		engine = partial(solve_sudoku_adaptive, order=args.order)
+		print("Adaptive rule order:", args.order)
+
+	if args.batch:
+		if args.steps:
+			parser.error("--steps works only when solving sudoku.txt, not with --batch")
+		if args.results and (args.batch == "-" or args.unordered or args.numpy or args.cache is not None or args.profile):
+			parser.error("--results needs an input file, and works without --unordered, --numpy, --cache, and --profile")
+		if args.rejects and not args.results:
+			parser.error("--rejects works only with --results")
+		if args.shared and (args.workers == 1 or args.numpy or args.results or args.cache is not None):
+			parser.error("--shared needs --workers other than 1, and works without --numpy, --results, and --cache")
+		if args.shared and args.batch != "-":
+			from sudoku_pack import is_packed
+			if is_packed(args.batch):	# its workers already read the puzzles from one shared map of the file
+				parser.error("--shared works only with text input, not a packed file")
+		cache = None
+		if args.cache is not None:
+			if args.workers != 1 or args.numpy or args.profile or args.order:
+				parser.error("--cache works only with one worker and a named --engine, without --numpy or --profile")
+			from sudoku_cache import SolveCache
+			cache = SolveCache(path=args.cache or None)
+		run_batch(args.batch, args.workers, args.chunk_size, not args.unordered, engine, profile, args.numpy, cache,
+			args.results, args.rejects, args.shared)
+		if cache is not None:
+			print("Cache: {} hits, {} misses.".format(cache.hits, cache.misses))
+			cache.close()
+		print_profile(profile, args.profile)
+		return
+
+	# Open data file
+	ifile = sys.stdin if args.input == "-" else open(args.input, "r")
+
+	rules_to_use = ifile.readline() # first line of file is logic rules (0-9) to use
+	if rules_to_use.startswith("Rules"):
+		s = Sudoku(ifile)		# initialize Sudoku from data file
+	else:						# no Rules line: the file is just the grid
+		s = sudoku_from_grid(rules_to_use + ifile.read())
+		rules_to_use = "Rules " + RULE_ORDER + "\n"
+	if args.rules:
+		rules_to_use = "Rules " + args.rules + "\n"
+	if args.live is not None:
+		s.set_display(GridDisplay(sys.stdout, args.live))
+	elif not args.quiet:
+		print("Solving sudoku using", rules_to_use)
+		s.set_trace(print)		# show what each rule finds
+	if args.steps:
+		s.set_recorder(StepRecorder())
+
+	if ifile is not sys.stdin:
+		ifile.close()	# close data file 
+
+	start = time.perf_counter()
+	solved, passes = get_engine(engine)(s, rules_to_use, verbose=not args.quiet and args.live is None, profile=profile)
+	if args.live is not None:
+		s.display.show(s, passes, final=True)
+		print(SolveResult(s, solved, passes, time.perf_counter() - start))
+	elif args.quiet:
+		print(SolveResult(s, solved, passes, time.perf_counter() - start))
+		print(s.to_line())
+	print_profile(profile, args.profile)
+	if args.steps:
+		save_steps(s.recorder, args.steps)
+
+def print_profile(profile, path):
+	if profile is None:
+		return
+	if path == "-":
+		print(profile.report())
+	else:
+		with open(path, "w") as ofile:
+			ofile.write(profile.to_json())
 
-main()
+if __name__ == "__main__":		# don't solve on import (e.g. in worker processes)
+	main()
@@ -0,0 +1,240 @@
+import io
+import os
+import time
+import unittest
+from sudoku import Sudoku
+from sudoku_solver import read_puzzle_texts, solve_sudoku
+
+# Regression tests: "python3 -m unittest test_sudoku" (or pytest) in this directory.  They use the puzzles in
+# sudoku.txt; the NumPy ones are skipped when NumPy isn't installed.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS = os.path.join(HERE, "sudoku.txt")
+
+def corpus_puzzles():				# (rules_to_use, grid_text) of every puzzle in sudoku.txt
+	with open(CORPUS, "r") as ifile:
+		return list(read_puzzle_texts(ifile))
+
+
+class CacheTest(unittest.TestCase):
+
+	def test_canonical_form_gives_up_quickly_on_empty_grid(self):
+		from sudoku_cache import canonical_form
+		start = time.perf_counter()
+		self.assertIsNone(canonical_form([0] * 81))		# ties in too many ways; took about a minute
+		self.assertLess(time.perf_counter() - start, 1.0)
+
+	def test_grid_too_symmetric_to_canonicalize_is_cached_as_given(self):
+		from sudoku_cache import SolveCache
+		cache = SolveCache()
+		line = "123456789" + "-" * 72
+		first = cache.solve(line, "0123")
+		again = cache.solve(line, "0123")
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+		self.assertEqual(first.masks, again.masks)
+
+
+class ServerTest(unittest.TestCase):
+
+	def test_budgets_must_be_finite_and_positive(self):
+		from sudoku_server import RequestError, number_option
+		for value in ("nan", "inf", "-inf", 1e400, 0, "-1"):
+			with self.assertRaises(RequestError) as raised:
+				number_option({"timeout": value}, "timeout", 10.0, float)
+			self.assertEqual(raised.exception.status, 400)
+		self.assertEqual(number_option({"timeout": "2.5"}, "timeout", 10.0, float), 2.5)
+
+	def test_contradiction_is_raised_not_printed(self):
+		import contextlib
+		from sudoku import Contradiction
+		from sudoku_server import solve_job
+		output = io.StringIO()
+		with contextlib.redirect_stdout(output), self.assertRaises(Contradiction):
+			solve_job("48--5---773-----5--5----1----21--6------5-6----8-14----9---77------89163--757-73-", "0123456789AB",
+				"passes", 100, time.time() + 10)
+		self.assertEqual(output.getvalue(), "")
+
+	def test_solve_past_its_deadline_reports_none(self):
+		from sudoku_server import solve_job
+		self.assertIsNone(solve_job("-23-65-899----4--55--9-----6--3---1838-59---2----863--23------68-7-2---3-96-5382-", "0123",
+			"passes", 100, time.time() - 1))
+
+
+class ChainRuleTest(unittest.TestCase):
+
+	def test_chains_keep_the_solution(self):	# rule D, where the other rules are stuck, never removes a solution digit
+		from sudoku_check import solution_of
+		from sudoku_solver import apply_rule
+		eliminated = helped = 0
+		for number, (rules_to_use, grid_text) in enumerate(corpus_puzzles(), 1):
+			s = Sudoku(io.StringIO(grid_text))
+			solution = solution_of(s.to_line())
+			solved, passes = solve_sudoku(s, "0123456789ABC", verbose=False)
+			found = False
+			while not solved:
+				before = s.get_cands()[:]
+				apply_rule(s, "D")
+				after = s.get_cands()
+				self.assertEqual([i for i in range(81) if not after[i] & solution[i]], [], "puzzle {}".format(number))
+				if after == before:
+					break
+				eliminated += sum([bin(old & ~new).count("1") for old, new in zip(before, after)])
+				found = True
+				solved, passes = solve_sudoku(s, "0123456789ABC", verbose=False)
+			helped += found
+		self.assertGreater(helped, 0)
+		self.assertGreater(eliminated, helped)
+
+
+class StepRecorderTest(unittest.TestCase):
+
+	def replay(self, givens, steps):	# the candidates after taking out each step's (cell, lost mask) from givens
+		cands = list(givens)
+		for eliminated in steps:
+			for i, lost in eliminated:
+				self.assertEqual(cands[i] & lost, lost)		# only candidates still there can be lost
+				cands[i] &= ~lost
+		return cands
+
+	def test_saved_steps_replay_to_final_grid(self):
+		import json
+		from sudoku import digits_to_mask
+		from sudoku_solver import StepRecorder
+		for number, (rules_to_use, grid_text) in enumerate(corpus_puzzles(), 1):
+			s = Sudoku(io.StringIO(grid_text))
+			givens = s.get_cands()[:]
+			s.set_recorder(StepRecorder(64))		# small, so the buffer has to grow
+			solve_sudoku(s, rules_to_use + "D", verbose=False)
+			jsonl = io.StringIO()
+			s.recorder.write_jsonl(jsonl)
+			binary = io.BytesIO()
+			s.recorder.write_binary(binary)
+			binary.seek(0)
+			steps = [json.loads(line) for line in jsonl.getvalue().splitlines()]
+			self.assertEqual(len(steps), len(s.recorder))
+			self.assertEqual(self.replay(givens, [[(r * 9 + c, digits_to_mask(digits)) for r, c, digits in step["eliminated"]]
+				for step in steps]), s.get_cands(), "puzzle {}, JSON lines".format(number))
+			self.assertEqual(self.replay(givens, [eliminated for rule, digits, pattern, eliminated in
+				StepRecorder.read_binary(binary).steps()]), s.get_cands(), "puzzle {}, binary".format(number))
+
+
+class PackTest(unittest.TestCase):
+
+	def test_packed_file_gives_back_its_puzzles(self):
+		import subprocess
+		import sys
+		import tempfile
+		from sudoku_pack import PackedPuzzles, convert_text
+		puzzles = corpus_puzzles()
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "sudoku.sdkb")
+			with open(CORPUS, "r") as ifile:
+				self.assertEqual(convert_text(ifile, path, "passes"), len(puzzles))
+			text = subprocess.run([sys.executable, os.path.join(HERE, "sudoku_pack.py"), "--text", path],
+				capture_output=True, text=True, check=True).stdout
+			packed = PackedPuzzles(path)
+			try:
+				for k, (rules_to_use, grid_text) in enumerate(puzzles):
+					s = Sudoku(io.StringIO(grid_text))
+					solved, passes = solve_sudoku(s, rules_to_use, verbose=False)
+					self.assertEqual(packed.get_status(k), "solved" if solved else "stuck")
+					self.assertEqual(list(packed.get_masks(k)), s.get_cands())
+			finally:
+				packed.close()
+		def grids(puzzles):			# rules and givens of each puzzle; sudoku.txt marks empty cells with ' ' as well as '-'
+			return [(rules_to_use, Sudoku(io.StringIO(grid_text)).to_line()) for rules_to_use, grid_text in puzzles]
+		self.assertEqual(grids(read_puzzle_texts(io.StringIO(text))), grids(puzzles))
+
+
+class JobsTest(unittest.TestCase):
+
+	def without_times(self, records):	# the saved records, without their times
+		return [dict([(key, value) for key, value in record.items() if key != "seconds"]) for record in records]
+
+	def test_stopped_job_resumes_to_same_results(self):
+		import json
+		import tempfile
+		from functools import partial
+		from sudoku_jobs import run_resumable
+		from sudoku_solver import solve_text
+		work = partial(solve_text, engine="passes")
+		puzzles = corpus_puzzles()[:30]
+		puzzles[4] = (puzzles[4][0], puzzles[4][1].replace("-", "x", 1))	# can't be read: goes to the rejects
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "puzzles.txt")
+			with open(path, "w") as ofile:
+				ofile.write("".join(["Rules {}\n{}".format(rules_to_use, grid_text) for rules_to_use, grid_text in puzzles]))
+			files = dict([(name, os.path.join(directory, name)) for name in ("whole", "whole.rej", "parts", "parts.rej")])
+			list(run_resumable(path, work, files["whole"], files["whole.rej"], checkpoint_seconds=0))
+			job = run_resumable(path, work, files["parts"], files["parts.rej"], checkpoint_seconds=0)
+			first = [next(job) for i in range(12)]
+			job.close()
+			for name in ("parts", "parts.rej"):		# half-written after the checkpoint, as if killed
+				with open(files[name], "ab") as ofile:
+					ofile.write(b'{"puzzle": 13, "rul')
+			rest = list(run_resumable(path, work, files["parts"], files["parts.rej"], checkpoint_seconds=0))
+			self.assertEqual([record["puzzle"] for record in first + rest], list(range(1, 31)))
+			results = {}
+			for name in files:
+				with open(files[name], "r") as ifile:
+					results[name] = ifile.read()
+		whole = [json.loads(line) for line in results["whole"].splitlines()]
+		self.assertEqual(self.without_times([json.loads(line) for line in results["parts"].splitlines()]), self.without_times(whole))
+		self.assertEqual(results["parts.rej"], results["whole.rej"])
+		self.assertEqual([record["puzzle"] for record in whole if record.get("error")], [5])
+		self.assertTrue(results["whole.rej"].startswith("Puzzle 5: Invalid character x in input.\nRules "))
+
+
+class GradeTest(unittest.TestCase):
+
+	def test_graded_rules_cannot_be_left_out(self):
+		from sudoku_grade import grade_record
+		for number, (rules_to_use, grid_text) in enumerate(corpus_puzzles()[:60], 1):
+			record = grade_record(number, grid_text)
+			if not record["solved"]:
+				continue
+			for rule in record["rules"]:
+				s = Sudoku(io.StringIO(grid_text))
+				solved, passes = solve_sudoku(s, record["rules"].replace(rule, ""), verbose=False)
+				self.assertFalse(solved, "puzzle {} solves without rule {}".format(number, rule))
+
+	def test_solved_grid_needs_no_rules(self):
+		from sudoku_grade import grade_record
+		record = grade_record(1, "534678912672195348198342567859761423426853791713924856961537284287419635345286179")
+		self.assertEqual((record["grade"], record["rules"], record["hardest"], record["score"]), ("EASY", "", None, 0))
+
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+@unittest.skipIf(numpy is None, "needs NumPy")
+class VectorRulesTest(unittest.TestCase):
+
+	def test_vector_rules_match_scalar_engine(self):		# every set of the vector rules, candidate for candidate
+		from sudoku_numpy import solve_states
+		puzzles = corpus_puzzles()
+		for rules in ("0", "1", "5", "01", "05", "15", "015"):
+			states = solve_states([(rules, grid_text) for rules_to_use, grid_text in puzzles])
+			for k, (rules_to_use, grid_text) in enumerate(puzzles):
+				s = Sudoku(io.StringIO(grid_text))
+				solved, passes = solve_sudoku(s, rules, verbose=False)
+				batch, batch_solved, batch_passes, error, seconds = states[k]
+				self.assertFalse(error)
+				self.assertEqual(batch_solved, solved)
+				self.assertEqual(batch.get_cands(), s.get_cands(), "rules {}, puzzle {}".format(rules, k + 1))
+
+	def test_numpy_batch_counts_no_errors(self):
+		import contextlib
+		from sudoku_solver import run_batch
+		output = io.StringIO()
+		with contextlib.redirect_stdout(output):
+			run_batch(CORPUS, numpy_batch=4096)
+		lines = output.getvalue().splitlines()
+		self.assertEqual(lines[-1], "Batch done: 122 solved, 21 stuck.")
+		self.assertEqual([line for line in lines if "error" in line], [])
+
+
+if __name__ == "__main__":
+	unittest.main()